@@ -56,17 +56,21 @@ import re
 import traceback
 import exceptions
 import base64
-from beah.misc.jsonenv import json
+import binascii
+from beah.misc import jsonenv
 import logging
 from xml.dom import minidom
 import socket
+import struct
 import time
+import zlib
 try:
     set
 except NameError: # Python 2.3
     from sets import Set as set
+from collections import deque
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.internet.task import LoopingCall
 from twisted.python import failure
 from twisted.web import xmlrpc
@@ -583,14 +587,14 @@ def run_task(runtime, check_task=None, get_roles=None, env_overrides=None):
                         args=task_data['args'])
                 task_uuid = run_cmd.id()
                 runtime.type_set('tasks_by_id', task_beaker_id, (run_cmd, task_uuid))
-                runtime.sync()
+                runtime.barrier()
             # get task
             if task is None:
                 task = recipe.tasks.make(task_uuid, **task_args)
                 if task is None:
                     log.error("task id: %r failed.", task_beaker_id)
                     return
-            runtime.sync()
+            runtime.barrier()
             thingy = defer.waitForDeferred(backend.send_cmd(run_cmd))
             yield thingy
             thingy.getResult()
@@ -644,7 +648,7 @@ def handle_error(result, *args, **kwargs):
 
 
 def jsonln(obj):
-    return "%s\n" % json.dumps(obj)
+    return "%s\n" % jsonenv.dumps(obj)
 
 
 def open_(name, mode):
@@ -861,24 +865,62 @@ class BeakerWriter(writers.JournallingWriter, BeakerObject, Item):
         id = parent.beaker_id
         offs_ = 'offsets/%s' % parent.id
         offs = parent.runtime().type_get(offs_, name, 0)
-        rpc = parent.proxy().callRemote
+        prepared_rpc = parent.proxy().preparedRemote
+        backend = parent.backend()
         method = parent.UPLOAD_METHOD
         digest_method = parent.digest_method()
         filename=os.path.basename(name)
         path=os.path.dirname(name) or '/'
+        # uploads of the file are ordered, other files are uploaded in parallel:
+        stream = (method, id, path, filename)
         digest_constructor = digests.DigestConstructor(digest_method or 'md5')
         runtime_set = self.runtime().type_set
-        self.send = (lambda cdata:
-                rpc(method, id, path, filename, len(cdata),
-                    digest_constructor(cdata).hexdigest(),
-                    self.get_offset(),
-                    event.encode("base64", cdata)))
+        def send(cdata):
+            # digest and encoding are computed in a thread, the call keeps
+            # its place in the stream:
+            upload_codec = backend.upload_codec
+            head = (id, path, filename, len(cdata))
+            offset = self.get_offset()
+            def make_args(prepared):
+                digest, data_args = prepared
+                return head + (digest, offset) + data_args
+            args_d = threads.deferToThread(prepare_upload, cdata, upload_codec,
+                    digest_constructor).addCallback(make_args)
+            suffix = upload_codec and ENCODED_UPLOAD_SUFFIX or ''
+            return prepared_rpc(stream, method + suffix, args_d)
+        self.send = send
         self.set_offset = (lambda offset: (
             runtime_set(offs_, name, offset),
             writers.JournallingWriter.set_offset(self, offset)))
-        jname = os.path.join(parent.backend().conf.get('DEFAULT', 'VAR_ROOT'), "journals", id, name)
+        conf = parent.backend().conf
+        jname = os.path.join(conf.get('DEFAULT', 'VAR_ROOT'), "journals", id, name)
         journal = open_(jname, "ab+")
-        writers.JournallingWriter.__init__(self, journal, offs, capacity=4096, no_split=True)
+        # Send chunks of at least capacity bytes, growing up to max_capacity
+        # while the proxy is busy. Data are sent after flush_delay anyway.
+        capacity = int(conf.get('DEFAULT', 'UPLOAD_CHUNK_SIZE'))
+        max_capacity = max(capacity, int(conf.get('DEFAULT', 'UPLOAD_CHUNK_MAX')))
+        self.flush_delay = float(conf.get('DEFAULT', 'UPLOAD_FLUSH_DELAY'))
+        self.flush_timer = None
+        writers.JournallingWriter.__init__(self, journal, offs,
+                capacity=capacity, no_split=True, max_capacity=max_capacity)
+
+    def ready(self): # pylint: disable=E0202
+        return self.proxy().is_ready()
+
+    def schedule_flush(self): # pylint: disable=E0202
+        if self.flush_timer is None and self.flush_delay > 0:
+            self.flush_timer = reactor.callLater(self.flush_delay,
+                    self.flush_timeout)
+
+    def flush_timeout(self):
+        self.flush_timer = None
+        self.flush()
+
+    def flush(self): # pylint: disable=E0202
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        writers.JournallingWriter.flush(self)
 
     def close(self): # pylint: disable=E0202
         self.journal.close()
@@ -1028,6 +1070,9 @@ class NullFile(object):
     def write(self, args):
         pass
 
+    def file_close(self):
+        pass
+
     def close(self):
         pass
 
@@ -1216,7 +1261,8 @@ class BeakerTask(PersistentBeakerObject):
     def stop(self, type, msg):
         # type: ('stop'|'abort')
         self.flush()
-        return self.proxy().callRemote('task_stop', self.beaker_id, type, msg) \
+        # task_stop has to wait for all uploads:
+        return self.proxy().barrierRemote('task_stop', self.beaker_id, type, msg) \
                 .chainDeferred(self.deferred)
 
 
@@ -1237,7 +1283,7 @@ class BeakerResult(BeakerObject, PersistentItem):
         return self._name
 
     def make_message(cls, **kwargs):
-        return json.dumps(kwargs)
+        return jsonenv.dumps(kwargs)
     make_message = classmethod(make_message)
 
     def make_object(cls, id, parent, args={}):
@@ -1307,6 +1353,27 @@ class BeakerResult(BeakerObject, PersistentItem):
         return self.parent.check_upload(delta, size)
 
 
+BASE64_WHITESPACE = ' \t\r\n'
+
+
+def base64_decoded_len(data):
+    """
+    Return length of base64 encoded data after decoding without decoding it.
+
+    Return None when data are not valid base64: number of characters other
+    than whitespace is not a multiple of four.
+    """
+    count = len(data)
+    for c in BASE64_WHITESPACE:
+        count -= data.count(c)
+    if count % 4:
+        return None
+    end = len(data)
+    while end > 0 and data[end-1] in BASE64_WHITESPACE:
+        end -= 1
+    return count / 4 * 3 - data.count('=', max(0, end-2), end)
+
+
 class BeakerFile(PersistentBeakerObject):
 
     METADATA = "file_info"
@@ -1349,14 +1416,42 @@ class BeakerFile(PersistentBeakerObject):
     def write_object(self):
         pass
 
+    def pass_through(data, in_codec, out_codec, in_digest, out_digest_method):
+        '''
+        Return (cdata_len, out_data, out_digest) without decoding data or None.
+
+        Data already in out_codec are passed through, when the digest does
+        not have to be calculated.
+        '''
+        if data is None or in_codec != out_codec or in_codec != 'base64':
+            return None
+        dm, digest = digests.make_digest(in_digest) or (None, None)
+        if dm != out_digest_method and \
+                digests.DigestConstructor(out_digest_method) is digests.NoDigest:
+            dm, digest = out_digest_method, ""
+        if dm == out_digest_method:
+            cdata_len = base64_decoded_len(data)
+            if cdata_len is not None:
+                return (cdata_len, data, digest)
+        return None
+    pass_through = staticmethod(pass_through)
+
     def recode(data, in_codec, out_codec, in_digest, out_digest_method):
         '''
         return: (cdata_len, out_data, out_digest)
+
+        See pass_through for data which are not decoded.
         '''
+        if data is None:
+            raise RuntimeError("No data found.")
+        answ = BeakerFile.pass_through(data, in_codec, out_codec, in_digest,
+                out_digest_method)
+        if answ is not None:
+            return answ
+        dm, digest = digests.make_digest(in_digest) or (None, None)
         cdata = event.decode(in_codec, data)
         if cdata is None:
             raise RuntimeError("No data found.")
-        dm, digest = digests.make_digest(in_digest) or (None, None)
         # FIXME: Optionally check digest
         if dm != out_digest_method:
             digest = digests.DigestConstructor(out_digest_method)(cdata).hexdigest()
@@ -1384,19 +1479,52 @@ class BeakerFile(PersistentBeakerObject):
                 id = self.parent.beaker_id
                 path, filename = self.filename()
                 self.stored_data['be:uploading_as'] = (method, id, path, filename)
-            rpc = self.proxy().callRemote
+            rpc = self.proxy().streamRemote
+            encode_upload = self.backend().encode_upload
+            stream = (method, id, path, filename)
             log.debug("writer for method=%r, id=%r, path=%r, filename=%r", method, id, path, filename)
             def writer_(size, digest, offset, data):
-                return rpc(method, id, path, filename, size, digest, str(offset), data)
+                suffix, data_args = encode_upload(data, 'base64')
+                return rpc(stream, method + suffix, id, path, filename, size, digest, str(offset), *data_args)
+            prepared_rpc = self.proxy().preparedRemote
+            def prepared_writer_(upload_codec, chunk_d):
+                # chunk_d is called with (size, digest, offset, data) or None
+                def make_args(chunk):
+                    if chunk is None:
+                        return None
+                    size, digest, offset, data = chunk
+                    if upload_codec:
+                        data_args = (upload_codec, data)
+                    else:
+                        data_args = (data,)
+                    return (id, path, filename, size, digest, str(offset)) + data_args
+                suffix = upload_codec and ENCODED_UPLOAD_SUFFIX or ''
+                return prepared_rpc(stream, method + suffix,
+                        chunk_d.addCallback(make_args))
             self._be_writer = writer_
+            self._be_prepared_writer = prepared_writer_
         return self._be_writer
 
+    def prepared_writer(self):
+        """
+        Return function uploading a chunk, which is not prepared yet.
+
+        The function takes upload codec and a Deferred called with
+        (size, digest, offset, data) tuple or None to skip the upload.
+        """
+        self.writer()
+        return self._be_prepared_writer
+
     def check_offset(self, offset):
         """
         Check the offset and return pair (offset to use, original offset).
 
+        Original offset is the end of data sent so far, which may not be
+        confirmed yet.
         """
-        seqoff = self.stored_data.get('offset', 0)
+        seqoff = getattr(self, '_be_sent_offset', None)
+        if seqoff is None:
+            seqoff = self.stored_data.get('offset', 0)
         if offset is None:
             offset = seqoff
         elif offset != seqoff:
@@ -1408,19 +1536,150 @@ class BeakerFile(PersistentBeakerObject):
                         offset, seqoff)
         return (offset, seqoff)
 
+    def expected_digest(self):
+        """Return pair (digest method, digest) from file's metadata."""
+        digest = self.get_meta('digest', None)
+        if isinstance(digest, (list, tuple)):
+            return (digest[0], digest[1])
+        if digest:
+            return (digests.which_digest(digest), digest)
+        return (None, None)
+
+    def file_digest(self, offset):
+        """
+        Return FileDigest of the file or None if no digest is expected.
+
+        State of the digest is kept in runtime.
+        """
+        fd = getattr(self, '_be_file_digest', None)
+        if fd is None:
+            state = self.stored_data.get('digest_state', None)
+            if state is not None:
+                fd = digests.FileDigest.from_state(state)
+            else:
+                method = self.expected_digest()[0]
+                if not method:
+                    return None
+                fd = digests.FileDigest(method, offset)
+            self._be_file_digest = fd
+        return fd
+
     def write(self, args):
-        (offset, seqoff) = self.check_offset(args.get('offset', None))
+        """
+        Upload a chunk of data.
+
+        Data which have to be decoded, encoded or hashed are processed in a
+        thread. Chunks are processed in order: while any chunk is being
+        prepared, following chunks wait for it.
+        """
         codec = args.get('codec', None)
         if codec is None:
             codec = self.get_meta('codec', None)
-        size, data, digest = self.recode(args.get('data'), codec, "base64", args.get('digest', None), self.backend().digest_method)
+        data = args.get('data')
+        in_digest = args.get('digest', None)
+        offsets = None
+        if not getattr(self, '_be_preparing', 0):
+            (offset, seqoff) = offsets = self.check_offset(args.get('offset', None))
+            fd = self.file_digest(offset)
+            if not self.rehash(fd, offset, data):
+                chunk = self.pass_through(data, codec, "base64", in_digest,
+                        self.backend().digest_method)
+                if chunk is not None:
+                    self.write_chunk(offset, seqoff, chunk, fd, False)
+                    return
+            self._be_chain = defer.succeed(None)
+        self._be_preparing = getattr(self, '_be_preparing', 0) + 1
+        upload_codec = self.backend().upload_codec
+        chunk_d = defer.Deferred()
+        rpc_d = self.prepared_writer()(upload_codec, chunk_d)
+        def prepare(_):
+            return self.prepare_chunk(args, offsets, codec, data, in_digest,
+                    upload_codec)
+        def done(result):
+            self._be_preparing -= 1
+            if not self._be_preparing:
+                self._be_chain = None
+            if isinstance(result, failure.Failure):
+                rpc_d.addErrback(self.write_failed)
+            elif result is not None:
+                rpc_d.addCallbacks(self.written, self.write_failed,
+                        callbackKeywords=dict(new_offset=result[2]+result[0]))
+            return result
+        self._be_chain.addCallback(prepare).addBoth(done) \
+                .addCallbacks(chunk_d.callback, chunk_d.errback)
+
+    def rehash(self, fd, offset, data):
+        # decode data only once, when whole file digest is calculated:
+        return fd is not None and data is not None and (fd.valid or offset == 0)
+
+    def prepare_chunk(self, args, offsets, codec, data, in_digest, upload_codec):
+        """
+        Prepare a chunk in a thread and return Deferred called with
+        (size, digest, offset, data) to upload or None.
+        """
+        if offsets is None:
+            offsets = self.check_offset(args.get('offset', None))
+        (offset, seqoff) = offsets
+        fd = self.file_digest(offset)
+        rehash = self.rehash(fd, offset, data)
+        out_codec = upload_codec and upload_codec + '|base64' or 'base64'
+        d = threads.deferToThread(prepare_file_chunk, data, codec, out_codec,
+                in_digest, self.backend().digest_method, rehash and fd,
+                offset)
+        return d.addCallback(lambda chunk:
+                self.write_chunk(offset, seqoff, chunk, fd, rehash,
+                    prepared=True))
+
+    def write_chunk(self, offset, seqoff, chunk, fd, hashed, prepared=False):
+        """
+        Upload recoded chunk (size, data, digest) written at offset.
+
+        When prepared is set, return (size, digest, offset, data) tuple for
+        prepared_writer or None when chunk is not to be uploaded.
+        """
+        size, data, digest = chunk
         if not self.check_upload(offset+size-seqoff, size):
+            if hashed:
+                fd.skip(offset, size)
+            return None
+        if fd is not None:
+            if not hashed:
+                fd.skip(offset, size)
+            self.stored_data['digest_state'] = fd.state()
+        self._be_sent_offset = offset+size
+        if prepared:
+            return (size, digest, offset, data)
+        self.writer()(size, digest, offset, data).addCallbacks(self.written,
+                self.write_failed, callbackKeywords=dict(new_offset=offset+size))
+
+    def file_close(self):
+        """Verify digest of uploaded data."""
+        if getattr(self, '_be_preparing', 0):
+            self._be_chain.addCallback(lambda result: self.file_close())
+            return
+        fd = self.file_digest(0)
+        if fd is None:
             return
-        self.writer()(size, digest, offset, data).addCallback(self.written, new_offset=offset+size)
+        method, digest = self.expected_digest()
+        answ = None
+        if method == fd.method:
+            answ = fd.check(digest)
+        if answ is None:
+            log.info("Can not verify digest of %s.", self.name())
+        elif not answ:
+            message = "%s: digest of uploaded data does not match %s:%s" % (
+                    self.name(), method, digest)
+            log.error(message)
+            self.parent_task().send_result('warn', 'upload/digest', 0, message)
 
     def written(self, response, new_offset=None):
         self.stored_data['offset'] = new_offset
 
+    def write_failed(self, fail):
+        # continue from the last confirmed offset:
+        self._be_sent_offset = None
+        return fail
+
 
 def BeakerFakeFile(fid, parent):
     return BeakerFile(fid, parent, dict(name="FakeFile-%s" % fid))
@@ -1463,55 +1722,427 @@ class BeakerRecipe(BeakerTask):
 
 class JournallingQueue(object):
 
-    def __init__(self, offset_writer=None, read_offset=None, journal_file=None):
-        self.queue = []
-        self.len_queue = []
+    """
+    Queue of events backed by a journal file.
+
+    Events are written to the journal by encoder - one of JOURNAL_FORMATS.
+    Events are kept in a deque, so pop is O(1). Offset of the first
+    unprocessed event in the journal is saved by offset_writer after every
+    checkpoint_every pops, when the queue gets empty and on checkpoint().
+
+    With commit_delay (in seconds) set, journal appends are committed in
+    groups: the journal is flushed once commit_delay after the first
+    uncommitted push or as soon as commit_bytes are pending. Events are
+    available for processing only after they were committed and on_commit is
+    called then, so no event is processed before it is in the journal.
+
+    With tracker set (see RepeatingProxy.call_mark and is_done), offset of
+    a popped event is saved only after all remote calls submitted before it
+    was popped were finished.
+    """
+
+    def __init__(self, offset_writer=None, read_offset=None, journal_file=None,
+            checkpoint_every=1, encoder=jsonln, commit_delay=0,
+            commit_bytes=0, call_later=None, fsync=False):
+        self.queue = deque()
+        self.encoder = encoder
         self.journal_file = journal_file
         self.journal_ready = False
         self.read_offset = read_offset
         self.offset_writer = offset_writer
+        self.checkpoint_every = checkpoint_every
+        self.unsaved = 0
+        self.saved_offset = read_offset
+        self.tracker = None
+        self.held = deque()
+        self.commit_delay = commit_delay
+        self.commit_bytes = commit_bytes
+        self.call_later = call_later
+        self.fsync = fsync
+        self.on_commit = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.commit_timer = None
 
     def ready(self):
         return self.journal_ready
 
 
     def _enqueue(self, obj, data_len):
-        self.queue.append(obj)
-        self.len_queue.append(data_len)
+        self.queue.append((obj, data_len))
+
+    def _flush(self):
+        self.journal_file.flush()
+        if self.fsync:
+            os.fsync(self.journal_file.fileno())
 
     def push(self, obj):
-        data = jsonln(obj)
+        data = self.encoder(obj)
         self.journal_file.write(data)
-        self.journal_file.flush()
-        if self.ready():
-            self._enqueue(obj, len(data))
+        if not self.commit_delay or not self.ready():
+            self._flush()
+            if self.ready():
+                self._enqueue(obj, len(data))
+            return
+        self.pending.append((obj, len(data)))
+        self.pending_bytes += len(data)
+        if self.commit_bytes and self.pending_bytes >= self.commit_bytes:
+            self.commit()
+        elif self.commit_timer is None:
+            self.commit_timer = self.call_later(self.commit_delay,
+                    self._commit_timeout)
+
+    def _commit_timeout(self):
+        self.commit_timer = None
+        self.commit()
+
+    def commit(self):
+        """Flush pending journal appends and make the events available."""
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+        if not self.pending:
+            return
+        self._flush()
+        self.queue.extend(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        if self.on_commit is not None:
+            self.on_commit()
 
     def pop(self):
-        self.read_offset += self.len_queue.pop(0)
-        self.offset_writer(self.read_offset)
-        return self.queue.pop(0)
+        obj, data_len = self.queue.popleft()
+        self.read_offset += data_len
+        self.unsaved += 1
+        if self.tracker is not None:
+            self.held.append((self.read_offset, self.tracker.call_mark()))
+        if self.unsaved >= self.checkpoint_every or not self.queue:
+            self.checkpoint()
+        return obj
+
+    def checkpoint(self):
+        """Save offset of the first unprocessed event."""
+        if not self.unsaved:
+            return
+        offset = self.read_offset
+        if self.tracker is not None:
+            offset = self.saved_offset
+            held = self.held
+            while held and self.tracker.is_done(held[0][1]):
+                offset = held.popleft()[0]
+            if offset == self.saved_offset:
+                return
+        self.unsaved = len(self.held)
+        self.saved_offset = offset
+        self.offset_writer(offset)
 
     def top(self):
-        return self.queue[0]
+        return self.queue[0][0]
 
     def empty(self):
         return not self.queue
 
+    def __len__(self):
+        """Number of events waiting for processing, including uncommitted."""
+        return len(self.queue) + len(self.pending)
+
+
+BINARY_RECORD_MARK = 'B'
+BINARY_RECORD_HEADER = '!III'
+BINARY_RECORD_HEADER_LEN = struct.calcsize(BINARY_RECORD_HEADER)
+
+
+def binary_record(obj):
+    """
+    Encode (evt, flags) pair as a binary journal record.
+
+    Record layout:
+        BINARY_RECORD_MARK
+        struct '!III': header length, data length, crc32 of header and data
+        header: JSON encoded [evt, flags, has_data]
+        data: raw file data
+
+    Data of file_write events encoded by base64 are stored decoded in data
+    part of the record and the base64 is removed from the event's codec.
+    Events with missing or malformed data are stored as plain JSON records.
+    """
+    evt, flags = obj
+    data = ''
+    has_data = False
+    if evt.event() == 'file_write':
+        codec = evt.arg('codec', None)
+        if codec:
+            codecs = codec.split('|')
+            if codecs[-1] == 'base64':
+                data = evt.arg('data', None)
+                if not isinstance(data, basestring):
+                    return jsonln(obj)
+                try:
+                    data = base64.decodestring(data)
+                except (TypeError, binascii.Error):
+                    return jsonln(obj)
+                has_data = True
+                evt = event.Event(evt)
+                evt.args()['data'] = None
+                evt.args()['codec'] = '|'.join(codecs[:-1])
+    header = jsonenv.dumps([evt, flags, has_data])
+    payload = header + data
+    return BINARY_RECORD_MARK + struct.pack(BINARY_RECORD_HEADER,
+            len(header), len(data), zlib.crc32(payload) & 0xffffffffL) \
+                    + payload
+
+
+JOURNAL_FORMATS = {
+        'json': jsonln,
+        'binary': binary_record,
+        }
+
+
+def read_journal_record(journal_in):
+    """
+    Read a record in any of JOURNAL_FORMATS from journal_in.
+
+    Return pair (data, obj) where data is the record as read and obj is the
+    decoded (evt, flags) pair or None if the record is not valid. data is
+    empty at the end of journal.
+    """
+    mark = journal_in.read(1)
+    if not mark:
+        return ('', None)
+    if mark != BINARY_RECORD_MARK:
+        data = mark + journal_in.readline()
+        try:
+            evt, flags = jsonenv.loads(data)
+        except:
+            return (data, None)
+        return (data, (evt, flags))
+    data = mark + journal_in.read(BINARY_RECORD_HEADER_LEN)
+    if len(data) < 1 + BINARY_RECORD_HEADER_LEN:
+        return (data, None)
+    header_len, data_len, crc = struct.unpack(BINARY_RECORD_HEADER, data[1:])
+    payload = journal_in.read(header_len + data_len)
+    data += payload
+    if len(payload) < header_len + data_len \
+            or zlib.crc32(payload) & 0xffffffffL != crc:
+        return (data, None)
+    try:
+        evt, flags, has_data = jsonenv.loads(payload[:header_len])
+    except:
+        return (data, None)
+    if has_data:
+        evt[event.Event.ARGS]['data'] = payload[header_len:]
+    return (data, (evt, flags))
+
+
+class SegmentedJournal(object):
+
+    """
+    Append-only journal split into segments of fixed size.
+
+    Segments are files named <fname>.<number>. Each segment starts with a
+    header line containing offset of its first record. Offsets are counted
+    over records only, headers are not included, so an offset is valid
+    across segments.
+
+    The journal is file-like for writing (write, flush, close). Use
+    reader(offset) to read records starting at given offset and
+    release(offset) to delete segments containing only records before the
+    offset.
+    """
+
+    HEADER = 'BEAH-JOURNAL-SEGMENT %020d\n'
+    HEADER_LEN = len(HEADER % 0)
+    HEADER_RE = re.compile('^BEAH-JOURNAL-SEGMENT ([0-9]{20})\n$')
+
+    def __init__(self, fname, segment_size=16*1024*1024, start=0):
+        self.fname = fname
+        self.segment_size = segment_size
+        pre_open(fname)
+        # list of [number, start offset, pathname]:
+        self.segments = self._scan()
+        self.file = None
+        if self.segments:
+            number, seg_start, path = self.segments[-1]
+            self.size = os.path.getsize(path) - self.HEADER_LEN
+            self.end = seg_start + self.size
+            self.file = open(path, 'ab')
+        else:
+            self._new_segment(0, start)
+
+    def _scan(self):
+        dirname, basename = os.path.split(self.fname)
+        prefix = basename + '.'
+        segments = []
+        for name in os.listdir(dirname or '.'):
+            if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+                continue
+            path = os.path.join(dirname, name)
+            f = open(path, 'rb')
+            try:
+                match = self.HEADER_RE.match(f.readline())
+            finally:
+                f.close()
+            if not match:
+                log.error("Journal segment %r has invalid header. Ignored.", path)
+                continue
+            segments.append([int(name[len(prefix):]), int(match.group(1)), path])
+        segments.sort()
+        return segments
+
+    def _new_segment(self, number, start):
+        path = '%s.%08d' % (self.fname, number)
+        self.file = open(path, 'wb')
+        self.file.write(self.HEADER % start)
+        self.file.flush()
+        self.segments.append([number, start, path])
+        self.size = 0
+        self.end = start
+
+    IMPORTING = '.importing'
+
+    def import_journal(self, fname, offset):
+        """
+        Append unread part of a plain journal file fname and remove it.
+
+        Used to convert journals written before segmentation. The journal
+        has to be created with start=offset for offsets to stay valid.
+
+        fname is renamed to fname+IMPORTING first and removed when done. If
+        the renamed file exists, an import was interrupted: segments written
+        by it are dropped and the import is started again, so no record is
+        imported twice.
+        """
+        importing = fname + self.IMPORTING
+        if os.path.exists(fname):
+            os.rename(fname, importing)
+        if not os.path.exists(importing):
+            return
+        self.truncate(offset)
+        f = open(importing, 'rb')
+        try:
+            f.seek(offset)
+            while True:
+                data = f.readline()
+                if not data:
+                    break
+                self.write(data)
+        finally:
+            f.close()
+        self.flush()
+        os.fsync(self.file.fileno())
+        os.remove(importing)
+
+    def truncate(self, start):
+        """Remove all segments and start a new one at offset start."""
+        self.close()
+        for number, seg_start, path in self.segments:
+            os.remove(path)
+        self.segments = []
+        self._new_segment(0, start)
+
+    def write(self, data):
+        if self.size >= self.segment_size:
+            self.file.close()
+            self._new_segment(self.segments[-1][0]+1, self.end)
+        self.file.write(data)
+        self.size += len(data)
+        self.end += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def release(self, offset):
+        """Remove segments containing only records before offset."""
+        while len(self.segments) > 1 and self.segments[1][1] <= offset:
+            number, start, path = self.segments.pop(0)
+            log.debug("Removing processed journal segment %r.", path)
+            try:
+                os.remove(path)
+            except OSError:
+                log.exception("Can not remove journal segment %r.", path)
+
+    def reader(self, offset):
+        return SegmentedJournalReader(self, offset)
+
+
+class SegmentedJournalReader(object):
+
+    """
+    File-like object reading records from SegmentedJournal.
+
+    offset is the actual starting offset, which is the start of the oldest
+    segment, when records at requested offset were already released.
+    """
+
+    def __init__(self, journal, offset):
+        self.journal = journal
+        segments = journal.segments
+        ix = 0
+        while ix+1 < len(segments) and segments[ix+1][1] <= offset:
+            ix += 1
+        number, start, path = segments[ix]
+        if offset < start:
+            log.warning("Journal offset %s not found. Reading from %s.",
+                    offset, start)
+            offset = start
+        self.offset = offset
+        self.number = number
+        self.file = open(path, 'rb')
+        self.file.seek(journal.HEADER_LEN + offset - start)
+
+    def _next_segment(self):
+        for number, start, path in self.journal.segments:
+            if number > self.number:
+                self.file.close()
+                self.number = number
+                self.file = open(path, 'rb')
+                self.file.seek(self.journal.HEADER_LEN)
+                return True
+        return False
+
+    def readline(self):
+        while True:
+            line = self.file.readline()
+            if line or not self._next_segment():
+                return line
+
+    def read(self, size):
+        # records do not span segments
+        while True:
+            data = self.file.read(size)
+            if data or not self._next_segment():
+                return data
+
+    def close(self):
+        self.file.close()
+
 
 def journal_reader(queue, journal_in, backend):
     if queue.ready():
         return
     evt_len = 0 # counter to skip any events which can not be enqueued
     while True:
-        ln = journal_in.readline()
-        evt_len += len(ln)
-        if ln == '':
+        data, obj = read_journal_record(journal_in)
+        evt_len += len(data)
+        if data == '':
             if evt_len > 0:
                 queue._enqueue((event.nop(), {}), evt_len)
             break
+        if obj is None:
+            log.error("Can not parse a record from journal. record=%r", data[:256])
+            continue
         try:
-            evt, flags = json.loads(ln)
-            evt = event.Event(evt)
+            evt, flags = obj
+            # the journal is written by this backend, no need to check again:
+            evt = event.adopt(evt, check=False)
             if not backend.async_proc(evt, flags):
                 tid = evt.task_id()
                 log.error("No task '%s' for the event '%r'.", tid, evt)
@@ -1519,7 +2150,7 @@ def journal_reader(queue, journal_in, backend):
             queue._enqueue((evt, flags), evt_len)
             evt_len = 0
         except:
-                log.error("Can not parse a line from journal. line=%r", ln)
+                log.error("Can not parse a record from journal. record=%r", data[:256])
     journal_in.close()
     queue.journal_ready = True
 
@@ -1531,17 +2162,24 @@ class BeakerLCBackend(SerializingBackend):
             'proc_evt_lose_item', 'proc_evt_log', 'proc_evt_echo',
             'proc_evt_start', 'proc_evt_end', 'proc_evt_result',
             'proc_evt_relation', 'proc_evt_file', 'proc_evt_file_meta',
-            'proc_evt_file_write', 'proc_evt_abort',
+            'proc_evt_file_write', 'proc_evt_file_close', 'proc_evt_abort',
             ]
     _VERBOSE += ['set_idle', '_next_evt', '_pop_evt', 'idle',
             ]
 
     WATCHDOG_TOLERANCE = 5 # Account for trip from scheduler to handler
 
+    # Reading events from controller is paused while more than
+    # queue_high_water events are queued and resumed when the queue is half
+    # empty. Use 0 to never pause.
+    queue_high_water = 0
+
     def __init__(self, conf=None, proxy=None, runtime=None, queue=None,
             build_queue=None):
         self.conf = conf
         self.digest_method = "no-digest" # self.conf.get('DEFAULT', 'DIGEST')
+        # codec used to compress uploads. Set when supported by LC:
+        self.upload_codec = None
         self.name = self.conf.get('DEFAULT', 'NAME')
         self.runtime = runtime
         self.__commands = {}
@@ -1550,6 +2188,11 @@ class BeakerLCBackend(SerializingBackend):
         self.__cmd_queue = []
         self.proxy = proxy
         self.build_queue = build_queue
+        self.queue = queue
+        self.reading_paused = False
+        if queue is not None:
+            queue.on_commit = self._next_evt
+            queue.tracker = proxy
         SerializingBackend.__init__(self, queue)
 
     def start(self, recipe):
@@ -1572,12 +2215,60 @@ class BeakerLCBackend(SerializingBackend):
         self.on_error(message)
 
     def idle(self):
-        return self.proxy.is_idle()
+        return self.proxy.is_ready()
+
+    def encode_upload(self, data, codec):
+        """
+        Return pair (method suffix, arguments) to upload data encoded by codec.
+
+        Data are uploaded base64 encoded or, when upload_codec is set,
+        compressed by upload_codec and sent by <method>_encoded call taking
+        codec as an additional argument. Data are recoded in a thread.
+        """
+        if not self.upload_codec:
+            if codec != 'base64':
+                data = threads.deferToThread(recompress, codec, 'base64', data)
+            return ('', [data])
+        return (ENCODED_UPLOAD_SUFFIX, [self.upload_codec,
+            threads.deferToThread(recompress, codec,
+                self.upload_codec + '|base64', data)])
+
+    def proxy_idle(self):
+        """Called when all remote calls are finished."""
+        self.set_idle()
+        if self.queue is not None:
+            self.queue.checkpoint()
+
+    def check_flow(self):
+        """Pause or resume reading events according to the queue length."""
+        if not self.queue_high_water or self.queue is None:
+            return
+        queued = len(self.queue)
+        if not self.reading_paused and queued > self.queue_high_water:
+            log.info("%d events queued. Pausing controller.", queued)
+            self.reading_paused = True
+            self.pause_controller()
+        elif self.reading_paused and queued <= self.queue_high_water / 2:
+            log.info("%d events queued. Resuming controller.", queued)
+            self.reading_paused = False
+            self.resume_controller()
+
+    def pause_controller(self):
+        pause = getattr(self.controller, 'pauseProducing', None)
+        if pause is not None:
+            pause()
+
+    def resume_controller(self):
+        resume = getattr(self.controller, 'resumeProducing', None)
+        if resume is not None:
+            resume()
 
     def set_controller(self, controller=None):
         SerializingBackend.set_controller(self, controller)
         if controller:
             log.debug('%r using controller %r', self, controller)
+            if self.reading_paused:
+                self.pause_controller()
             while self.__cmd_queue:
                 self._send_cmd(self.__cmd_queue.pop())
         else:
@@ -1585,12 +2276,17 @@ class BeakerLCBackend(SerializingBackend):
                 log.debug('%r controller disconnected', self)
 
     def close(self):
-        pass
+        self.flush()
 
     def flush(self):
         """Flush any memory-cached data to disk."""
         log.debug("flush")
-        self.runtime.sync()
+        if self.queue is not None:
+            self.queue.commit()
+            self.queue.checkpoint()
+        self.runtime.barrier()
+        if hasattr(self.runtime, 'cache_stats'):
+            log.debug("runtime cache: %r", self.runtime.cache_stats())
 
     ############################################################################
     # RECIPE HANDLING
@@ -1733,13 +2429,36 @@ class BeakerLCBackend(SerializingBackend):
         elif evev == 'flush':
             self.flush()
             return
-        if self._queue_ready():
-            # store the task:
-            if not self.async_proc(evt, flags):
-                return
-            SerializingBackend.proc_evt(self, evt, **flags)
-        else:
-            self._queue_evt(evt, flags)
+        # write all runtime changes caused by the event in a single commit:
+        self.runtime.begin()
+        try:
+            if self._queue_ready():
+                # store the task:
+                if not self.async_proc(evt, flags):
+                    return
+                SerializingBackend.proc_evt(self, evt, **flags)
+            else:
+                self._queue_evt(evt, flags)
+        finally:
+            self.runtime.end()
+        self.check_flow()
+
+    def proc_evts(self, evts, **flags):
+        # write all runtime changes caused by the batch in a single commit:
+        self.runtime.begin()
+        try:
+            for evt in evts:
+                self.proc_evt(evt, **flags)
+        finally:
+            self.runtime.end()
+
+    def _next_evt(self):
+        self.runtime.begin()
+        try:
+            SerializingBackend._next_evt(self)
+        finally:
+            self.runtime.end()
+        self.check_flow()
 
     def proc_evt_abort(self, evt):
         type = evt.arg('type', '')
@@ -1795,6 +2514,9 @@ class BeakerLCBackend(SerializingBackend):
     def proc_evt_file_write(self, evt):
         evt.task.file(evt.arg('file_id')).write(evt.args())
 
+    def proc_evt_file_close(self, evt):
+        evt.task.file(evt.arg('file_id')).file_close()
+
     # AUXILIARY:
 
     LOG_TYPE = {
@@ -1832,24 +2554,22 @@ class BeakerLCBackend(SerializingBackend):
 
 
 def make_runtime(conf, verbose=False):
-    runtime = runtimes.ShelveRuntime(conf.get('DEFAULT', 'RUNTIME_FILE_NAME'))
-    # override runtime sync to prevent performance hit:
-    runtime_sync_orig = runtime.sync
-    def runtime_sync(type=None):
-        """
-        Synchronize the runtime to disk.
-
-        Original sync method will be called only when called explicitly
-        i.e. with type == None.
-
-        """
-        if type is None:
-            runtime_sync_orig()
-            if verbose:
-                log.debug("runtime.dump: %s" % (runtime.dump(sorted=True),))
+    runtime = runtimes.open_runtime(conf.get('DEFAULT', 'RUNTIME_FILE_NAME'),
+            conf.get('DEFAULT', 'RUNTIME_TYPE'),
+            cache_size=conf.get('DEFAULT', 'RUNTIME_CACHE_SIZE'))
+    # group commits to prevent performance hit of syncing every write:
+    runtime.set_sync_policy(conf.get('DEFAULT', 'RUNTIME_SYNC'),
+            writes=conf.get('DEFAULT', 'RUNTIME_SYNC_WRITES'),
+            interval=conf.get('DEFAULT', 'RUNTIME_SYNC_INTERVAL'),
+            call_later=reactor.callLater)
     if verbose:
+        runtime_sync_orig = runtime.sync_primitive
+        def runtime_sync():
+            """Synchronize the runtime to disk and dump it."""
+            runtime_sync_orig()
+            log.debug("runtime.dump: %s" % (runtime.dump(sorted=True),))
         log.debug("runtime.dump: %s" % (runtime.dump(sorted=True),))
-    runtime.sync = runtime_sync
+        runtime.sync_primitive = runtime_sync
     return runtime
 
 
@@ -1923,8 +2643,65 @@ def make_proxy(conf, verbose):
     except:
         proxy.set_timeout(None)
     proxy.serializing = True
+    proxy.max_parallel = max(1, int(conf.get('DEFAULT', 'RPC_PARALLEL')))
     return proxy
 
+ENCODED_UPLOAD_SUFFIX = '_encoded'
+
+
+def recompress(in_codec, out_codec, data):
+    return event.encode(out_codec, event.decode(in_codec, data))
+
+
+def prepare_upload(data, upload_codec, digest_constructor):
+    """
+    Compute digest and encode raw data for upload. Runs in a thread.
+
+    Return (digest, data arguments) pair.
+    """
+    digest = digest_constructor(data).hexdigest()
+    if upload_codec:
+        return (digest, (upload_codec,
+            event.encode(upload_codec + '|base64', data)))
+    return (digest, (event.encode('base64', data),))
+
+
+def prepare_file_chunk(data, in_codec, out_codec, in_digest, digest_method,
+        file_digest, offset):
+    """
+    Recode chunk of a file and update file_digest. Runs in a thread.
+
+    Return (size, out_data, digest) tuple.
+    """
+    if data is None:
+        raise RuntimeError("No data found.")
+    if file_digest:
+        data = event.decode(in_codec, data)
+        in_codec = ''
+        file_digest.update(offset, data)
+    return BeakerFile.recode(data, in_codec, out_codec, in_digest,
+            digest_method)
+
+
+def probe_upload_codec(proxy, codec):
+    """
+    Check lab controller supports compressed uploads using codec.
+
+    Returns Deferred called with codec if supported or None otherwise.
+    """
+    def check(codecs):
+        if isinstance(codecs, (list, tuple)) and codec in codecs:
+            log.info("Using %s compressed uploads.", codec)
+            return codec
+        log.info("Lab controller does not support %s compressed uploads.", codec)
+        return None
+    def failed(fail):
+        log.info("Lab controller does not support compressed uploads: %s",
+                fail.getErrorMessage())
+        return None
+    return proxy.callRemote('upload_codecs').addCallbacks(check, failed)
+
+
 def make_verbose():
     print_this = log_this(lambda s: log.debug(s), log_on=True)
     make_class_verbose(BeakerLCBackend, print_this)
@@ -1939,12 +2716,25 @@ def make_verbose():
 def make_queue(conf, runtime):
     offset = runtime.type_get('', 'journal_offs', 0)
     journal_fname = os.path.join(conf.get('DEFAULT', 'VAR_ROOT'), 'journals' , 'beakerlc.journal')
+    journal = SegmentedJournal(journal_fname,
+            segment_size=int(conf.get('DEFAULT', 'JOURNAL_SEGMENT_SIZE')),
+            start=offset)
+    # journal written by older version:
+    journal.import_journal(journal_fname, offset)
+    journal_in = journal.reader(offset)
+    def offset_writer(offset):
+        runtime.type_set('', 'journal_offs', offset)
+        journal.release(offset)
     queue = JournallingQueue(
-            offset_writer=lambda offset: runtime.type_set('', 'journal_offs', offset),
-            read_offset=offset,
-            journal_file=open_(journal_fname, 'ab+'))
-    journal_in = open_(journal_fname, 'rb')
-    journal_in.seek(offset, 1)
+            offset_writer=offset_writer,
+            read_offset=journal_in.offset,
+            journal_file=journal,
+            checkpoint_every=int(conf.get('DEFAULT', 'JOURNAL_CHECKPOINT')),
+            encoder=JOURNAL_FORMATS[conf.get('DEFAULT', 'JOURNAL_FORMAT')],
+            commit_delay=float(conf.get('DEFAULT', 'JOURNAL_COMMIT_DELAY'))/1000,
+            commit_bytes=int(conf.get('DEFAULT', 'JOURNAL_COMMIT_BYTES')),
+            call_later=reactor.callLater,
+            fsync=parse_bool(conf.get('DEFAULT', 'JOURNAL_FSYNC')))
     return dict(queue=queue, build_queue=lambda backend: journal_reader(queue, journal_in, backend))
 
 
@@ -1959,10 +2749,21 @@ def start_beaker_backend(conf):
 
     proxy = make_proxy(conf, verbose)
 
+    # Uploaded data are encoded and hashed in threads:
+    reactor.suggestThreadPoolSize(max(1, int(conf.get('DEFAULT', 'CODEC_THREADS'))))
+
     backend = BeakerLCBackend(conf=conf, proxy=proxy, runtime=runtime,
             **make_queue(conf, runtime))
 
-    proxy.on_idle = backend.set_idle
+    proxy.on_idle = backend.proxy_idle
+    proxy.on_ready = backend.set_idle
+    backend.queue_high_water = int(conf.get('DEFAULT', 'QUEUE_HIGH_WATER'))
+
+    upload_codec = conf.get('DEFAULT', 'UPLOAD_CODEC')
+    if upload_codec:
+        def set_codec(codec):
+            backend.upload_codec = codec
+        probe_upload_codec(proxy, upload_codec).addCallback(set_codec)
 
     simple_schedule(conf, runtime, proxy, backend)
 
@@ -2042,6 +2843,21 @@ def defaults():
             'RECIPEID':'-1',
             'DIGEST':'no-digest',
             'RPC_TIMEOUT':'60',
+            'RPC_PARALLEL':'4',
+            'UPLOAD_CHUNK_SIZE':'4096',
+            'UPLOAD_CHUNK_MAX':str(1024*1024),
+            'UPLOAD_FLUSH_DELAY':'5',
+            'UPLOAD_CODEC':'',
+            'CODEC_THREADS':'2',
+            'RUNTIME_SYNC':'group',
+            'RUNTIME_CACHE_SIZE':'0',
+            'JOURNAL_CHECKPOINT':'16',
+            'JOURNAL_SEGMENT_SIZE':str(16*1024*1024),
+            'JOURNAL_FORMAT':'json',
+            'JOURNAL_COMMIT_DELAY':'0',
+            'JOURNAL_COMMIT_BYTES':'65536',
+            'JOURNAL_FSYNC':'False',
+            'QUEUE_HIGH_WATER':'10000',
             'RECIPE_UPLOAD_LIMIT':'0',
             'RECIPE_UPLOAD_LIMIT_SOFT':'0',
             'RECIPE_SIZE_LIMIT':'0',
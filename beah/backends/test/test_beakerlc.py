@@ -1,10 +1,20 @@
 # -*- test-case-name: beah.backends.test.test_beakerlc -*-
 
+import os
+import md5
+import time
+
 from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
 
 from beah.backends import beakerlc
 from beah import config
-from beah.test import twisted_debug
+from beah.core import event
+from beah.misc import runtimes, digests
+from beah.test import twisted_debug, benchmark, BENCHMARK_SCALE, \
+        BENCHMARK_SKIP
+from beah.wires.internals import twadaptors
 
 
 class TestConfigure(unittest.TestCase):
@@ -37,5 +47,840 @@ class TestConfigure(unittest.TestCase):
         self.test_defaults()
 
 
+class FakeBackend(object):
+
+    def async_proc(self, evt, flags):
+        return True
+
+
+class FakeTracker(object):
+
+    """Each pop submits one call. Calls up to done are finished."""
+
+    def __init__(self):
+        self.calls = 0
+        self.done = 0
+
+    def call_mark(self):
+        self.calls += 1
+        return self.calls
+
+    def is_done(self, mark):
+        return mark <= self.done
+
+
+class TestJournallingQueue(unittest.TestCase):
+
+    def _queue(self, fname, offset=0, checkpoint_every=1):
+        self.offsets = []
+        return beakerlc.JournallingQueue(offset_writer=self.offsets.append,
+                read_offset=offset, journal_file=open(fname, 'ab+'),
+                checkpoint_every=checkpoint_every)
+
+    def _fill(self, fname, count):
+        queue = self._queue(fname)
+        for i in xrange(count):
+            queue.push((event.output('line %d\n' % i,
+                origin={'id': 'task1'}), {}))
+        queue.journal_file.close()
+
+    def _read(self, fname, offset=0, checkpoint_every=1):
+        queue = self._queue(fname, offset, checkpoint_every)
+        journal_in = open(fname, 'rb')
+        journal_in.seek(offset)
+        beakerlc.journal_reader(queue, journal_in, FakeBackend())
+        return queue
+
+    def testCheckpoint(self):
+        fname = 'journal.tmp'
+        self._fill(fname, 10)
+        queue = self._read(fname, checkpoint_every=4)
+        for i in range(3):
+            self.failUnlessEqual(queue.pop()[0].arg('data'), 'line %d\n' % i)
+        self.failUnlessEqual(self.offsets, [])
+        queue.pop()
+        self.failUnlessEqual(len(self.offsets), 1)
+        queue.pop()
+        queue.checkpoint()
+        self.failUnlessEqual(len(self.offsets), 2)
+        queue.checkpoint()
+        self.failUnlessEqual(len(self.offsets), 2)
+        # restart from the checkpoint:
+        queue = self._read(fname, offset=self.offsets[-1])
+        evts = []
+        while not queue.empty():
+            evts.append(queue.pop()[0].arg('data'))
+        self.failUnlessEqual(evts, ['line %d\n' % i for i in range(5, 10)])
+        self.failUnlessEqual(self.offsets[-1], os.path.getsize(fname))
+
+    def testTracker(self):
+        fname = 'journal-tracker.tmp'
+        self._fill(fname, 4)
+        queue = self._read(fname)
+        tracker = FakeTracker()
+        queue.tracker = tracker
+        queue.pop()
+        self.failUnlessEqual(self.offsets, [])
+        tracker.done = 1
+        queue.pop()
+        self.failUnlessEqual(len(self.offsets), 1)
+        tracker.done = 3
+        queue.pop()
+        queue.pop()
+        self.failUnlessEqual(len(self.offsets), 2)
+        self.failUnlessEqual(self.offsets[-1], os.path.getsize(fname) * 3 / 4)
+        tracker.done = 4
+        queue.checkpoint()
+        self.failUnlessEqual(self.offsets[-1], os.path.getsize(fname))
+
+    def testBinaryJournal(self):
+        fname = 'journal-binary.tmp'
+        queue = self._queue(fname)
+        queue.encoder = beakerlc.binary_record
+        queue.push((event.file_write('f1', event.encode('base64', 'data'),
+            codec='base64', origin={'id': 'task1'}), {}))
+        queue.push((event.output('line\n', origin={'id': 'task1'}), {}))
+        queue.journal_file.close()
+        queue = self._read(fname)
+        evt = queue.pop()[0]
+        self.failUnlessEqual(event.decode(evt.arg('codec'), evt.arg('data')), 'data')
+        self.failUnlessEqual(queue.pop()[0].arg('data'), 'line\n')
+        self.failUnlessEqual(self.offsets[-1], os.path.getsize(fname))
+
+    def testBenchmarkDrain(self):
+        """
+        Replay a journal through journal_reader and drain the queue.
+
+        Use BEAH_BENCHMARK_SCALE=100 for 500k events.
+        """
+        count = 5000 * BENCHMARK_SCALE
+        fname = 'journal-bench.tmp'
+        self._fill(fname, count)
+        queue = self._read(fname, checkpoint_every=16)
+        def drain():
+            while not queue.empty():
+                queue.top()
+                queue.pop()
+        benchmark('journal drain', count, drain)
+        self.failUnlessEqual(self.offsets[-1], os.path.getsize(fname))
+        benchmark('journal read', count, self._read, fname)
+    testBenchmarkDrain.skip = BENCHMARK_SKIP
+
+
+class TestRecode(unittest.TestCase):
+
+    def testBase64Len(self):
+        for size in range(0, 200) + [4096, 65537]:
+            data = 'x' * size
+            self.failUnlessEqual(beakerlc.base64_decoded_len(
+                event.encode('base64', data)), size)
+            self.failUnlessEqual(beakerlc.base64_decoded_len(
+                unicode(event.encode('base64', data).replace('\n', '\r\n'))),
+                size)
+        self.failUnlessEqual(beakerlc.base64_decoded_len('abc'), None)
+
+    def testPassThrough(self):
+        data = event.encode('base64', 'some data\n' * 100)
+        size, out, digest = beakerlc.BeakerFile.recode(data, 'base64',
+                'base64', None, 'no-digest')
+        self.failUnless(out is data)
+        self.failUnlessEqual(size, 1000)
+        self.failUnlessEqual(digest, '')
+
+    def testRecode(self):
+        data = 'some data\n' * 100
+        size, out, digest = beakerlc.BeakerFile.recode(
+                event.encode('gz|base64', data), 'gz|base64', 'base64', None,
+                'no-digest')
+        self.failUnlessEqual(size, 1000)
+        self.failUnlessEqual(event.decode('base64', out), data)
+        self.assertRaises(RuntimeError, beakerlc.BeakerFile.recode, None,
+                'base64', 'base64', None, 'no-digest')
+
+
+class FakeFileParent(object):
+
+    """Task owning BeakerFile."""
+
+    UPLOAD_METHOD = 'task_upload_file'
+    beaker_id = '1'
+    digest_method = 'no-digest'
+    upload_codec = None
+    encode_upload = beakerlc.BeakerLCBackend.__dict__['encode_upload']
+
+    def __init__(self):
+        self.runtime = runtimes.DictRuntime({})
+        self.proxy = self
+        self.conf = self
+        self.uploads = []
+        self.methods = []
+        self.results = []
+
+    def get(self, section, option, default=None):
+        return default
+
+    def backend(self):
+        return self
+
+    def parent_task(self):
+        return self
+
+    def check_upload(self, delta, size):
+        return True
+
+    def send_result(self, result, handle, score=0, message=''):
+        self.results.append((result, handle))
+
+    def streamRemote(self, stream, method, *args):
+        self.methods.append(method)
+        self.uploads.append(args)
+        return defer.succeed(True)
+
+    def preparedRemote(self, stream, method, args):
+        def call(args):
+            if args is None:
+                return None
+            return self.streamRemote(stream, method, *args)
+        return args.addCallback(call)
+
+
+class FakeWriterBackend(object):
+
+    upload_codec = None
+
+    def __init__(self, proxy, var_root):
+        self.proxy = proxy
+        self.runtime = runtimes.DictRuntime({})
+        self.conf = self
+        self.options = {'VAR_ROOT': var_root, 'UPLOAD_CHUNK_SIZE': '1',
+                'UPLOAD_CHUNK_MAX': '1', 'UPLOAD_FLUSH_DELAY': '0'}
+
+    def get(self, section, option, default=None):
+        return self.options.get(option, default)
+
+
+class FakeWriterParent(object):
+
+    """Task owning BeakerWriter."""
+
+    UPLOAD_METHOD = 'task_upload_file'
+    beaker_id = '1'
+    id = 'task1'
+    streamRemote = FakeFileParent.__dict__['streamRemote']
+    preparedRemote = FakeFileParent.__dict__['preparedRemote']
+
+    def __init__(self, var_root):
+        self.uploads = []
+        self.methods = []
+        self._backend = FakeWriterBackend(self, var_root)
+
+    def backend(self):
+        return self._backend
+
+    def runtime(self):
+        return self._backend.runtime
+
+    def proxy(self):
+        return self
+
+    def digest_method(self):
+        return 'md5'
+
+    def is_ready(self):
+        return True
+
+
+def wait_prepared(f):
+    """Return Deferred fired when all chunks written to f were prepared."""
+    if getattr(f, '_be_preparing', 0):
+        d = defer.Deferred()
+        f._be_chain.addCallback(d.callback)
+        return d
+    return defer.succeed(None)
+
+
+class TestFileDigest(unittest.TestCase):
+
+    def _write(self, data, digest, chunks, restart=None):
+        parent = FakeFileParent()
+        f = beakerlc.BeakerFile('f1', parent, dict(name='f1',
+            digest=('md5', None), codec='base64'))
+        def write(f, chunks):
+            for offset, chunk in chunks:
+                f.write(dict(offset=offset, data=event.encode('base64', chunk)))
+            return f
+        def close(f):
+            f.meta(dict(digest=('md5', digest)))
+            f.file_close()
+            return wait_prepared(f).addCallback(check)
+        def check(_):
+            self.failUnlessEqual(''.join([event.decode('base64', args[-1])
+                for args in parent.uploads]), data)
+            return parent.results
+        if restart is None:
+            return close(write(f, chunks))
+        write(f, chunks[:restart])
+        return wait_prepared(f) \
+                .addCallback(lambda _: write(beakerlc.BeakerFile('f1', parent),
+                    chunks[restart:])) \
+                .addCallback(close)
+
+    def testOK(self):
+        return self._write('abcdef', md5.new('abcdef').hexdigest(),
+                [(0, 'abc'), (3, 'def')]) \
+                .addCallback(self.failUnlessEqual, [])
+
+    def testMismatch(self):
+        return self._write('abcdef', md5.new('abcdeF').hexdigest(),
+                [(0, 'abc'), (3, 'def')]) \
+                .addCallback(self.failUnlessEqual, [('warn', 'upload/digest')])
+
+    def testRestart(self):
+        return self._write('abcdef', md5.new('abcdeF').hexdigest(),
+                [(0, 'abc'), (3, 'def')], restart=1) \
+                .addCallback(self.failUnlessEqual, [])
+
+    def testOrder(self):
+        """Chunks prepared in threads are uploaded in order."""
+        parent = FakeFileParent()
+        f = beakerlc.BeakerFile('f1', parent, dict(name='f1', codec='base64'))
+        f.write(dict(offset=0, data=event.encode('base64', 'abc')))
+        f.write(dict(offset=3, data=event.encode('gz|base64', 'def'),
+            codec='gz|base64'))
+        f.write(dict(offset=6, data=event.encode('base64', 'ghi')))
+        # the last chunk must wait for the second one:
+        self.failUnlessEqual(len(parent.uploads), 1)
+        def check(_):
+            self.failUnlessEqual([(args[5], event.decode('base64', args[-1]))
+                for args in parent.uploads],
+                [('0', 'abc'), ('3', 'def'), ('6', 'ghi')])
+            self.failUnlessEqual(f.stored_data['offset'], 9)
+        return wait_prepared(f).addCallback(check)
+
+
+class TestBeakerWriter(unittest.TestCase):
+
+    def _upload(self, upload_codec):
+        parent = FakeWriterParent(self.mktemp())
+        parent.backend().upload_codec = upload_codec
+        writer = beakerlc.BeakerWriter('console.log', parent)
+        self.addCleanup(writer.close)
+        d1 = writer.send('abc')
+        writer.set_offset(3)
+        d2 = writer.send('def')
+        def check(_):
+            return [(method, args[:6], event.decode(
+                (upload_codec or '') + '|base64', args[-1]))
+                for method, args in zip(parent.methods, parent.uploads)]
+        return defer.gatherResults([d1, d2]).addCallback(check)
+
+    def testSend(self):
+        digest = digests.DigestConstructor('md5')
+        return self._upload(None).addCallback(self.failUnlessEqual, [
+            ('task_upload_file', ('1', '/', 'console.log', 3,
+                digest('abc').hexdigest(), 0), 'abc'),
+            ('task_upload_file', ('1', '/', 'console.log', 3,
+                digest('def').hexdigest(), 3), 'def')])
+
+    def testEncoded(self):
+        d = self._upload('gz')
+        def check(uploads):
+            self.failUnlessEqual([method for method, args, data in uploads],
+                    ['task_upload_file_encoded'] * 2)
+            self.failUnlessEqual([data for method, args, data in uploads],
+                    ['abc', 'def'])
+        return d.addCallback(check)
+
+
+class TestReactorStall(unittest.TestCase):
+
+    """
+    Longest reactor stall while a large compressed chunk is uploaded.
+
+    Use BEAH_BENCHMARK_SCALE to change size of the chunk (4MB per unit).
+    """
+
+    skip = BENCHMARK_SKIP
+
+    def _stall(self, label, write):
+        data = ''.join(['line %d\n' % i
+            for i in xrange(400000 * BENCHMARK_SCALE)])
+        chunk = event.encode('gz|base64', data)
+        ticks = []
+        def tick():
+            ticks.append(time.time())
+        loop = task.LoopingCall(tick)
+        loop.start(0.001)
+        def done(_):
+            loop.stop()
+            stall = max([b - a for a, b in zip(ticks, ticks[1:])])
+            print "%s: %d bytes, longest reactor stall %.3fs" % (label,
+                    len(data), stall)
+            return stall
+        d = task.deferLater(reactor, 0.01, write, chunk)
+        return d.addCallback(lambda _: task.deferLater(reactor, 0.01,
+            lambda: None)).addCallback(done)
+
+    def testInline(self):
+        def write(chunk):
+            beakerlc.BeakerFile.recode(chunk, 'gz|base64', 'base64', None,
+                    'no-digest')
+        return self._stall('upload recoded inline', write)
+
+    def testThread(self):
+        parent = FakeFileParent()
+        def write(chunk):
+            f = beakerlc.BeakerFile('f1', parent, dict(name='f1',
+                digest=('md5', None), codec='gz|base64'))
+            f.write(dict(offset=0, data=chunk))
+            return wait_prepared(f)
+        return self._stall('upload recoded in thread', write)
+
+    def testWriter(self):
+        parent = FakeWriterParent(self.mktemp())
+        writer = beakerlc.BeakerWriter('console.log', parent)
+        self.addCleanup(writer.close)
+        def write(chunk):
+            return writer.send(event.decode('gz|base64', chunk))
+        return self._stall('writer upload prepared in thread', write)
+
+
+class FakeCodecsProxy(object):
+
+    def __init__(self, answ):
+        self.answ = answ
+
+    def callRemote(self, method, *args):
+        if method != 'upload_codecs' or isinstance(self.answ, Exception):
+            return defer.fail(self.answ)
+        return defer.succeed(self.answ)
+
+
+class TestUploadCodec(unittest.TestCase):
+
+    def testProbe(self):
+        answ = []
+        for lc_answ in [['gz', 'bz2'], ['bz2'], "--- ERROR", RuntimeError()]:
+            beakerlc.probe_upload_codec(FakeCodecsProxy(lc_answ), 'gz') \
+                    .addCallback(answ.append)
+        self.failUnlessEqual(answ, ['gz', None, None, None])
+
+    def testCompressedUpload(self):
+        parent = FakeFileParent()
+        parent.upload_codec = 'gz'
+        data = 'compressible data\n' * 1000
+        f = beakerlc.BeakerFile('f1', parent, dict(name='f1', codec='base64'))
+        f.write(dict(offset=0, data=event.encode('base64', data)))
+        self.failUnlessEqual(parent.methods, ['task_upload_file_encoded'])
+        args = parent.uploads[0]
+        self.failUnlessEqual(args[3], len(data))
+        self.failUnlessEqual(args[-2], 'gz')
+        def check(cdata):
+            self.failUnless(len(cdata) < len(data) / 10)
+            self.failUnlessEqual(event.decode('gz|base64', cdata), data)
+        return args[-1].addCallback(check)
+
+
+class FakeTimer(object):
+
+    def __init__(self, timers, call):
+        self.timers = timers
+        self.call = call
+        timers.append(self)
+
+    def cancel(self):
+        self.timers.remove(self)
+
+    def fire(self):
+        self.timers.remove(self)
+        self.call()
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = self.mktemp()
+        self.timers = []
+        self.commits = 0
+
+    def call_later(self, delay, call):
+        return FakeTimer(self.timers, call)
+
+    def on_commit(self):
+        self.commits += 1
+
+    def _queue(self, commit_bytes=0):
+        queue = beakerlc.JournallingQueue(offset_writer=lambda offs: None,
+                read_offset=0, journal_file=open(self.fname, 'ab+'),
+                commit_delay=0.01, commit_bytes=commit_bytes,
+                call_later=self.call_later)
+        queue.journal_ready = True
+        queue.on_commit = self.on_commit
+        return queue
+
+    def _push(self, queue, count):
+        for i in xrange(count):
+            queue.push((event.output('line %d\n' % i,
+                origin={'id': 'task1'}), {}))
+
+    def testTimer(self):
+        queue = self._queue()
+        self._push(queue, 3)
+        self.failUnless(queue.empty())
+        self.failUnlessEqual(len(self.timers), 1)
+        self.timers[0].fire()
+        self.failUnlessEqual(self.commits, 1)
+        self.failUnlessEqual(os.path.getsize(self.fname),
+                sum([data_len for obj, data_len in queue.queue]))
+        self.failUnlessEqual(queue.pop()[0].arg('data'), 'line 0\n')
+        # commit cancels the timer:
+        self._push(queue, 1)
+        queue.commit()
+        self.failUnlessEqual(self.timers, [])
+        self.failUnlessEqual(self.commits, 2)
+        queue.commit()
+        self.failUnlessEqual(self.commits, 2)
+
+    def testBytes(self):
+        queue = self._queue(commit_bytes=1024)
+        self._push(queue, 100)
+        self.failIf(queue.empty())
+        self.failUnless(self.commits > 1)
+        self.failUnless(queue.pending_bytes < 1024)
+        committed = len(queue.queue)
+        queue.commit()
+        self.failUnlessEqual(len(queue.queue), 100)
+        self.failUnless(committed < 100)
+
+
+class FakeConf(object):
+
+    def get(self, section, option):
+        return 'beah_beaker_backend'
+
+
+class FakeProxy(object):
+
+    def is_idle(self):
+        return True
+
+    def is_ready(self):
+        return True
+
+    def call_mark(self):
+        return 0
+
+    def is_done(self, mark):
+        return True
+
+
+class FakeWriter(object):
+
+    def write(self, data):
+        pass
+
+
+class FakeTask(object):
+
+    def __init__(self):
+        self.lines = 0
+        self.fake_writer = FakeWriter()
+
+    def has_completed(self):
+        return False
+
+    def writer(self, name):
+        return self.fake_writer
+
+    def output(self, args):
+        self.lines += 1
+
+
+class FakeRecipe(object):
+
+    def __init__(self):
+        self.tasks = {'task1': FakeTask()}
+
+
+class FakeSlowProxy(FakeProxy):
+
+    """Proxy busy with remote calls until ready is set."""
+
+    ready = False
+
+    def is_ready(self):
+        return self.ready
+
+
+def make_backend(dirname, proxy, **kwargs):
+    journal = beakerlc.SegmentedJournal(
+            os.path.join(dirname, 'beakerlc.journal'),
+            segment_size=16*1024*1024)
+    queue = beakerlc.JournallingQueue(offset_writer=lambda offs: None,
+            read_offset=0, journal_file=journal, checkpoint_every=16,
+            **kwargs)
+    queue.journal_ready = True
+    backend = beakerlc.BeakerLCBackend(conf=FakeConf(), proxy=proxy,
+            runtime=runtimes.DictRuntime({}), queue=queue)
+    backend.recipe = FakeRecipe()
+    return backend
+
+
+class TestFlowControl(unittest.TestCase):
+
+    def _output(self, backend, count):
+        for i in range(count):
+            backend.proc_evt(event.output('line %d\n' % i,
+                origin={'id': 'task1'}))
+
+    def testSlowProxy(self):
+        proxy = FakeSlowProxy()
+        backend = make_backend(self.mktemp(), proxy)
+        backend.queue_high_water = 10
+        adaptor = twadaptors.ControllerAdaptor_Backend_JSON()
+        adaptor.add_backend(backend)
+        transport = proto_helpers.StringTransport()
+        adaptor.makeConnection(transport)
+        self._output(backend, 10)
+        self.failUnlessEqual(transport.producerState, 'producing')
+        self._output(backend, 1)
+        self.failUnlessEqual(transport.producerState, 'paused')
+        self.failUnlessEqual(len(backend.queue), 11)
+        # proxy catches up:
+        proxy.ready = True
+        backend.proxy_idle()
+        self.failUnlessEqual(transport.producerState, 'producing')
+        self.failUnless(backend.queue.empty())
+        self.failUnlessEqual(backend.recipe.tasks['task1'].lines, 11)
+
+    def testReconnect(self):
+        backend = make_backend(self.mktemp(), FakeSlowProxy())
+        backend.queue_high_water = 10
+        self._output(backend, 11)
+        self.failUnless(backend.reading_paused)
+        # controller connected later is paused as well:
+        adaptor = twadaptors.ControllerAdaptor_Backend_JSON()
+        adaptor.add_backend(backend)
+        transport = proto_helpers.StringTransport()
+        adaptor.makeConnection(transport)
+        self.failUnlessEqual(transport.producerState, 'paused')
+
+
+class TestProcEvtBenchmark(unittest.TestCase):
+
+    """
+    Throughput of BeakerLCBackend.proc_evt with a storm of output events.
+
+    Use BEAH_BENCHMARK_SCALE=100 for 1M events.
+    """
+
+    skip = BENCHMARK_SKIP
+
+    def _storm(self, label, **kwargs):
+        count = 10000 * BENCHMARK_SCALE
+        backend = make_backend(self.mktemp(), FakeProxy(), **kwargs)
+        def storm():
+            for i in xrange(count):
+                backend.proc_evt(event.output('line %d\n' % i,
+                    origin={'id': 'task1'}))
+            backend.flush()
+        benchmark(label, count, storm)
+        self.failUnlessEqual(backend.recipe.tasks['task1'].lines, count)
+        self.failUnless(backend.queue.empty())
+
+    def testImmediate(self):
+        self._storm('proc_evt output (immediate)')
+
+    def testGroupCommit(self):
+        timers = []
+        self._storm('proc_evt output (group commit)', commit_delay=0.01,
+                commit_bytes=65536,
+                call_later=lambda delay, call: FakeTimer(timers, call))
+
+
+class TestJournalFormats(unittest.TestCase):
+
+    def _events(self):
+        data = 'binary \0\xff data\n' * 10
+        return [
+                (event.output('line\n', origin={'id': 'task1'}), {}),
+                (event.file_write('f1', event.encode('base64', data),
+                    codec='base64', offset=0, origin={'id': 'task1'}), {}),
+                (event.file_write('f1', unicode(event.encode('gz|base64', data)),
+                    codec='gz|base64', origin={'id': 'task1'}), {'flag': 1}),
+                (event.file_write('f1', 'plain text', codec=None), {}),
+                ]
+
+    def setUp(self):
+        self.fname = self.mktemp()
+
+    def _read_all(self, fname):
+        f = open(fname, 'rb')
+        answ = []
+        while True:
+            data, obj = beakerlc.read_journal_record(f)
+            if not data:
+                break
+            answ.append(obj)
+        f.close()
+        return answ
+
+    def testRoundTrip(self):
+        evts = self._events()
+        f = open(self.fname, 'wb')
+        # mixed journal:
+        for i, obj in enumerate(evts + evts):
+            f.write(beakerlc.JOURNAL_FORMATS[('json', 'binary')[i % 2]](obj))
+        f.close()
+        records = self._read_all(self.fname)
+        self.failUnlessEqual(len(records), 2*len(evts))
+        for (evt, flags), (evt2, flags2) in zip(evts + evts, records):
+            evt2 = event.Event(evt2)
+            self.failUnlessEqual(flags, flags2)
+            self.failUnlessEqual(evt.id(), evt2.id())
+            self.failUnlessEqual(evt.arg('offset'), evt2.arg('offset'))
+            if evt.event() == 'file_write':
+                self.failUnlessEqual(event.decode(evt.arg('codec'), evt.arg('data')),
+                        event.decode(evt2.arg('codec'), evt2.arg('data')))
+            else:
+                self.failUnlessEqual(evt.args(), evt2.args())
+
+    def testMissingData(self):
+        evts = [(event.file_write('f1', None, codec='base64'), {}),
+                (event.file_write('f1', 'not base64!', codec='base64'), {}),
+                ]
+        f = open(self.fname, 'wb')
+        for obj in evts:
+            f.write(beakerlc.binary_record(obj))
+        f.write(beakerlc.binary_record(
+            (event.file_write('f1', '', codec='gz|base64'), {})))
+        f.close()
+        records = self._read_all(self.fname)
+        self.failUnlessEqual(len(records), len(evts) + 1)
+        for (evt, flags), (evt2, flags2) in zip(evts, records):
+            self.failUnlessEqual(flags, flags2)
+            self.failUnlessEqual(evt.args(), event.Event(evt2).args())
+        evt = event.Event(records[-1][0])
+        self.failUnlessEqual((evt.arg('codec'), evt.arg('data')), ('gz', ''))
+
+    def testBinarySize(self):
+        data = 'binary \0\xff data\n' * 1000
+        obj = (event.file_write('f1', event.encode('base64', data),
+            codec='base64', origin={'id': 'task1'}), {})
+        self.failUnless(len(beakerlc.binary_record(obj)) <
+                len(beakerlc.jsonln(obj)) * 4 / 5)
+
+    def testCorrupted(self):
+        evts = self._events()
+        records = [beakerlc.binary_record(obj) for obj in evts]
+        records[1] = records[1][:20] + 'X' + records[1][21:]
+        records[3] = records[3][:-5]
+        f = open(self.fname, 'wb')
+        f.write(''.join(records))
+        f.close()
+        read = self._read_all(self.fname)
+        self.failUnlessEqual([obj is not None for obj in read],
+                [True, False, True, False])
+
+
+class TestSegmentedJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = self.mktemp()
+        self.fname = os.path.join(self.dirname, 'beakerlc.journal')
+
+    def _records(self, first, count):
+        return ['record %02d\n' % i for i in range(first, first+count)]
+
+    def _read(self, journal, offset):
+        reader = journal.reader(offset)
+        lines = []
+        while True:
+            ln = reader.readline()
+            if not ln:
+                break
+            lines.append(ln)
+        reader.close()
+        return lines
+
+    def testSegments(self):
+        journal = beakerlc.SegmentedJournal(self.fname, segment_size=30)
+        for record in self._records(0, 10):
+            journal.write(record)
+        journal.flush()
+        # 10 bytes per record, rotated after 3 records:
+        self.failUnlessEqual([seg[1] for seg in journal.segments], [0, 30, 60, 90])
+        self.failUnlessEqual(self._read(journal, 0), self._records(0, 10))
+        self.failUnlessEqual(self._read(journal, 40), self._records(4, 6))
+        journal.release(65)
+        self.failUnlessEqual([seg[1] for seg in journal.segments], [60, 90])
+        self.failIf(os.path.exists(self.fname + '.00000000'))
+        self.failUnlessEqual(self._read(journal, 70), self._records(7, 3))
+        reader = journal.reader(10)
+        self.failUnlessEqual(reader.offset, 60)
+        reader.close()
+        journal.close()
+        # reopen and continue:
+        journal = beakerlc.SegmentedJournal(self.fname, segment_size=30)
+        self.failUnlessEqual(journal.end, 100)
+        journal.write('record 10\n')
+        journal.flush()
+        self.failUnlessEqual(self._read(journal, 60), self._records(6, 5))
+        journal.release(110)
+        self.failUnlessEqual(len(journal.segments), 1)
+        journal.close()
+
+    def testImport(self):
+        os.makedirs(self.dirname)
+        f = open(self.fname, 'wb')
+        for record in self._records(0, 5):
+            f.write(record)
+        f.close()
+        journal = beakerlc.SegmentedJournal(self.fname, segment_size=30, start=20)
+        journal.import_journal(self.fname, 20)
+        self.failIf(os.path.exists(self.fname))
+        self.failUnlessEqual(self._read(journal, 20), self._records(2, 3))
+        self.failUnlessEqual(self._read(journal, 30), self._records(3, 2))
+        journal.close()
+
+    def testInterruptedImport(self):
+        os.makedirs(os.path.join(self.dirname, 'journals'))
+        fname = os.path.join(self.dirname, 'journals', 'beakerlc.journal')
+        evts = [(event.linfo('line %d' % i), {}) for i in range(5)]
+        f = open(fname, 'wb')
+        for obj in evts:
+            f.write(beakerlc.jsonln(obj))
+        f.close()
+        options = beakerlc.defaults()
+        options['VAR_ROOT'] = self.dirname
+        class Conf(object):
+            def get(self, section, option):
+                return options[option]
+        runtime = runtimes.DictRuntime({})
+        offset = len(beakerlc.jsonln(evts[0]))
+        runtime.type_set('', 'journal_offs', offset)
+        # crash after the records were written to segments:
+        remove = os.remove
+        def crash(path):
+            raise OSError("crashed")
+        self.patch(os, 'remove', crash)
+        self.failUnlessRaises(OSError, beakerlc.make_queue, Conf(), runtime)
+        self.patch(os, 'remove', remove)
+        self.failIf(os.path.exists(fname))
+        beakerlc.make_queue(Conf(), runtime)
+        self.failIf(os.path.exists(fname + beakerlc.SegmentedJournal.IMPORTING))
+        journal = beakerlc.SegmentedJournal(fname)
+        reader = journal.reader(offset)
+        read = []
+        while True:
+            data, obj = beakerlc.read_journal_record(reader)
+            if not data:
+                break
+            read.append(obj[0][5]['message'])
+        reader.close()
+        journal.close()
+        self.failUnlessEqual(read, ['line %d' % i for i in range(1, 5)])
+
+
 #twisted_debug().set()
 
@@ -397,6 +397,10 @@ def defaults():
             CONSOLE_LOG='False',
             NAME='beah-default-%2.2d' % random.randint(0,99),
             RUNTIME_FILE_NAME='%(VAR_ROOT)s/%(NAME)s.runtime',
+            RUNTIME_TYPE='shelve',
+            RUNTIME_SYNC='immediate',
+            RUNTIME_SYNC_WRITES='100',
+            RUNTIME_SYNC_INTERVAL='1000',
             IPV6_DISABLED='False', 
             )
 
@@ -407,10 +411,13 @@ def beah_defaults():
     d.update({
             'CONTROLLER.NAME':'beah',
             'CONTROLLER.LOG_FILE_NAME':'%(LOG_PATH)s/%(NAME)s.log',
+            'CONTROLLER.BINARY_FRAMES':'False',
             # backend listens on all interfaces by default, for multi-host
             'BACKEND.INTERFACE': '',
             'BACKEND.PORT':'12432',
             'BACKEND.PORT_OPT':'False',
+            # pause tasks when more bytes are waiting to be sent to a backend
+            'BACKEND.HIGH_WATER_MARK':'1048576',
             'TASK.INTERFACE': 'localhost',
             'TASK.PORT':'12434'})
     if os.name == 'posix':
@@ -18,16 +18,40 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import os
 import uuid
+import threading
 import exceptions
 
+# State of new_id: (pid, prefix, last value of the last 48 bits)
+_id_state = (None, None, None)
+_id_lock = threading.Lock()
+
 def new_id():
     """
     Function generating unique id's.
 
+    Ids are UUIDs. Only the first id in a process is a random uuid4, following
+    ids increment its last 48 bits, which is much cheaper than reading
+    os.urandom for each id. A new random base is taken after fork.
+
     Return: a string representation of id.
     """
-    return str(uuid.uuid4())
+    global _id_state
+    _id_lock.acquire()
+    try:
+        pid, prefix, n = _id_state
+        if pid != os.getpid():
+            pid = os.getpid()
+            base = str(uuid.uuid4())
+            prefix = base[:24]
+            n = long(base[24:], 16)
+        else:
+            n = (n + 1) & 0xffffffffffffL
+        _id_state = (pid, prefix, n)
+    finally:
+        _id_lock.release()
+    return '%s%012x' % (prefix, n)
 
 def esc_name(name):
     """
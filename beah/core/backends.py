@@ -19,12 +19,13 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 from beah.core.errors import KilledException
-from beah.misc.jsonenv import json
+from beah.misc import jsonenv, DispatchTable
 
 class GoodBye(KilledException): pass
 
 class BasicBackend(object):
     """Simple Backend, with no command input."""
+    evt_handlers = None
     def __init__(self):
         self.controller = None
     def set_controller(self, controller=None):
@@ -32,7 +33,10 @@ class BasicBackend(object):
     def proc_error(self, evt):
         return False
     def proc_evt(self, evt, **flags):
-        f = getattr(self, "proc_evt_"+evt.event(), None)
+        handlers = self.evt_handlers
+        if handlers is None:
+            handlers = self.evt_handlers = DispatchTable(self, 'proc_evt_')
+        f = handlers.get(evt.event(), None)
         if f:
             try:
                 answ = f(evt)
@@ -42,6 +46,9 @@ class BasicBackend(object):
             except:
                 return self.proc_error(evt)
         return False
+    def proc_evts(self, evts, **flags):
+        for evt in evts:
+            self.proc_evt(evt, **flags)
     def proc_evt_bye(self, evt):
         raise GoodBye("Controller said: \"bye\".")
     def close(self):
@@ -157,7 +164,7 @@ class PprintBackend(ExtBackend):
 
 class PrintBackend(ExtBackend):
     def pre_proc(self, evt):
-        print json.dumps(evt)
+        print jsonenv.dumps(evt)
         return False
 
 from sys import stderr
@@ -21,7 +21,8 @@ import exceptions
 import logging
 from beah.core import event, command
 from beah.core.constants import ECHO
-from beah.misc import Raiser, localhost, format_exc, dict_update, log_flush
+from beah.misc import Raiser, localhost, format_exc, dict_update, log_flush, \
+        DispatchTable
 from beah import config
 
 from beah.system import Executable
@@ -137,7 +138,8 @@ class Controller(object):
 
     __ON_KILLED = staticmethod(Raiser(ServerKilled, "Aaargh, I was killed!"))
     _VERBOSE = ('add_backend', 'remove_backend', 'add_task', 'remove_task',
-            'find_task', 'proc_evt', 'send_evt', 'task_started',
+            'find_task', 'backend_paused', 'backend_resumed', 'proc_evt',
+            'proc_evts', 'send_evt', 'send_evts', 'task_started',
             'task_finished', 'handle_exception', 'proc_cmd', 'generate_evt',
             'proc_cmd_forward', 'proc_cmd_variable_value', 'proc_cmd_ping',
             'proc_cmd_PING', 'proc_cmd_config', 'proc_cmd_run',
@@ -146,20 +148,24 @@ class Controller(object):
 
     def __init__(self, spawn_task, runtime, on_killed=None):
         self.spawn_task = spawn_task
-        self.tasks = [] # list of connected tasks
-        self.backends = []
+        self.tasks = {} # connected tasks: task -> task_id
+        self.task_ids = {} # index of connected tasks: task_id -> [task, ...]
+        self.backends = {} # connected backends: backend -> flags
         self.masters = {} # task objects
-        self.out_backends = []
+        self.out_backends = [] # backends receiving output, in order of connection
+        self.paused_backends = {} # backends not accepting events at the moment
         self.conf = {}
         self.runtime = runtime
         self.killed = False
         self.on_killed = on_killed or self.__ON_KILLED
         self.__waiting_tasks = {}
         self.rebooting = False
+        self.evt_handlers = DispatchTable(self, 'proc_evt_')
+        self.cmd_handlers = DispatchTable(self, 'proc_cmd_')
 
     def add_backend(self, backend):
         if backend and not (backend in self.backends):
-            self.backends.append(backend)
+            self.backends[backend] = {'output': True}
             self.out_backends.append(backend)
             for k, v in self.__waiting_tasks.items():
                 backend.proc_evt(v[0])
@@ -167,9 +173,10 @@ class Controller(object):
 
     def remove_backend(self, backend):
         if backend and backend in self.backends:
-            self.backends.remove(backend)
-            if backend in self.out_backends:
+            flags = self.backends.pop(backend)
+            if flags['output']:
                 self.out_backends.remove(backend)
+            self.backend_resumed(backend)
             if self.killed and not self.backends:
                 # All backends were removed and controller was killed - call
                 # on_killed handler
@@ -190,18 +197,75 @@ class Controller(object):
                     task.task_id = origin_id
             else:
                 task.task_id = task.origin['id'] = task_id
-            self.tasks.append(task)
+            self.index_task(task)
+            if self.paused_backends:
+                self.pause_task(task)
             return True
 
+    def index_task(self, task):
+        """
+        Register connected task under its current task_id.
+
+        Several connections may share a task_id, e.g. task's stdout and a
+        socket the task introduced itself on. These are kept in order of
+        registration and find_task returns the first one.
+        """
+        self.unindex_task(task, self.tasks.get(task, None))
+        self.tasks[task] = task.task_id
+        if task.task_id is not None:
+            self.task_ids.setdefault(task.task_id, []).append(task)
+
+    def unindex_task(self, task, task_id):
+        tasks = self.task_ids.get(task_id, None)
+        if tasks and task in tasks:
+            tasks.remove(task)
+            if not tasks:
+                del self.task_ids[task_id]
+
     def remove_task(self, task):
         if task and task in self.tasks:
-            self.tasks.remove(task)
+            self.unindex_task(task, self.tasks.pop(task))
+            if self.paused_backends:
+                # let the task finish
+                self.resume_task(task)
             return True
 
+    def backend_paused(self, backend):
+        """
+        Backend can not accept more events for now.
+
+        Tasks are paused until all backends accept events again, so memory
+        used by buffered events stays bounded and task output is throttled.
+        """
+        if backend in self.paused_backends:
+            return
+        if not self.paused_backends:
+            log.info("Controller: backend %r is busy. Pausing tasks.", backend)
+            for task in self.tasks.keys():
+                self.pause_task(task)
+        self.paused_backends[backend] = True
+
+    def backend_resumed(self, backend):
+        """Backend can accept events again."""
+        if self.paused_backends.pop(backend, None) and not self.paused_backends:
+            log.info("Controller: backends are ready. Resuming tasks.")
+            for task in self.tasks.keys():
+                self.resume_task(task)
+
+    def pause_task(self, task):
+        pause = getattr(task, 'pauseProducing', None)
+        if pause is not None:
+            pause()
+
+    def resume_task(self, task):
+        resume = getattr(task, 'resumeProducing', None)
+        if resume is not None:
+            resume()
+
     def find_task(self, task_id):
-        for task in self.tasks:
-            if (task.task_id == task_id):
-                return task
+        tasks = self.task_ids.get(task_id, None)
+        if tasks:
+            return tasks[0]
         return None
 
     def get_master(self, task_id, make_new=False):
@@ -217,6 +281,8 @@ class Controller(object):
             task_id =  evt.task_id()
             if task_id:
                 task.task_id = task.origin['id'] = task_id
+                if task in self.tasks:
+                    self.index_task(task)
                 return True
             else:
                 return False
@@ -285,21 +351,54 @@ class Controller(object):
 
         This is the only method mandatory for Task side Controller-Adaptor.
         """
+        if self.handle_evt(task, evt):
+            self.send_evt(evt, to_all=(evt.event() in ('flush',)))
+
+    def proc_evts(self, task, evts):
+        """
+        Process a batch of Events received from task.
+
+        Events are forwarded to backends in batches. Events handled by
+        controller and events sent to all backends split the batch, so the
+        order of events is kept.
+        """
+        batch = []
+        handlers = self.evt_handlers
+        for evt in evts:
+            evev = evt.event()
+            if batch and (evev in ('flush',) or evev in handlers):
+                self.send_evts(batch)
+                batch = []
+            if not self.handle_evt(task, evt):
+                continue
+            if evev in ('flush',):
+                self.send_evt(evt, to_all=True)
+            else:
+                batch.append(evt)
+        if batch:
+            self.send_evts(batch)
+
+    def handle_evt(self, task, evt):
+        """
+        Handle Event received from task.
+
+        Return True if the event is to be forwarded to backends.
+        """
         log.debug("Controller: proc_evt(..., %r)", evt)
         self.log_event(task, evt)
         evev = evt.event()
-        handler = getattr(self, "proc_evt_"+evev, None)
+        handler = self.evt_handlers.get(evev, None)
         if handler:
             try:
                 if handler(task, evt):
-                    return
+                    return False
             except:
                 self.handle_exception("Handling %s raised an exception." %
                         evt.event())
         orig = evt.origin()
         if not orig.has_key('id'):
             orig['id'] = task.task_id
-        self.send_evt(evt, to_all=(evev in ('flush',)))
+        return True
 
     def proc_evt_introduce(self, task, evt):
         """Process introduce event."""
@@ -386,6 +485,19 @@ class Controller(object):
             except:
                 self.handle_exception("Writing to backend %r failed." % backend)
 
+    def send_evts(self, evts):
+        """Send a batch of events to output backends."""
+        for backend in self.out_backends:
+            try:
+                proc_evts = getattr(backend, 'proc_evts', None)
+                if proc_evts is not None:
+                    proc_evts(evts)
+                else:
+                    for evt in evts:
+                        backend.proc_evt(evt)
+            except:
+                self.handle_exception("Writing to backend %r failed." % backend)
+
     def task_started(self, task):
         log.info("Task %s has started.", task.task_id)
         self.add_task(task)
@@ -424,7 +536,7 @@ class Controller(object):
         This is the only method mandatory for Backend side
         Controller-Adaptor."""
         log.debug("Controller: proc_cmd(..., %r)", cmd)
-        handler = getattr(self, "proc_cmd_"+cmd.command(), None)
+        handler = self.cmd_handlers.get(cmd.command(), None)
         if not handler:
             evt = event.echo(cmd, ECHO.NOT_IMPLEMENTED, origin=self.__origin)
         else:
@@ -601,6 +713,8 @@ class Controller(object):
         pass
 
     def proc_cmd_no_output(self, backend, cmd, echo_evt):
-        if backend in self.out_backends:
+        flags = self.backends.get(backend, None)
+        if flags is not None and flags['output']:
+            flags['output'] = False
             self.out_backends.remove(backend)
 
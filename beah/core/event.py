@@ -27,6 +27,7 @@ Classes:
 
 Function:
     event(list) - make Event from list if necessary.
+    adopt(list) - make Event from list received from a peer, without copying.
 
 Module contains many helper functions (e.g. idle, pong, start, end, etc.) to
 instantiate Event of particular type.
@@ -517,6 +518,21 @@ def event(evt):
     return EventFactory.make(evt)
 
 
+def adopt(evt, check=True):
+    """
+    Make Event from list evt, e.g. received from a peer.
+
+    Unlike Event(evt), origin and args of evt are not copied: evt must not be
+    used by the caller anymore. Use check=False for data which were already
+    validated, e.g. read back from a journal written by this process.
+    """
+    if isinstance(evt, Event):
+        return evt
+    if not isinstance(evt, list):
+        return Event(evt)
+    return Event.adopt(evt, check)
+
+
 import time
 class Event(list):
 
@@ -531,8 +547,13 @@ class Event(list):
         isinstance(args, dict)
 
     The list inheritance is important to be able to serialize to JSON object.
+    Slots are used to save memory and time. Attributes are task, used by
+    backends to cache the task the event belongs to, and serialized, used by
+    beah.wires.frames to cache the event serialized for sending.
     """
 
+    __slots__ = ('task', 'serialized')
+
     EVENT = 1
     ID = 2
     ORIGIN = 3
@@ -575,7 +596,30 @@ class Event(list):
 
         self.check()
 
+    def adopt(cls, evt, check=True):
+        """
+        Make Event from list evt, sharing its origin and args.
+
+        See module level adopt.
+        """
+        self = list.__new__(EventFactory.get_constructor(evt[cls.EVENT]))
+        list.__init__(self, evt)
+        if self[cls.TIMESTAMP] == True:
+            self[cls.TIMESTAMP] = time.time()
+        if self[cls.ID] is None:
+            self[cls.ID] = new_id()
+        if check:
+            self.check()
+        return self
+    adopt = classmethod(adopt)
+
     def check(self):
+        if len(self) == 6 and self[0] == 'Event' \
+                and isinstance(self[1], self.TESTTYPE) \
+                and isinstance(self[2], self.TESTTYPE) \
+                and type(self[3]) is dict and type(self[5]) is dict \
+                and (self[4] is None or type(self[4]) is float):
+            return
         if self[0] != 'Event':
             raise exceptions.TypeError('%r not permitted as %r[0]. Has to be \'Event\'' % (self[0]))
         check_type("event", self.event(), self.TESTTYPE)
@@ -628,6 +672,7 @@ class Event(list):
 # SUBCLASSES:
 ################################################################################
 class file_write_(Event):
+    __slots__ = ()
     _ = 'file_write'
     _f = file_write
     def printable(self):
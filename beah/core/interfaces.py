@@ -40,6 +40,13 @@ class ControllerInterface(object):
         This is the only method mandatory for Task side Controller-Adaptor."""
         raise exceptions.NotImplementedError
 
+    def proc_evts(self, task, evts):
+        """Process a batch of Events received from task.
+
+        Optional. Events are passed to backends as a batch."""
+        for evt in evts:
+            self.proc_evt(task, evt)
+
     def add_backend(self, backend):
         raise exceptions.NotImplementedError
 
@@ -52,6 +59,16 @@ class ControllerInterface(object):
     def remove_task(self, task):
         raise exceptions.NotImplementedError
 
+    def backend_paused(self, backend):
+        """Backend can not accept more events for now. Optional.
+
+        Controller stops reading from tasks until backend_resumed is called."""
+        pass
+
+    def backend_resumed(self, backend):
+        """Backend can accept events again. Optional."""
+        pass
+
 class BackendInterface(object):
     """Class used as a Backend should implement this interface. This includes
     Controller side Backend-Adaptor"""
@@ -60,6 +77,11 @@ class BackendInterface(object):
         """Process event received from task"""
         raise exceptions.NotImplementedError
 
+    def proc_evts(self, evts, **flags):
+        """Process a batch of events received from task. Optional."""
+        for evt in evts:
+            self.proc_evt(evt, **flags)
+
     def set_controller(self, controller=None):
         raise exceptions.NotImplementedError
 
@@ -74,3 +96,11 @@ class TaskInterface(object):
     def set_controller(self, controller=None):
         raise exceptions.NotImplementedError
 
+    def pauseProducing(self):
+        """Stop sending events to Controller for now. Optional."""
+        pass
+
+    def resumeProducing(self):
+        """Resume sending events to Controller. Optional."""
+        pass
+
@@ -2,7 +2,8 @@
 
 from twisted.trial import unittest
 
-from beah.core import backends, command
+from beah.core import backends, command, event
+from beah.misc import make_class_verbose, set_handler
 
 class FakeController(object):
 
@@ -30,3 +31,61 @@ class TestCmdOnlyBackend(unittest.TestCase):
         test(be, 'run a_task', command.run('a_task'))
 
 
+
+class HandlersBackend(backends.BasicBackend):
+
+    _VERBOSE = ('proc_evt_log',)
+
+    def __init__(self):
+        backends.BasicBackend.__init__(self)
+        self.handled = []
+
+    def proc_evt_log(self, evt):
+        self.handled.append(evt.event())
+
+class OverridingBackend(HandlersBackend):
+
+    def proc_evt_log(self, evt):
+        self.handled.append('overridden')
+
+class TestDispatch(unittest.TestCase):
+
+    def testOverride(self):
+        be = OverridingBackend()
+        self.failUnless(be.proc_evt(event.linfo('line')))
+        self.failIf(be.proc_evt(event.output('output')))
+        self.failUnlessEqual(be.handled, ['overridden'])
+
+    def testInstanceHandlers(self):
+        be = HandlersBackend()
+        handled = []
+        be.proc_evt_output = lambda evt: handled.append(evt.event())
+        self.failUnless(be.proc_evt(event.output('output')))
+        self.failUnlessEqual(handled, ['output'])
+        # handlers assigned after the table was built:
+        set_handler(be, 'proc_evt_log', lambda evt: handled.append('patched'))
+        set_handler(be, 'proc_evt_lose_item',
+                lambda evt: handled.append(evt.event()))
+        be.proc_evt(event.linfo('line'))
+        be.proc_evt(event.lose_item('data'))
+        self.failUnlessEqual(handled, ['output', 'patched', 'lose_item'])
+        self.failUnlessEqual(be.handled, [])
+
+    def testVerbose(self):
+        be = HandlersBackend()
+        be.proc_evt(event.linfo('line'))
+        calls = []
+        def print_on_call(meth):
+            def verbose(self, *args):
+                calls.append(meth.__name__)
+                return meth(self, *args)
+            return verbose
+        original = HandlersBackend.__dict__['proc_evt_log']
+        def restore():
+            HandlersBackend.proc_evt_log = original
+            del HandlersBackend._class_is_verbose
+        self.addCleanup(restore)
+        make_class_verbose(HandlersBackend, print_on_call)
+        be.proc_evt(event.linfo('line'))
+        self.failUnlessEqual(be.handled, ['log', 'log'])
+        self.failUnlessEqual(calls, ['proc_evt_log'])
@@ -0,0 +1,271 @@
+# -*- test-case-name: beah.core.test.test_controller -*-
+
+import os
+
+from twisted.trial import unittest
+
+from beah.core import event, command
+from beah.core.controller import Controller, log
+from beah.misc import runtimes
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
+
+
+class FakeTask(object):
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.origin = {'id': task_id}
+        self.commands = []
+
+    def proc_cmd(self, cmd):
+        self.commands.append(cmd)
+
+    def set_controller(self, controller=None):
+        pass
+
+
+class PausableTask(FakeTask):
+
+    def __init__(self, task_id):
+        FakeTask.__init__(self, task_id)
+        self.paused = 0
+
+    def pauseProducing(self):
+        self.paused += 1
+
+    def resumeProducing(self):
+        self.paused -= 1
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def proc_evt(self, evt, **flags):
+        self.calls.append(('proc_evt', evt.event()))
+
+    def proc_evts(self, evts, **flags):
+        self.calls.append(('proc_evts', [evt.event() for evt in evts]))
+
+
+class SimpleBackend(object):
+
+    def __init__(self):
+        self.events = []
+
+    def proc_evt(self, evt, **flags):
+        self.events.append(evt.event())
+
+
+class GetattrController(Controller):
+
+    """Controller looking up event handlers by name for each event."""
+
+    def handle_evt(self, task, evt):
+        log.debug("Controller: proc_evt(..., %r)", evt)
+        self.log_event(task, evt)
+        evev = evt.event()
+        handler = getattr(self, "proc_evt_"+evev, None)
+        if handler:
+            try:
+                if handler(task, evt):
+                    return False
+            except:
+                self.handle_exception("Handling %s raised an exception." %
+                        evt.event())
+        orig = evt.origin()
+        if not orig.has_key('id'):
+            orig['id'] = task.task_id
+        return True
+
+
+def make_controller(spawn_task=None, controller_class=Controller):
+    runtime = runtimes.DictRuntime({})
+    runtime.vars = runtimes.TypeDict(runtime, 'vars')
+    runtime.tasks = runtimes.TypeDict(runtime, 'tasks')
+    return controller_class(spawn_task, runtime)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def testTasks(self):
+        controller = make_controller()
+        task = FakeTask(None)
+        task.origin = {}
+        controller.add_task(task)
+        self.failUnlessEqual(controller.find_task(None), None)
+        controller.proc_evt(task, event.introduce('task1'))
+        self.failUnless(controller.find_task('task1') is task)
+        controller.remove_task(task)
+        self.failUnlessEqual(controller.find_task('task1'), None)
+        self.failIf(controller.tasks)
+
+    def testSharedTaskId(self):
+        controller = make_controller()
+        stdout_task = FakeTask('task1')
+        controller.add_task(stdout_task)
+        socket_task = FakeTask(None)
+        socket_task.origin = {}
+        controller.add_task(socket_task)
+        controller.proc_evt(socket_task, event.introduce('task1'))
+        self.failUnless(controller.find_task('task1') is stdout_task)
+        controller.remove_task(socket_task)
+        self.failUnless(controller.find_task('task1') is stdout_task)
+        # the other way round:
+        controller.add_task(socket_task)
+        controller.remove_task(stdout_task)
+        self.failUnless(controller.find_task('task1') is socket_task)
+        controller.remove_task(socket_task)
+        self.failUnlessEqual(controller.find_task('task1'), None)
+        self.failIf(controller.task_ids)
+
+    def testBackends(self):
+        controller = make_controller()
+        backend = SimpleBackend()
+        self.failUnless(controller.add_backend(backend))
+        self.failIf(controller.add_backend(backend))
+        controller.proc_cmd_no_output(backend, None, None)
+        self.failUnlessEqual(controller.out_backends, [])
+        self.failUnless(controller.remove_backend(backend))
+        self.failIf(controller.backends)
+
+
+class TestFlowControl(unittest.TestCase):
+
+    def testPause(self):
+        controller = make_controller()
+        backends = [SimpleBackend(), SimpleBackend()]
+        for backend in backends:
+            controller.add_backend(backend)
+        task1 = PausableTask('task1')
+        controller.add_task(task1)
+        controller.backend_paused(backends[0])
+        controller.backend_paused(backends[1])
+        controller.backend_paused(backends[1])
+        self.failUnlessEqual(task1.paused, 1)
+        # tasks connected while paused are paused, too:
+        task2 = PausableTask('task2')
+        controller.add_task(task2)
+        self.failUnlessEqual(task2.paused, 1)
+        # tasks without flow control are left alone:
+        controller.add_task(FakeTask('task3'))
+        controller.backend_resumed(backends[0])
+        self.failUnlessEqual((task1.paused, task2.paused), (1, 1))
+        controller.remove_backend(backends[1])
+        self.failUnlessEqual((task1.paused, task2.paused), (0, 0))
+        self.failIf(controller.paused_backends)
+
+    def testRemovedTaskIsResumed(self):
+        controller = make_controller()
+        backend = SimpleBackend()
+        controller.add_backend(backend)
+        task = PausableTask('task1')
+        controller.add_task(task)
+        controller.backend_paused(backend)
+        controller.remove_task(task)
+        self.failUnlessEqual(task.paused, 0)
+        controller.backend_resumed(backend)
+        self.failUnlessEqual(task.paused, 0)
+
+
+class TestScale(unittest.TestCase):
+
+    """
+    Many concurrent short tasks.
+
+    testBenchmark reports controller CPU time per event. Use
+    BEAH_BENCHMARK_SCALE to run more tasks.
+    """
+
+    def _run_tasks(self, count):
+        """Run count tasks and return CPU time per event in seconds."""
+        def spawn_task(controller, backend, task_info, env, args):
+            controller.task_started(FakeTask(task_info['id']))
+        controller = make_controller(spawn_task)
+        backend = SimpleBackend()
+        controller.add_backend(backend)
+        lines = 10
+        start = os.times()
+        ids = []
+        for i in xrange(count):
+            cmd = command.run('/bin/true', name='task%d' % i)
+            controller.proc_cmd(backend, cmd)
+            ids.append(cmd.id())
+        for j in xrange(lines):
+            for task_id in ids:
+                task = controller.find_task(task_id)
+                controller.proc_evt(task, event.linfo('line %d' % j))
+        for task_id in ids:
+            controller.task_finished(controller.find_task(task_id), 0)
+        end = os.times()
+        cpu = (end[0] - start[0]) + (end[1] - start[1])
+        self.failIf(controller.tasks)
+        self.failUnlessEqual(backend.events.count('log'), count * lines)
+        return cpu / len(backend.events)
+
+    def testConcurrentTasks(self):
+        self._run_tasks(50)
+
+    def testBenchmark(self):
+        count = 500 * BENCHMARK_SCALE
+        print "%d tasks: %.1f us CPU per event" % (count,
+                self._run_tasks(count) * 1e6)
+    testBenchmark.skip = BENCHMARK_SKIP
+
+
+class TestBatches(unittest.TestCase):
+
+    def testFanOut(self):
+        controller = make_controller()
+        backend = FakeBackend()
+        simple = SimpleBackend()
+        controller.add_backend(backend)
+        controller.add_backend(simple)
+        task = FakeTask('task1')
+        controller.add_task(task)
+        controller.proc_evts(task, [
+            event.linfo('1'), event.linfo('2'),
+            event.flush(),
+            event.linfo('3'),
+            event.introduce('task1'),
+            event.linfo('4'),
+            ])
+        self.failUnlessEqual(backend.calls, [
+            ('proc_evts', ['log', 'log']),
+            ('proc_evt', 'flush'),
+            ('proc_evts', ['log']),
+            ('proc_evts', ['log']),
+            ])
+        self.failUnlessEqual(simple.events, ['log', 'log', 'flush', 'log',
+            'log'])
+
+
+class TestDispatch(unittest.TestCase):
+
+    def testHandlers(self):
+        controller = make_controller()
+        self.failUnlessEqual(controller.evt_handlers['introduce'],
+                controller.proc_evt_introduce)
+        self.failUnlessEqual(controller.cmd_handlers['no_output'],
+                controller.proc_cmd_no_output)
+        self.failIf('log' in controller.evt_handlers)
+
+    def testBenchmark(self):
+        count = 20000 * BENCHMARK_SCALE
+        evts = [event.linfo('line %d' % i) for i in xrange(count)]
+        rates = []
+        for controller_class in (GetattrController, Controller):
+            controller = make_controller(controller_class=controller_class)
+            backend = SimpleBackend()
+            controller.add_backend(backend)
+            task = FakeTask('task1')
+            controller.add_task(task)
+            def run():
+                for evt in evts:
+                    controller.proc_evt(task, evt)
+            rates.append(benchmark('%s.proc_evt' % controller_class.__name__,
+                count, run))
+            self.failUnlessEqual(len(backend.events), count)
+        print "dispatch table speed-up: %.2fx" % (rates[1] / rates[0])
+    testBenchmark.skip = BENCHMARK_SKIP
@@ -1,8 +1,12 @@
 # -*- test-case-name: beah.core.test.test_core -*-
 
+import os
+import uuid
+
 from twisted.trial import unittest
 
 from beah import core
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
 
 
 class TestEscName(unittest.TestCase):
@@ -89,3 +93,38 @@ class TestCheckType(unittest.TestCase):
                 TypeError,
                 core.check_type, "NAME", None, str, allows_none=False)
 
+
+
+class TestNewId(unittest.TestCase):
+
+    def test_unique(self):
+        ids = [core.new_id() for i in xrange(1000)]
+        self.failUnlessEqual(len(set(ids)), len(ids))
+        for id in ids[:2] + ids[-2:]:
+            self.failUnlessEqual(str(uuid.UUID(id)), id)
+            self.failUnlessEqual(uuid.UUID(id).version, 4)
+
+    def test_wrap_around(self):
+        self.patch(core, '_id_state', (os.getpid(), '0' * 24, 0xffffffffffffL))
+        self.failUnlessEqual(core.new_id(), '0' * 36)
+
+    def test_fork(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            os.write(w, core.new_id())
+            os._exit(0)
+        os.close(w)
+        child_id = os.read(r, 100)
+        os.close(r)
+        os.waitpid(pid, 0)
+        self.failIfEqual(child_id[:24], core.new_id()[:24])
+
+    def test_benchmark(self):
+        count = 100000 * BENCHMARK_SCALE
+        benchmark('uuid4', count, lambda: [str(uuid.uuid4())
+            for i in xrange(count)])
+        benchmark('new_id', count, lambda: [core.new_id()
+            for i in xrange(count)])
+    test_benchmark.skip = BENCHMARK_SKIP
@@ -8,6 +8,7 @@ import bz2
 from twisted.trial import unittest
 
 from beah.core import event
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
 
 class TestCommand(unittest.TestCase):
 
@@ -51,6 +52,38 @@ class TestCommand(unittest.TestCase):
         test_constructors(event.pong(message='Hello World!'))
         test_constructors(event.file_write('FID', 'DATA'))
 
+    def testAdopt(self):
+        obj = ['Event', 'output', '99', {'id': 'task1'}, None, {'data': 'x'}]
+        evt = event.adopt(obj)
+        self.failUnlessEqual(evt, obj)
+        self.failUnless(evt.args() is obj[5])
+        self.failUnlessIsInstance(event.adopt(['Event', 'file_write', '99', {},
+            None, {}]), event.file_write_)
+        self.failUnless(event.adopt(evt) is evt)
+        self.failUnlessRaises(TypeError, event.adopt,
+                ['Event', 'output', 99, {}, None, {}])
+        # trusted data are not checked:
+        event.adopt(['Event', 'output', 99, {}, None, {}], check=False)
+        self.failUnless(event.adopt(['Event', 'output', None, {}, None,
+            {}]).id())
+
+    def testSlots(self):
+        evt = event.linfo('line')
+        self.failIf(hasattr(evt, '__dict__'))
+        self.failUnlessEqual(getattr(evt, 'task', None), None)
+        evt.task = 'task'
+        self.failUnlessEqual(evt.task, 'task')
+        self.failUnlessRaises(AttributeError, setattr, evt, 'other', None)
+
+    def testBenchmark(self):
+        count = 20000 * BENCHMARK_SCALE
+        objs = [list(event.linfo('line %d' % i)) for i in xrange(count)]
+        benchmark('Event(list)', count, lambda: [event.Event(obj)
+            for obj in objs])
+        benchmark('event.adopt(list)', count, lambda: [event.adopt(obj)
+            for obj in objs])
+    testBenchmark.skip = BENCHMARK_SKIP
+
 
 class TestEncoderDecoder(unittest.TestCase):
 
@@ -16,8 +16,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from beah.misc.jsonenv import json
+from beah.misc import jsonenv
 import exceptions
+import os
 
 ################################################################################
 # Generic Input Filters:
@@ -33,31 +34,85 @@ class Receiver(object):
         pass
 
 class CachingReceiver(Receiver):
+    """Receiver keeping received data in a list of chunks."""
     def __init__(self, **kwargs):
         Receiver.__init__(self, **kwargs)
-        self.cache = ''
+        self.chunks = []
         self.raise_pending = kwargs.get('raise_pending', False)
+    def get_cache(self):
+        return ''.join(self.chunks)
+    def set_cache(self, cache):
+        self.chunks = cache and [cache] or []
+    cache = property(get_cache, set_cache)
     def proc_data(self, data):
-        self.cache += data
+        self.chunks.append(data)
         self.proc_cache()
     def proc_cache(self):
         """Reimplement this in sublcass."""
-        self.cache = ''
+        self.chunks = []
     def close(self):
         if self.cache and self.raise_pending:
             raise exceptions.RuntimeError('Pending data in cache')
 
 class LineReceiver(CachingReceiver):
-    def __init__(self, delim=None, **kwargs):
+    """
+    Receiver splitting data into lines.
+
+    Chunks of data are joined and split only when a line is completed, so
+    processing is linear in size of data. Lines longer than max_length are
+    passed to line_length_exceeded.
+    """
+    MAX_LENGTH = 0x100000 # 1 MiB
+    def __init__(self, delim=None, max_length=None, **kwargs):
         CachingReceiver.__init__(self, **kwargs)
         self.delim = delim or '\n'
+        self.max_length = max_length or self.MAX_LENGTH
+        self.pending = 0
+    def proc_data(self, data):
+        probe = data
+        if len(self.delim) > 1 and self.chunks:
+            # delimiter could be split between chunks:
+            probe = self.chunks[-1][1-len(self.delim):] + data
+        self.chunks.append(data)
+        self.pending += len(data)
+        if self.delim in probe:
+            self.proc_cache()
+        elif self.pending > self.max_length:
+            self.proc_long_line()
     def proc_cache(self):
-        while True:
-            line_list = self.cache.split(self.delim, 1)
-            if len(line_list) <= 1:
-                return
-            (head, self.cache) = line_list
-            self.proc_line(head)
+        lines = ''.join(self.chunks).split(self.delim)
+        rest = lines.pop()
+        self.set_cache(rest)
+        self.pending = len(rest)
+        max_length = self.max_length
+        for line in lines:
+            if len(line) > max_length:
+                self.line_length_exceeded(line)
+            else:
+                self.proc_line(line)
+        if self.pending > max_length:
+            self.proc_long_line()
+    def proc_long_line(self):
+        line = self.get_cache()
+        self.chunks = []
+        self.pending = 0
+        self.line_length_exceeded(line)
+    def proc_pending(self):
+        """Process incomplete last line."""
+        if self.chunks:
+            line = self.get_cache()
+            self.chunks = []
+            self.pending = 0
+            if line:
+                self.proc_line(line)
+    def line_length_exceeded(self, line):
+        """
+        Called with a line longer than max_length, or with a part of it.
+
+        Line is split into parts of max_length by default.
+        """
+        for ix in xrange(0, len(line), self.max_length):
+            self.proc_line(line[ix:ix+self.max_length])
     def proc_line(self, line): # pylint: disable=E0202
         """Reimplement this in sublcass."""
         pass
@@ -70,7 +125,7 @@ class LineReceiver(CachingReceiver):
 
 class Deserializer(LineReceiver):
     def __init__(self, deserializer=None, **kwargs):
-        self.deserializer = deserializer or json.loads
+        self.deserializer = deserializer or jsonenv.loads
         LineReceiver.__init__(self, **kwargs)
     def proc_line(self, line): # pylint: disable=E0202
         try:
@@ -93,7 +148,7 @@ class Deserializer(LineReceiver):
 
 class ListDeserializer(LineReceiver):
     def __init__(self, deserializer=None, **kwargs):
-        self.deserializer = deserializer or json.loads
+        self.deserializer = deserializer or jsonenv.loads
         LineReceiver.__init__(self, **kwargs)
     def proc_line(self, line): # pylint: disable=E0202
         try:
@@ -150,14 +205,31 @@ def Pprinter(**kwargs):
 
 def JSONSerializer(**kwargs):
     ka = dict(kwargs)
-    ka['serializer'] = json.dumps
+    ka['serializer'] = jsonenv.dumps
     return ObjectWriter(**ka)
-# FIXME: it is easier to use lambda obj: stdout.write(json.dumps(obj)+"\n")
+# FIXME: it is easier to use lambda obj: stdout.write(jsonenv.dumps(obj)+"\n")
 
 ################################################################################
 # Special Filters:
 ################################################################################
 
+def proc_file(receiver, f, block_size=0x10000):
+    """
+    Feed receiver with data read from file f until end of file.
+
+    Data are read in blocks as they are available.
+    """
+    fd = f.fileno()
+    while True:
+        data = os.read(fd, block_size)
+        if not data:
+            break
+        receiver.proc_data(data)
+    proc_pending = getattr(receiver, 'proc_pending', None)
+    if proc_pending is not None:
+        proc_pending()
+
+
 def nop(*args, **kwargs):
     pass
 
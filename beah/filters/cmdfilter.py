@@ -25,6 +25,7 @@ import shlex
 from sys import stderr
 from optparse import OptionParser
 from beah.core import command, new_id
+from beah.misc import DispatchTable
 
 class CmdFilter(object):
 
@@ -42,6 +43,7 @@ class CmdFilter(object):
 
     def __init__(self):
         self.__handlers = {}
+        self.cmd_handlers = DispatchTable(self, 'proc_cmd_')
 
     def add_handler(self, handler, help='', *cmds):
         for cmd in cmds:
@@ -116,7 +118,7 @@ class CmdFilter(object):
         if not args:
             return None
         cmd = args[0]
-        f = getattr(self, "proc_cmd_"+cmd, None)
+        f = self.cmd_handlers.get(cmd, None)
         if f:
             return f(cmd=cmd, cmd_args=args[1:])
         return self.echoerr("Command %s is not implemented. Input line: %s" % (cmd, data))
@@ -136,7 +136,7 @@ http://search.cpan.org/~petdance/Test-Harness-2.64/lib/Test/Harness/TAP.pod
 
 # FIXME: Is this useful outside of this?
 # FIXME: Use default serializer from configuration
-from beah.filters import JSONSerializer
+from beah.filters import JSONSerializer, LineReceiver, proc_file
 
 def Str2Task(data, filter=None, serializer=None):
     str_list = data.split('\n')
@@ -153,8 +153,13 @@ def Stdin2Task(filter=None, serializer=None):
     from sys import stdin
     serializer = serializer or JSONSerializer().proc_obj
     filter = filter or TestHarnessTAP2EventList()
-    for line in stdin:
-        Str2Task(line, filter, serializer)
+    def proc_line(line):
+        if line:
+            for event in filter(line):
+                event and serializer(event)
+    receiver = LineReceiver()
+    receiver.proc_line = proc_line
+    proc_file(receiver, stdin)
 
 ################################################################################
 # TESTING:
@@ -0,0 +1,77 @@
+# -*- test-case-name: beah.filters.test.test_filters -*-
+
+import os
+
+from twisted.trial import unittest
+
+from beah import filters
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
+
+
+class Lines(filters.LineReceiver):
+
+    def __init__(self, **kwargs):
+        filters.LineReceiver.__init__(self, **kwargs)
+        self.lines = []
+
+    def proc_line(self, line):
+        self.lines.append(line)
+
+
+class TestLineReceiver(unittest.TestCase):
+
+    def testChunks(self):
+        lr = Lines()
+        for chunk in ['a', 'b\ncd', '\n', '\n\nef', 'g']:
+            lr.proc_data(chunk)
+        self.failUnlessEqual(lr.lines, ['ab', 'cd', '', ''])
+        self.failUnlessEqual(lr.cache, 'efg')
+        lr.proc_pending()
+        self.failUnlessEqual(lr.lines, ['ab', 'cd', '', '', 'efg'])
+        self.failUnlessEqual(lr.cache, '')
+
+    def testSplitDelimiter(self):
+        lr = Lines(delim='\r\n')
+        for chunk in ['a\r', '\nb\r', 'c\r', '\n']:
+            lr.proc_data(chunk)
+        self.failUnlessEqual(lr.lines, ['a', 'b\rc'])
+
+    def testMaxLength(self):
+        lr = Lines(max_length=4)
+        lr.proc_data('abcdefghij\nab')
+        self.failUnlessEqual(lr.lines, ['abcd', 'efgh', 'ij'])
+        lr.proc_data('cdef')
+        self.failUnlessEqual(lr.lines[3:], ['abcd', 'ef'])
+        self.failUnlessEqual(lr.cache, '')
+
+    def testDeserializer(self):
+        objs = []
+        d = filters.ListDeserializer()
+        d.redir(objs.append)
+        d.proc_data('[1, 2]\n[3')
+        d.proc_data(']\n')
+        self.failUnlessEqual(objs, [1, 2, 3])
+
+    def testProcFile(self):
+        r, w = os.pipe()
+        os.write(w, 'a\nb\nc')
+        os.close(w)
+        f = os.fdopen(r)
+        lr = Lines()
+        filters.proc_file(lr, f)
+        f.close()
+        self.failUnlessEqual(lr.lines, ['a', 'b', 'c'])
+
+    def testBenchmark(self):
+        count = 100000 * BENCHMARK_SCALE
+        data = ''.join(['line %d\n' % i for i in xrange(count)])
+        lr = Lines()
+        benchmark('LineReceiver, one block', count, lr.proc_data, data)
+        self.failUnlessEqual(len(lr.lines), count)
+        lr = Lines()
+        def small_chunks():
+            for ix in xrange(0, len(data), 100):
+                lr.proc_data(data[ix:ix+100])
+        benchmark('LineReceiver, 100 byte chunks', count, small_chunks)
+        self.failUnlessEqual(len(lr.lines), count)
+    testBenchmark.skip = BENCHMARK_SKIP
@@ -26,6 +26,7 @@ import logging
 import logging.handlers
 import inspect
 import re
+import weakref
 
 log = logging.getLogger('beah')
 
@@ -267,6 +268,45 @@ def is_class_verbose(cls):
     return '_class_is_verbose' in dir(cls) and cls._class_is_verbose
 
 
+# Live dispatch tables, rebuilt when methods are made verbose:
+_dispatch_tables = weakref.WeakValueDictionary()
+
+class DispatchTable(dict):
+    """
+    Table mapping names to bound methods of obj named prefix+name.
+
+    Handlers are looked up once, instead of building a name and calling
+    getattr for each event or command. Methods and instance attributes of obj
+    are used. Tables are rebuilt when make_methods_verbose replaces methods
+    and when a handler is assigned by set_handler. A handler assigned to obj
+    directly after the table was built is not used.
+    """
+
+    def __init__(self, obj, prefix):
+        dict.__init__(self)
+        self.obj = obj
+        self.prefix = prefix
+        self.build()
+        _dispatch_tables[id(self)] = self
+
+    def build(self):
+        self.clear()
+        obj, prefix = self.obj, self.prefix
+        for name in dir(obj):
+            if name.startswith(prefix):
+                handler = getattr(obj, name, None)
+                if callable(handler):
+                    self[name[len(prefix):]] = handler
+
+
+def set_handler(obj, name, handler):
+    """Set obj's attribute name to handler and rebuild obj's DispatchTables."""
+    setattr(obj, name, handler)
+    for table in _dispatch_tables.values():
+        if table.obj is obj:
+            table.build()
+
+
 def make_methods_verbose(cls, print_on_call, method_list):
     for id in method_list:
         if isinstance(id, (tuple, list)):
@@ -287,6 +327,8 @@ def make_methods_verbose(cls, print_on_call, method_list):
             new_meth = print_on_call(meth)
             new_meth.original_method = meth
             setattr(cls, id, new_meth)
+    for table in _dispatch_tables.values():
+        table.build()
 
 
 def make_class_verbose(cls, print_on_call):
@@ -1,4 +1,11 @@
 #import hashlib
+try:
+    import hashlib
+    _HASH_CONSTRUCTOR = {'md5':hashlib.md5, 'sha1':hashlib.sha1, # pylint: disable=E1101
+            'sha256':hashlib.sha256, 'sha512':hashlib.sha512}      # pylint: disable=E1101
+except ImportError:
+    import md5, sha
+    _HASH_CONSTRUCTOR = {'md5':md5.new, 'sha1':sha.new}
 
 __DIGEST_BY_LEN = {32:'md5', 40:'sha1', 64:'sha256', 128:'sha512'}
 
@@ -71,3 +78,60 @@ def DigestConstructor(digest_method):
 #    return __DIGEST_CONSTRUCTOR.get(digest_method, NoDigest)
     return NoDigest
 
+
+
+class FileDigest(object):
+
+    """
+    Digest of a whole file calculated from chunks as they are written.
+
+    Chunks have to be written in order. Digest is not valid when a chunk is
+    missing or when the state was lost e.g. by restart: digest objects can
+    not be saved, so only state() - method, offset and validity - is
+    persisted and from_state creates an invalid digest for offset > 0.
+    """
+
+    def __init__(self, method, offset=0, valid=True):
+        self.method = method
+        self.offset = offset
+        self.valid = valid and offset == 0
+        constructor = _HASH_CONSTRUCTOR.get(method, None)
+        if constructor is None:
+            self.valid = False
+            self.hash = None
+        else:
+            self.hash = constructor()
+
+    def from_state(cls, state):
+        method, offset, valid = state
+        return cls(method, offset, valid)
+    from_state = classmethod(from_state)
+
+    def state(self):
+        return (self.method, self.offset, self.valid)
+
+    def update(self, offset, data):
+        """Add chunk of data written at offset."""
+        if offset == 0 and self.offset != 0:
+            # file is being rewritten:
+            self.__init__(self.method)
+        elif offset != self.offset:
+            self.valid = False
+        if self.valid:
+            self.hash.update(data)
+        self.offset = offset + len(data)
+
+    def skip(self, offset, size):
+        """Chunk was written, but not added to the digest."""
+        self.valid = False
+        self.offset = offset + size
+
+    def check(self, digest):
+        """
+        Compare with expected hex digest.
+
+        Return None if the digest can not be checked.
+        """
+        if not self.valid or not digest:
+            return None
+        return self.hash.hexdigest() == digest.lower()
@@ -23,15 +23,65 @@ import os
 import exceptions
 import beah.misc
 
-# Prefer the std.lib json module on Python2.6+
-try:
-    import json
-except ImportError:
-    json = None
-# Use simplejson instead if there is no json module at all,
-# or if it appears to be the old python-json package (RHEL5 & earlier)
-if not json or not hasattr(json, 'dumps'):
-    import simplejson as json
+
+
+def _c_accelerated(module):
+    """Check whether JSON module uses C extension to encode and decode."""
+    if hasattr(module, '_import_c_make_encoder'):
+        # simplejson
+        return bool(module._import_c_make_encoder())
+    encoder = getattr(module, 'encoder', None)
+    decoder = getattr(module, 'decoder', None)
+    return bool(getattr(encoder, 'c_make_encoder', None)
+            and getattr(decoder, 'c_scanstring', None))
+
+
+def json_backends(preference=('json', 'simplejson')):
+    """
+    Return list of (name, module) pairs of available JSON implementations.
+
+    The list is sorted by preference: C-accelerated implementations first,
+    then in the order given by preference.
+    """
+    backends = []
+    for name in preference:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        # the old python-json package (RHEL5 & earlier) is not usable:
+        if not hasattr(module, 'dumps'):
+            continue
+        backends.append((name, module))
+    accelerated = [b for b in backends if _c_accelerated(b[1])]
+    return accelerated + [b for b in backends if b not in accelerated]
+
+
+def make_codec(module):
+    """
+    Return (dumps, loads) functions using encoder and decoder instances
+    created once.
+    """
+    return (module.JSONEncoder().encode, module.JSONDecoder().decode)
+
+
+def _select(preference):
+    backends = json_backends(preference)
+    return ([b for b in backends if b[0] == os.getenv('BEAH_JSON')]
+            or backends)[0]
+
+
+# The std.lib encoder is faster than simplejson's, while simplejson decodes
+# faster, as it returns str instead of unicode for ASCII strings, which is
+# also cheaper to encode again. The implementation can be overridden by
+# BEAH_JSON environment variable.
+JSON_ENCODER, json = _select(('json', 'simplejson'))
+JSON_DECODER, _decoder_module = _select(('simplejson', 'json'))
+
+# Shared encoder and decoder used for all wire and journal serialization:
+dumps = make_codec(json)[0]
+loads = make_codec(_decoder_module)[1]
+
 
 def _copy_dict_check(src, dst, checkf, errorf):
     answ = True
@@ -19,11 +19,31 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import exceptions
+import os
 import shelve
+import struct
+import time
+import zlib
+import logging
+import cPickle as pickle
+try:
+    set
+except NameError: # Python 2.3
+    from sets import Set as set
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite
+    except ImportError:
+        sqlite = None
 from beah.misc import pre_open
 from beah.core import make_addict
 
 
+log = logging.getLogger('beah')
+
+
 UNDEFINED=[]
 
 
@@ -39,7 +59,7 @@ class BaseRuntime(object):
         type_keys(rt, type)
     And depending on the implementation these:
         close(rt)
-        sync(rt, type=None)
+        sync_primitive(rt)
     This one might be redefined for performance reasons:
         type_has_key(rt, type, key)
 
@@ -50,15 +70,117 @@ class BaseRuntime(object):
     or in subclass' contructor.
     These can be accessed as normal dictionary
         rt.vars['a'] = 11
+
+    Durability:
+        Every modification ends with sync(type). Whether it is written to
+        disk is decided by sync policy - see set_sync_policy. Use barrier()
+        (or sync() without arguments) to write all pending changes
+        regardless of the policy.
+
+    Batches:
+        Modifications made between begin() and end() are synced as a single
+        modification when the outermost end() is called. batch() returns
+        a context manager doing the same:
+            rt.begin()
+            try:
+                rt.vars.update(a=1, b=2)
+                rt.files['f'] = 'file'
+            finally:
+                rt.end()
     """
 
+    SYNC_IMMEDIATE = 'immediate'
+    SYNC_GROUP = 'group'
+    SYNC_EXPLICIT = 'explicit'
+
+    # type used to sync a batch:
+    BATCH = '<batch>'
+
     def __init__(self):
-        pass
+        self.sync_policy = self.SYNC_IMMEDIATE
+        self.sync_writes = 100
+        self.sync_interval = 1.0
+        self.call_later = None
+        self.__pending = 0
+        self.__last_sync = time.time()
+        self.__timer = None
+        self.__batch = 0
+        self.__batch_syncs = 0
+
+    def set_sync_policy(self, policy, writes=None, interval=None,
+            call_later=None):
+        """
+        Set the durability policy.
+
+        policy -- one of:
+            SYNC_IMMEDIATE - sync after each modification,
+            SYNC_GROUP - sync after given number of writes or when interval
+                (in milliseconds) has elapsed since the last sync,
+            SYNC_EXPLICIT - sync only on barrier.
+        call_later -- function like reactor.callLater used to sync pending
+            writes when interval elapses without further writes. When not
+            set, the interval is checked on writes only.
+        """
+        if policy not in (self.SYNC_IMMEDIATE, self.SYNC_GROUP,
+                self.SYNC_EXPLICIT):
+            raise exceptions.ValueError("Unknown sync policy %r." % policy)
+        self.barrier()
+        self.sync_policy = policy
+        if writes is not None:
+            self.sync_writes = int(writes)
+        if interval is not None:
+            self.sync_interval = float(interval) / 1000
+        if call_later is not None:
+            self.call_later = call_later
 
     def close(self):
         self.sync()
 
+    def barrier(self):
+        """Write all pending changes to disk regardless of sync policy."""
+        self.__pending = 0
+        self.__last_sync = time.time()
+        if self.__timer is not None:
+            if self.__timer.active():
+                self.__timer.cancel()
+            self.__timer = None
+        self.sync_primitive()
+
+    def begin(self):
+        """Start a batch. Batches may be nested."""
+        self.__batch += 1
+
+    def end(self):
+        """End a batch. Sync changes made since outermost begin()."""
+        self.__batch -= 1
+        if self.__batch == 0 and self.__batch_syncs:
+            self.__batch_syncs = 0
+            self.sync(self.BATCH)
+
+    def batch(self):
+        """Return a context manager calling begin and end."""
+        return RuntimeBatch(self)
+
     def sync(self, type=None):
+        if type is None:
+            self.barrier()
+            return
+        if self.__batch > 0:
+            self.__batch_syncs += 1
+            return
+        if self.sync_policy == self.SYNC_IMMEDIATE:
+            self.barrier()
+            return
+        if self.sync_policy == self.SYNC_EXPLICIT:
+            return
+        self.__pending += 1
+        if self.__pending >= self.sync_writes or \
+                time.time() - self.__last_sync >= self.sync_interval:
+            self.barrier()
+        elif self.__timer is None and self.call_later is not None:
+            self.__timer = self.call_later(self.sync_interval, self.barrier)
+
+    def sync_primitive(self):
         pass
 
     def type_set(self, type, key, value):
@@ -87,6 +209,24 @@ class BaseRuntime(object):
 
 
 
+class RuntimeBatch(object):
+
+    """
+    Context manager wrapping runtime modifications in a single batch.
+    """
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def __enter__(self):
+        self.runtime.begin()
+        return self.runtime
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.runtime.end()
+        return False
+
+
 class TypeDict(object):
 
     """
@@ -154,12 +294,15 @@ class TypeList(object):
         f = self.__first = int(self.runtime.type_get(self.type, 'first', 0))
         l = self.__last = int(self.runtime.type_get(self.type, 'last', -1))
         index = []
-        while f <= l:
-            key = str(f)
-            if self.runtime.type_has_key(self.type, key):
-                index.append(key)
-            f += 1
-        self.__index = index
+        for key in self.runtime.type_keys(self.type):
+            try:
+                ix = int(key)
+            except exceptions.ValueError:
+                continue
+            if f <= ix <= l and str(ix) == key:
+                index.append(ix)
+        index.sort()
+        self.__index = [str(ix) for ix in index]
 
     def __len__(self):
         return len(self.__index)
@@ -277,18 +420,23 @@ class TypeList(object):
 class DictRuntime(BaseRuntime):
     """
     Runtime using dict to store data.
+
+    Keys of each type are tracked in type_index, so type_keys does not have
+    to scan the whole dictionary. The index is built on first use and
+    maintained afterwards.
+
+    NOTE: Type may contain slashes and keys of type 'a/b' are listed as keys
+    of type 'a' too.
     """
 
     def __init__(self, dict_):
         self.dict_ = dict_
+        self.type_index = None
         BaseRuntime.__init__(self)
 
     def close(self):
         pass
 
-    def sync(self, type=None):
-        pass
-
     def mk_type_key(self, type, key):
         # NOTE: In python 2.3 this might return unicode, which is not handled
         # by shelve.
@@ -299,11 +447,45 @@ class DictRuntime(BaseRuntime):
         # Note: ``id[l:][1:]'' is not the same as ``id[l+1:]'' if l is -1
         return (id[:l], id[l:][1:])
 
+    def index_add(self, id):
+        index = self.type_index
+        l = id.find("/")
+        while l >= 0:
+            keys = index.get(id[:l], None)
+            if keys is None:
+                keys = index[id[:l]] = set()
+            keys.add(id[l+1:])
+            l = id.find("/", l+1)
+
+    def index_del(self, id):
+        index = self.type_index
+        l = id.find("/")
+        while l >= 0:
+            keys = index.get(id[:l], None)
+            if keys is not None:
+                keys.discard(id[l+1:])
+                if not keys:
+                    del index[id[:l]]
+            l = id.find("/", l+1)
+
+    def get_type_index(self):
+        if self.type_index is None:
+            self.type_index = {}
+            for id in self.dict_.keys():
+                self.index_add(id)
+        return self.type_index
+
     def type_set_primitive(self, type, key, value):
-        self.dict_[self.mk_type_key(type, key)] = value
+        id = self.mk_type_key(type, key)
+        self.dict_[id] = value
+        if self.type_index is not None:
+            self.index_add(id)
 
     def type_del_primitive(self, type, key):
-        del self.dict_[self.mk_type_key(type, key)]
+        id = self.mk_type_key(type, key)
+        del self.dict_[id]
+        if self.type_index is not None:
+            self.index_del(id)
 
     def type_get(self, type, key, defval=UNDEFINED):
         if defval is UNDEFINED:
@@ -314,9 +496,7 @@ class DictRuntime(BaseRuntime):
         return self.dict_.has_key(self.mk_type_key(type, key))
 
     def type_keys(self, type):
-        tl = len(type)+1
-        type = type + '/'
-        return [key[tl:] for key in self.dict_.keys() if key[:tl] == type]
+        return list(self.get_type_index().get(type, ()))
 
     def dump(self, sorted=False):
         key_value_list = self.dict_.items()
@@ -337,9 +517,468 @@ class ShelveRuntime(DictRuntime):
 
     def close(self):
         if self.dict_ is not None:
+            self.barrier()
             self.dict_.close()
             self.dict_ = None
 
-    def sync(self, type=None): # pylint: disable=E0202
+    def sync_primitive(self):
         self.dict_.sync()
 
+
+
+
+class RecordLogError(exceptions.Exception):
+    """Exception raised when a file is not a valid record log."""
+    pass
+
+
+class RecordLog(object):
+
+    """
+    Append-only, dictionary-like persistent store.
+
+    Every assignment and deletion is appended to the file as a single record.
+    Only an index (key -> position of the last value) is kept in memory and
+    values are read back from the file on access.
+
+    Record layout:
+        struct '!BIII' header: operation, crc32, key length, value length
+        key
+        pickled value (empty for deletions)
+    crc32 covers operation, key and value.
+
+    When the file is opened, the records are replayed to rebuild the index.
+    Incomplete or corrupted trailing record (e.g. after power failure) is
+    discarded and the file is truncated to the last good record.
+
+    The log is compacted on sync, when there is more garbage than live data
+    and garbage exceeds COMPACT_MIN bytes. Compacted copy is written to a
+    temporary file which then atomically replaces the original.
+    """
+
+    MAGIC = 'BEAH-RECORD-LOG-1\n'
+    HEADER = '!BIII'
+    HEADER_LEN = struct.calcsize(HEADER)
+    OP_SET = 1
+    OP_DEL = 2
+    COMPACT_MIN = 1024*1024
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.index = {}
+        self.live = 0
+        self.garbage = 0
+        self.fd = None
+        self.reader = None
+        self.open()
+
+    def open(self):
+        pre_open(self.fname)
+        self.fd = os.open(self.fname, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        self.reader = open(self.fname, 'rb')
+        self.end = self.replay()
+
+    def replay(self):
+        """Rebuild the index from the file. Return offset of the end."""
+        reader = self.reader
+        magic = reader.read(len(self.MAGIC))
+        if not magic:
+            self._write(self.MAGIC)
+            return len(self.MAGIC)
+        if magic != self.MAGIC:
+            raise RecordLogError("File '%s' is not a record log." % self.fname)
+        offset = len(self.MAGIC)
+        while True:
+            header = reader.read(self.HEADER_LEN)
+            if not header:
+                break
+            if len(header) < self.HEADER_LEN:
+                break
+            op, crc, klen, vlen = struct.unpack(self.HEADER, header)
+            payload = reader.read(klen+vlen)
+            if len(payload) < klen+vlen or op not in (self.OP_SET, self.OP_DEL):
+                break
+            if zlib.crc32(chr(op) + payload) & 0xffffffffL != crc:
+                break
+            self._index(op, payload[:klen], offset, klen, vlen)
+            offset += self.HEADER_LEN + klen + vlen
+        size = os.fstat(self.fd).st_size
+        if offset < size:
+            log.warning("RecordLog(%r): dropping %s bytes of incomplete data.",
+                    self.fname, size - offset)
+            os.ftruncate(self.fd, offset)
+        return offset
+
+    def _index(self, op, key, offset, klen, vlen):
+        old = self.index.get(key, None)
+        if old is not None:
+            self.live -= old[2]
+            self.garbage += old[2]
+        rlen = self.HEADER_LEN + klen + vlen
+        if op == self.OP_SET:
+            self.index[key] = (offset + self.HEADER_LEN + klen, vlen, rlen)
+            self.live += rlen
+        else:
+            if old is not None:
+                del self.index[key]
+            self.garbage += rlen
+
+    def _write(self, data):
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def _record(self, op, key, value):
+        payload = key + value
+        return struct.pack(self.HEADER, op,
+                zlib.crc32(chr(op) + payload) & 0xffffffffL,
+                len(key), len(value)) + payload
+
+    def _append(self, op, key, value):
+        self._write(self._record(op, key, value))
+        self._index(op, key, self.end, len(key), len(value))
+        self.end += self.HEADER_LEN + len(key) + len(value)
+
+    def _read(self, position):
+        self.reader.seek(position[0])
+        return self.reader.read(position[1])
+
+    def __setitem__(self, key, value):
+        self._append(self.OP_SET, key, pickle.dumps(value, 2))
+
+    def __getitem__(self, key):
+        return pickle.loads(self._read(self.index[key]))
+
+    def __delitem__(self, key):
+        if not self.index.has_key(key):
+            raise exceptions.KeyError(key)
+        self._append(self.OP_DEL, key, '')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return self.index.has_key(key)
+
+    def has_key(self, key):
+        return self.index.has_key(key)
+
+    def get(self, key, defval=None):
+        position = self.index.get(key, None)
+        if position is None:
+            return defval
+        return pickle.loads(self._read(position))
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.index.keys()]
+
+    def needs_compaction(self):
+        return self.garbage > self.COMPACT_MIN and self.garbage > self.live
+
+    def compact(self):
+        """Rewrite the log keeping only live records."""
+        tmpname = self.fname + '.compact'
+        tmp = open(tmpname, 'wb')
+        tmp.write(self.MAGIC)
+        for key, position in self.index.items():
+            tmp.write(self._record(self.OP_SET, key, self._read(position)))
+        tmp.flush()
+        os.fsync(tmp.fileno())
+        tmp.close()
+        os.rename(tmpname, self.fname)
+        self._close()
+        self.index = {}
+        self.live = 0
+        self.garbage = 0
+        self.open()
+
+    def sync(self):
+        os.fsync(self.fd)
+        if self.needs_compaction():
+            self.compact()
+
+    def _close(self):
+        os.close(self.fd)
+        self.fd = None
+        self.reader.close()
+        self.reader = None
+
+    def close(self):
+        if self.fd is not None:
+            self.sync()
+            self._close()
+
+
+class LogRuntime(DictRuntime):
+    """
+    Runtime using append-only RecordLog to store data.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        DictRuntime.__init__(self, RecordLog(fname))
+
+    def close(self):
+        if self.dict_ is not None:
+            self.barrier()
+            self.dict_.close()
+            self.dict_ = None
+
+    def sync_primitive(self):
+        self.dict_.sync()
+
+
+class CachingRuntime(BaseRuntime):
+    """
+    LRU write-back cache in front of another runtime.
+
+    Up to size most recently used items (including information that a key
+    does not exist) are kept in memory. Modifications are written to the
+    underlying runtime when a modified item is evicted or on barrier, which
+    also syncs the underlying runtime.
+
+    NOTE: Cached values are shared - do not modify returned values in place.
+    """
+
+    # link fields:
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+    # value of missing or deleted items:
+    MISSING = []
+
+    def __init__(self, runtime, size=1024):
+        self.runtime = runtime
+        self.size = max(int(size), 1)
+        self.cache = {}
+        self.dirty = {}
+        root = self.root = []
+        root[:] = [root, root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        BaseRuntime.__init__(self)
+
+    def cache_stats(self):
+        """Return dictionary with cache statistics."""
+        return dict(hits=self.hits, misses=self.misses, writes=self.writes,
+                size=len(self.cache), dirty=len(self.dirty))
+
+    def __unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def __link(self, link):
+        root = self.root
+        first = root[self.NEXT]
+        link[self.PREV] = root
+        link[self.NEXT] = first
+        first[self.PREV] = root[self.NEXT] = link
+
+    def __lookup(self, type, key):
+        ck = (type, "%s" % key)
+        link = self.cache.get(ck, None)
+        if link is not None:
+            self.hits += 1
+            self.__unlink(link)
+            self.__link(link)
+            return link[self.VALUE]
+        self.misses += 1
+        value = self.runtime.type_get(type, key, self.MISSING)
+        self.__store(ck, value)
+        return value
+
+    def __store(self, ck, value):
+        link = self.cache.get(ck, None)
+        if link is not None:
+            self.__unlink(link)
+            link[self.VALUE] = value
+        else:
+            link = [None, None, ck, value]
+            self.cache[ck] = link
+        self.__link(link)
+        if len(self.cache) > self.size:
+            last = self.root[self.PREV]
+            self.__unlink(last)
+            ck = last[self.KEY]
+            del self.cache[ck]
+            if self.dirty.has_key(ck):
+                del self.dirty[ck]
+                self.__write(ck, last[self.VALUE])
+        return link
+
+    def __write(self, ck, value):
+        type, key = ck
+        self.writes += 1
+        if value is self.MISSING:
+            if self.runtime.type_has_key(type, key):
+                self.runtime.type_del_primitive(type, key)
+        else:
+            self.runtime.type_set_primitive(type, key, value)
+
+    def write_back(self):
+        """Write all modified items to the underlying runtime."""
+        dirty = self.dirty
+        self.dirty = {}
+        for ck, link in dirty.items():
+            self.__write(ck, link[self.VALUE])
+
+    def sync_primitive(self):
+        self.write_back()
+        self.runtime.barrier()
+
+    def close(self):
+        if self.runtime is not None:
+            self.barrier()
+            log.info("CachingRuntime: %r", self.cache_stats())
+            self.runtime.close()
+            self.runtime = None
+
+    def type_set_primitive(self, type, key, value):
+        ck = (type, "%s" % key)
+        self.dirty[ck] = self.__store(ck, value)
+
+    def type_del_primitive(self, type, key):
+        if self.__lookup(type, key) is self.MISSING:
+            raise exceptions.KeyError("Key %r is not present." % key)
+        ck = (type, "%s" % key)
+        self.dirty[ck] = self.__store(ck, self.MISSING)
+
+    def type_get(self, type, key, defval=UNDEFINED):
+        value = self.__lookup(type, key)
+        if value is self.MISSING:
+            if defval is UNDEFINED:
+                raise exceptions.KeyError("Key %r is not present." % key)
+            return defval
+        return value
+
+    def type_has_key(self, type, key):
+        return self.__lookup(type, key) is not self.MISSING
+
+    def type_keys(self, type):
+        self.write_back()
+        return self.runtime.type_keys(type)
+
+    def dump(self, sorted=False):
+        self.write_back()
+        return self.runtime.dump(sorted=sorted)
+
+
+class SqliteRuntime(BaseRuntime):
+    """
+    Runtime using SQLite database to store data.
+
+    Values are pickled and stored in a single table indexed by (type, key).
+    Database is used in WAL mode where available. Modifications are made in
+    a transaction, which is committed on sync, so a batch or a
+    TypeDict.update is written in a single commit.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS runtime (
+            type TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            PRIMARY KEY (type, key))"""
+
+    def __init__(self, fname):
+        if sqlite is None:
+            raise exceptions.RuntimeError("SQLite module is not available.")
+        self.fname = fname
+        pre_open(fname)
+        # transactions are handled explicitly:
+        self.db = sqlite.connect(fname, isolation_level=None)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(self.SCHEMA)
+        self.in_transaction = False
+        BaseRuntime.__init__(self)
+
+    def close(self):
+        if self.db is not None:
+            self.barrier()
+            self.db.close()
+            self.db = None
+
+    def sync_primitive(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.db.execute('COMMIT')
+
+    def __begin(self):
+        if not self.in_transaction:
+            self.db.execute('BEGIN')
+            self.in_transaction = True
+
+    def type_set_primitive(self, type, key, value):
+        self.__begin()
+        self.db.execute('INSERT OR REPLACE INTO runtime VALUES (?, ?, ?)',
+                (type, "%s" % key, sqlite.Binary(pickle.dumps(value, 2))))
+
+    def type_del_primitive(self, type, key):
+        self.__begin()
+        cursor = self.db.execute('DELETE FROM runtime WHERE type=? AND key=?',
+                (type, "%s" % key))
+        if cursor.rowcount == 0:
+            raise exceptions.KeyError("Key %r is not present." % key)
+
+    def type_get(self, type, key, defval=UNDEFINED):
+        row = self.db.execute(
+                'SELECT value FROM runtime WHERE type=? AND key=?',
+                (type, "%s" % key)).fetchone()
+        if row is None:
+            if defval is UNDEFINED:
+                raise exceptions.KeyError("Key %r is not present." % key)
+            return defval
+        return pickle.loads(str(row[0]))
+
+    def type_has_key(self, type, key):
+        return self.db.execute(
+                'SELECT 1 FROM runtime WHERE type=? AND key=?',
+                (type, "%s" % key)).fetchone() is not None
+
+    def type_keys(self, type):
+        # keys of type 'a/b' are listed as keys of type 'a' too. Types
+        # starting with 'a/' are in range ['a/', 'a0').
+        tl = len(type)+1
+        rows = self.db.execute('SELECT type, key FROM runtime WHERE type=? '
+                'OR (type>=? AND type<?)', (type, type+'/', type+'0'))
+        answ = []
+        for row_type, key in rows:
+            if len(row_type) < tl:
+                answ.append(key)
+            else:
+                answ.append("%s/%s" % (row_type[tl:], key))
+        return answ
+
+    def dump(self, sorted=False):
+        query = 'SELECT type, key, value FROM runtime'
+        if sorted:
+            query += ' ORDER BY type, key'
+        return [("%s/%s" % (type, key), pickle.loads(str(value)))
+                for type, key, value in self.db.execute(query)]
+
+
+RUNTIMES = {
+        'shelve': ShelveRuntime,
+        'log': LogRuntime,
+        'sqlite': SqliteRuntime,
+        }
+
+
+def open_runtime(fname, runtime_type=None, cache_size=0):
+    """
+    Open a runtime of given type.
+
+    runtime_type is one of RUNTIMES keys. ShelveRuntime is used by default.
+    When cache_size is positive, the runtime is wrapped in CachingRuntime.
+    """
+    cls = RUNTIMES.get(runtime_type or 'shelve', None)
+    if cls is None:
+        raise exceptions.ValueError("Unknown runtime type %r." % runtime_type)
+    runtime = cls(fname)
+    cache_size = int(cache_size or 0)
+    if cache_size > 0:
+        runtime.set_sync_policy(BaseRuntime.SYNC_EXPLICIT)
+        runtime = CachingRuntime(runtime, cache_size)
+    return runtime
@@ -0,0 +1,44 @@
+# -*- test-case-name: beah.misc.test.test_digests -*-
+
+import md5
+
+from twisted.trial import unittest
+
+from beah.misc import digests
+
+
+class TestFileDigest(unittest.TestCase):
+
+    def testChunks(self):
+        fd = digests.FileDigest('md5')
+        fd.update(0, 'abc')
+        fd.update(3, 'def')
+        self.failUnless(fd.check(md5.new('abcdef').hexdigest()))
+        self.failUnless(fd.check(md5.new('abcdef').hexdigest().upper()))
+        self.failIf(fd.check(md5.new('abc').hexdigest()))
+        self.failUnlessEqual(fd.state(), ('md5', 6, True))
+
+    def testMissingChunk(self):
+        fd = digests.FileDigest('md5')
+        fd.update(0, 'abc')
+        fd.update(4, 'def')
+        self.failUnlessEqual(fd.check(md5.new('abcdef').hexdigest()), None)
+        fd = digests.FileDigest('md5')
+        fd.skip(0, 3)
+        fd.update(3, 'def')
+        self.failUnlessEqual(fd.check(md5.new('abcdef').hexdigest()), None)
+        # rewriting the file from the beginning:
+        fd.update(0, 'xyz')
+        self.failUnless(fd.check(md5.new('xyz').hexdigest()))
+
+    def testState(self):
+        fd = digests.FileDigest.from_state(('md5', 0, True))
+        fd.update(0, 'abc')
+        self.failUnless(fd.check(md5.new('abc').hexdigest()))
+        # digest state is lost:
+        fd = digests.FileDigest.from_state(fd.state())
+        fd.update(3, 'def')
+        self.failUnlessEqual(fd.check(md5.new('abcdef').hexdigest()), None)
+        fd = digests.FileDigest('unknown')
+        fd.update(0, 'abc')
+        self.failUnlessEqual(fd.check('x'*32), None)
@@ -3,6 +3,7 @@
 from twisted.trial import unittest
 
 from beah.misc import jsonenv
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
 
 import shutil
 import tempfile
@@ -128,3 +129,60 @@ class TestAll(unittest.TestCase):
         finally:
             shutil.rmtree(d)
 
+
+
+class TestCodec(unittest.TestCase):
+
+    def testBackends(self):
+        backends = jsonenv.json_backends()
+        self.failUnless(backends)
+        self.failUnless((jsonenv.JSON_ENCODER, jsonenv.json) in backends)
+        self.failUnless(jsonenv.JSON_DECODER in [b[0] for b in backends])
+        accelerated = [jsonenv._c_accelerated(module)
+                for name, module in backends]
+        self.failUnlessEqual(accelerated, sorted(accelerated, reverse=True))
+
+    def testRoundTrip(self):
+        from beah.core import event
+        evt = event.output('line\n', origin={'id': 'task1'})
+        for name, module in jsonenv.json_backends():
+            dumps, loads = jsonenv.make_codec(module)
+            self.failUnlessEqual(event.Event(loads(dumps(evt))), evt)
+        self.failUnlessEqual(jsonenv.loads(jsonenv.dumps(evt)), evt)
+
+
+class TestCodecBenchmark(unittest.TestCase):
+
+    """
+    Serialize and deserialize events with each JSON implementation.
+
+    Use BEAH_BENCHMARK_SCALE to run more iterations.
+    """
+
+    skip = BENCHMARK_SKIP
+
+    def testEvents(self):
+        from beah.core import event
+        from beah.core.constants import RC
+        events = [
+                event.output('line of output\n', origin={'id': 'task1'}),
+                event.file_write('file1', event.encode('base64', 'x' * 4096),
+                    codec='base64', offset=0, origin={'id': 'task1'}),
+                event.result_ex(RC.PASS, handle='test/result',
+                    message='Passed', origin={'id': 'task1'}),
+                ]
+        count = 10000 * BENCHMARK_SCALE
+        codecs = [(name, jsonenv.make_codec(module))
+                for name, module in jsonenv.json_backends()]
+        codecs.append(('%s/%s' % (jsonenv.JSON_ENCODER, jsonenv.JSON_DECODER),
+            (jsonenv.dumps, jsonenv.loads)))
+        for name, (dumps, loads) in codecs:
+            def dump_all():
+                for i in xrange(count):
+                    dumps(events[i % 3])
+            lines = [dumps(evt) for evt in events]
+            def load_all():
+                for i in xrange(count):
+                    loads(lines[i % 3])
+            benchmark('%s dumps' % name, count, dump_all)
+            benchmark('%s loads' % name, count, load_all)
@@ -1,10 +1,13 @@
 # -*- test-case-name: beah.misc.test.test_runtimes -*-
 
+import os
 import pprint
 
 from twisted.trial import unittest
+from twisted.internet import task
 
 from beah.misc import runtimes
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
 
 
 class TestingRuntime(runtimes.ShelveRuntime):
@@ -15,6 +18,31 @@ class TestingRuntime(runtimes.ShelveRuntime):
         self.queue = runtimes.TypeList(self, 'queue')
 
 
+class TestingLogRuntime(runtimes.LogRuntime):
+    def __init__(self, fname):
+        runtimes.LogRuntime.__init__(self, fname)
+        self.vars = runtimes.TypeDict(self, 'var')
+        self.files = runtimes.TypeDict(self, 'file')
+        self.queue = runtimes.TypeList(self, 'queue')
+
+
+class TestingSqliteRuntime(runtimes.SqliteRuntime):
+    def __init__(self, fname):
+        runtimes.SqliteRuntime.__init__(self, fname)
+        self.vars = runtimes.TypeDict(self, 'var')
+        self.files = runtimes.TypeDict(self, 'file')
+        self.queue = runtimes.TypeList(self, 'queue')
+
+
+class TestingCachingRuntime(runtimes.CachingRuntime):
+    def __init__(self, fname):
+        # small cache to exercise eviction:
+        runtimes.CachingRuntime.__init__(self, runtimes.ShelveRuntime(fname), 4)
+        self.vars = runtimes.TypeDict(self, 'var')
+        self.files = runtimes.TypeDict(self, 'file')
+        self.queue = runtimes.TypeList(self, 'queue')
+
+
 def print_(runtime):
     for attr in ["vars", "files", "tasks"]:
         obj = getattr(runtime, attr, None)
@@ -37,11 +65,15 @@ def print_runtime(runtime):
     pprint_(runtime)
 
 
-class TestShelveRuntime(unittest.TestCase):
+class RuntimeTests(object):
+
+    RUNTIME = TestingRuntime
+    TESTDB = '.test-runtime.db.tmp'
 
     def testAll(self):
 
-        TESTDB='.test-runtime.db.tmp'
+        TESTDB = self.TESTDB
+        TestingRuntime = self.RUNTIME
         tr = TestingRuntime(TESTDB)
         tr.tasks = runtimes.TypeDict(tr, 'tasks')
         tr.tqueue = runtimes.TypeList(tr, 'testqueue')
@@ -112,3 +144,424 @@ class TestShelveRuntime(unittest.TestCase):
         assert tr.addict['d'] == 'e'
         tr.close()
 
+
+
+class TestShelveRuntime(RuntimeTests, unittest.TestCase):
+    pass
+
+
+class TestCachingRuntime(RuntimeTests, unittest.TestCase):
+
+    RUNTIME = TestingCachingRuntime
+    TESTDB = '.test-runtime.cache.tmp'
+
+    def _runtime(self, size=3):
+        self.backend = CountingRuntime()
+        self.gets = []
+        type_get = self.backend.type_get
+        def counting_get(type, key, defval=runtimes.UNDEFINED):
+            self.gets.append((type, key))
+            return type_get(type, key, defval)
+        self.backend.type_get = counting_get
+        return runtimes.CachingRuntime(self.backend, size)
+
+    def testHits(self):
+        rt = self._runtime()
+        sd = runtimes.TypeAddict(rt, 'file_info/f1')
+        self.failUnlessEqual(sd.get('offset', 0), 0)
+        sd['offset'] = 10
+        self.failUnlessEqual(sd.get('offset', 0), 10)
+        self.failUnlessEqual(sd.get('offset', 0), 10)
+        self.failUnlessEqual(self.gets, [('file_info/f1', 'offset')])
+        stats = rt.cache_stats()
+        self.failUnlessEqual(stats['misses'], 1)
+        self.failUnlessEqual(stats['hits'], 4)
+
+    def testWriteBack(self):
+        rt = self._runtime()
+        rt.set_sync_policy(rt.SYNC_EXPLICIT)
+        self.backend.syncs = 0
+        rt.type_set('t', 'a', 1)
+        rt.type_set('t', 'a', 2)
+        self.failIf(self.backend.dict_)
+        rt.barrier()
+        self.failUnlessEqual(self.backend.dict_, {'t/a': 2})
+        self.failUnlessEqual(self.backend.syncs, 1)
+        rt.type_del('t', 'a')
+        self.failUnlessRaises(KeyError, rt.type_del, 't', 'a')
+        self.failUnlessRaises(KeyError, rt.type_get, 't', 'a')
+        self.failUnlessEqual(self.backend.dict_, {'t/a': 2})
+        rt.barrier()
+        self.failUnlessEqual(self.backend.dict_, {})
+
+    def testEviction(self):
+        rt = self._runtime(2)
+        rt.set_sync_policy(rt.SYNC_EXPLICIT)
+        rt.type_set('t', 'a', 1)
+        rt.type_set('t', 'b', 2)
+        rt.type_get('t', 'a')
+        rt.type_set('t', 'c', 3)
+        # b was least recently used:
+        self.failUnlessEqual(self.backend.dict_, {'t/b': 2})
+        self.failUnlessEqual(sorted(rt.type_keys('t')), ['a', 'b', 'c'])
+        self.failUnlessEqual(len(rt.cache), 2)
+
+    def testDeleteNew(self):
+        rt = self._runtime()
+        rt.type_set('t', 'a', 1)
+        rt.type_del('t', 'a')
+        rt.barrier()
+        self.failUnlessEqual(self.backend.dict_, {})
+
+
+class TestSqliteRuntime(RuntimeTests, unittest.TestCase):
+
+    RUNTIME = TestingSqliteRuntime
+    TESTDB = '.test-runtime.sqlite.tmp'
+
+    if runtimes.sqlite is None:
+        skip = "SQLite module is not available."
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.TESTDB + suffix):
+                os.remove(self.TESTDB + suffix)
+
+    def _committed(self, type, key):
+        db = runtimes.sqlite.connect(self.TESTDB)
+        try:
+            return db.execute('SELECT 1 FROM runtime WHERE type=? AND key=?',
+                    (type, key)).fetchone() is not None
+        finally:
+            db.close()
+
+    def testTypeKeys(self):
+        rt = self.RUNTIME(self.TESTDB)
+        rt.type_set('offsets/t1', 'debug/log', 1)
+        rt.type_set('offsets/t1/debug', 'log2', 2)
+        rt.type_set('offsets0', 'x', 3)
+        rt.type_set('offsets', 'y', 4)
+        self.failUnlessEqual(sorted(rt.type_keys('offsets')),
+                ['t1/debug/log', 't1/debug/log2', 'y'])
+        self.failUnlessEqual(sorted(rt.type_keys('offsets/t1')),
+                ['debug/log', 'debug/log2'])
+        rt.close()
+
+    def testBatch(self):
+        rt = self.RUNTIME(self.TESTDB)
+        rt.begin()
+        rt.vars['a'] = 1
+        rt.begin()
+        rt.vars.update(b=2, c=3)
+        rt.end()
+        rt.queue.extend([1, 2, 3])
+        self.failIf(self._committed('var', 'a'))
+        rt.end()
+        self.failUnless(self._committed('var', 'a'))
+        self.failUnless(self._committed('queue', '2'))
+        batch = rt.batch()
+        batch.__enter__()
+        rt.vars['d'] = 4
+        self.failIf(self._committed('var', 'd'))
+        batch.__exit__(None, None, None)
+        self.failUnless(self._committed('var', 'd'))
+        rt.close()
+
+    def testUpdateIsOneTransaction(self):
+        rt = self.RUNTIME(self.TESTDB)
+        commits = []
+        sync = rt.sync_primitive
+        def counting_sync():
+            commits.append(rt.in_transaction)
+            sync()
+        rt.sync_primitive = counting_sync
+        rt.vars.update(a=1, b=2, c=3)
+        rt.queue.extend(range(10))
+        self.failUnlessEqual(commits, [True, True])
+        rt.close()
+
+
+def scan_type_keys(runtime, type):
+    tl = len(type)+1
+    type = type + '/'
+    return [key[tl:] for key in runtime.dict_.keys() if key[:tl] == type]
+
+
+class TestTypeIndex(unittest.TestCase):
+
+    def _check(self, rt, types):
+        for type in types:
+            self.failUnlessEqual(sorted(rt.type_keys(type)),
+                    sorted(scan_type_keys(rt, type)))
+
+    def testTypeKeys(self):
+        rt = runtimes.DictRuntime({})
+        rt.type_set('', 'journal_offs', 0)
+        rt.type_set('offsets/t1', 'debug/log', 1)
+        rt.type_set('offsets/t2', 'debug/log', 2)
+        rt.type_set('offsets', 'x', 3)
+        types = ('', 'offsets', 'offsets/t1', 'offsets/t2', 'offsets/t1/debug', 'none')
+        self._check(rt, types)
+        rt.type_set('offsets/t1', 'debug/log2', 4)
+        rt.type_del('offsets/t2', 'debug/log')
+        rt.type_del('offsets', 'x')
+        self._check(rt, types)
+        self.failIf(rt.type_index.has_key('offsets/t2'))
+        self.failUnlessEqual(sorted(rt.type_keys('offsets')),
+                ['t1/debug/log', 't1/debug/log2'])
+
+    def testLazyIndex(self):
+        rt = runtimes.DictRuntime({'a/1': 1, 'a/2': 2, 'b/1': 3})
+        self.failUnlessEqual(rt.type_index, None)
+        rt.type_set('a', '3', 3)
+        self.failUnlessEqual(rt.type_index, None)
+        self.failUnlessEqual(sorted(rt.type_keys('a')), ['1', '2', '3'])
+        rt.type_del('a', '1')
+        self.failUnlessEqual(sorted(rt.type_keys('a')), ['2', '3'])
+
+    def testTypeListWithGaps(self):
+        rt = runtimes.DictRuntime({})
+        l = runtimes.TypeList(rt, 'queue')
+        l.extend(range(12))
+        del l[5]
+        del l[0]
+        rt.type_set('queue/nested', '7', 'nested')
+        l2 = runtimes.TypeList(rt, 'queue')
+        self.failUnlessEqual(list(l2), [1, 2, 3, 4, 6, 7, 8, 9, 10, 11])
+        l2.check()
+
+
+class TestLogRuntime(RuntimeTests, unittest.TestCase):
+
+    RUNTIME = TestingLogRuntime
+    TESTDB = '.test-runtime.log.tmp'
+
+    def tearDown(self):
+        if os.path.exists(self.TESTDB):
+            os.remove(self.TESTDB)
+
+    def testReplayTruncated(self):
+        tr = self.RUNTIME(self.TESTDB)
+        tr.vars['a'] = 'A'
+        tr.vars['b'] = 'B'
+        tr.close()
+        size = os.path.getsize(self.TESTDB)
+        # simulate a crash in the middle of writing the last record:
+        f = open(self.TESTDB, 'ab')
+        f.write(runtimes.RecordLog.MAGIC[:7])
+        f.close()
+        tr = self.RUNTIME(self.TESTDB)
+        self.failUnlessEqual(tr.vars['a'], 'A')
+        self.failUnlessEqual(tr.vars['b'], 'B')
+        self.failUnlessEqual(os.path.getsize(self.TESTDB), size)
+        tr.vars['c'] = 'C'
+        tr.close()
+        tr = self.RUNTIME(self.TESTDB)
+        self.failUnlessEqual(tr.vars['c'], 'C')
+        tr.close()
+
+    def testReplayCorrupted(self):
+        tr = self.RUNTIME(self.TESTDB)
+        tr.vars['a'] = 'A'
+        tr.close()
+        size = os.path.getsize(self.TESTDB)
+        tr = self.RUNTIME(self.TESTDB)
+        tr.vars['b'] = 'B'
+        tr.close()
+        f = open(self.TESTDB, 'r+b')
+        f.seek(-1, 2)
+        f.write('X')
+        f.close()
+        tr = self.RUNTIME(self.TESTDB)
+        self.failUnlessEqual(tr.vars['a'], 'A')
+        self.failIf(tr.vars.has_key('b'))
+        self.failUnlessEqual(os.path.getsize(self.TESTDB), size)
+        tr.close()
+
+    def testNotALog(self):
+        f = open(self.TESTDB, 'wb')
+        f.write('definitely not a record log')
+        f.close()
+        self.failUnlessRaises(runtimes.RecordLogError, self.RUNTIME, self.TESTDB)
+
+    def testCompact(self):
+        tr = self.RUNTIME(self.TESTDB)
+        tr.set_sync_policy(runtimes.BaseRuntime.SYNC_EXPLICIT)
+        tr.dict_.COMPACT_MIN = 1024
+        for i in range(1000):
+            tr.vars['offset'] = i
+        tr.vars['x'] = 'y'
+        tr.files['f'] = 'f'
+        del tr.files['f']
+        self.failUnless(tr.dict_.needs_compaction())
+        size = os.path.getsize(self.TESTDB)
+        tr.sync()
+        self.failIf(tr.dict_.needs_compaction())
+        self.failUnless(os.path.getsize(self.TESTDB) < size / 10)
+        self.failUnlessEqual(tr.vars['offset'], 999)
+        tr.vars['offset'] = 1000
+        tr.close()
+        tr = self.RUNTIME(self.TESTDB)
+        self.failUnlessEqual(tr.vars['offset'], 1000)
+        self.failUnlessEqual(tr.vars['x'], 'y')
+        self.failIf(tr.files.has_key('f'))
+        tr.close()
+
+
+class CountingRuntime(runtimes.DictRuntime):
+    def __init__(self):
+        runtimes.DictRuntime.__init__(self, {})
+        self.syncs = 0
+    def sync_primitive(self):
+        self.syncs += 1
+
+
+class TestSyncPolicy(unittest.TestCase):
+
+    def testImmediate(self):
+        rt = CountingRuntime()
+        vars = runtimes.TypeDict(rt, 'var')
+        vars['a'] = 1
+        vars['b'] = 2
+        self.failUnlessEqual(rt.syncs, 2)
+
+    def testExplicit(self):
+        rt = CountingRuntime()
+        rt.set_sync_policy(rt.SYNC_EXPLICIT)
+        rt.syncs = 0
+        vars = runtimes.TypeDict(rt, 'var')
+        queue = runtimes.TypeList(rt, 'queue')
+        for i in range(10):
+            vars['a'] = i
+            queue.append(i)
+        self.failUnlessEqual(rt.syncs, 0)
+        rt.barrier()
+        self.failUnlessEqual(rt.syncs, 1)
+        rt.sync()
+        self.failUnlessEqual(rt.syncs, 2)
+
+    def testGroupWrites(self):
+        rt = CountingRuntime()
+        rt.set_sync_policy(rt.SYNC_GROUP, writes=5, interval=3600000)
+        rt.syncs = 0
+        vars = runtimes.TypeDict(rt, 'var')
+        for i in range(12):
+            vars['a'] = i
+        self.failUnlessEqual(rt.syncs, 2)
+        rt.barrier()
+        self.failUnlessEqual(rt.syncs, 3)
+        for i in range(4):
+            vars['a'] = i
+        self.failUnlessEqual(rt.syncs, 3)
+
+    def testGroupInterval(self):
+        clock = task.Clock()
+        rt = CountingRuntime()
+        rt.set_sync_policy(rt.SYNC_GROUP, writes=100, interval=500,
+                call_later=clock.callLater)
+        rt.syncs = 0
+        vars = runtimes.TypeDict(rt, 'var')
+        vars['a'] = 1
+        vars['b'] = 2
+        self.failUnlessEqual(rt.syncs, 0)
+        clock.advance(0.4)
+        self.failUnlessEqual(rt.syncs, 0)
+        clock.advance(0.1)
+        self.failUnlessEqual(rt.syncs, 1)
+        clock.advance(1)
+        self.failUnlessEqual(rt.syncs, 1)
+        vars['c'] = 3
+        rt.barrier()
+        self.failUnlessEqual(rt.syncs, 2)
+        self.failIf(clock.getDelayedCalls())
+
+    def testBatch(self):
+        rt = CountingRuntime()
+        rt.set_sync_policy(rt.SYNC_GROUP, writes=2, interval=3600000)
+        rt.syncs = 0
+        vars = runtimes.TypeDict(rt, 'var')
+        for i in range(3):
+            rt.begin()
+            vars['a'] = i
+            vars['b'] = i
+            rt.end()
+        # each batch counts as single write:
+        self.failUnlessEqual(rt.syncs, 1)
+        rt.set_sync_policy(rt.SYNC_IMMEDIATE)
+        rt.syncs = 0
+        rt.begin()
+        vars['a'] = 1
+        rt.begin()
+        vars['b'] = 1
+        rt.end()
+        self.failUnlessEqual(rt.syncs, 0)
+        rt.end()
+        self.failUnlessEqual(rt.syncs, 1)
+        rt.begin()
+        rt.end()
+        self.failUnlessEqual(rt.syncs, 1)
+
+    def testUnknownPolicy(self):
+        rt = CountingRuntime()
+        self.failUnlessRaises(ValueError, rt.set_sync_policy, 'sometimes')
+
+
+class TestRuntimeBenchmark(unittest.TestCase):
+
+    """
+    Compare runtimes under access patterns used by beakerlc backend.
+
+    Set BEAH_BENCHMARK_SCALE environment variable to get meaningful numbers.
+    """
+
+    skip = BENCHMARK_SKIP
+
+    RUNTIMES = (('shelve', '.bench-runtime.db.tmp', 0),
+            ('log', '.bench-runtime.log.tmp', 0),
+            ('shelve', '.bench-runtime-cached.db.tmp', 1024))
+    if runtimes.sqlite is not None:
+        RUNTIMES += (('sqlite', '.bench-runtime.sqlite.tmp', 0),)
+    COUNT = 200 * BENCHMARK_SCALE
+
+    def _runtime(self, runtime_type, fname, cache_size):
+        runtime = runtimes.open_runtime(fname, runtime_type, cache_size)
+        runtime.set_sync_policy(runtime.SYNC_EXPLICIT)
+        return runtime
+
+    def _stored_data(self, runtime):
+        # PersistentBeakerObject.stored_data and BeakerFile.write/written
+        sd = runtimes.TypeAddict(runtime, 'file_info/f1')
+        for i in xrange(self.COUNT):
+            offset = sd.get('offset', 0)
+            sd['upload_total'] = sd.get('upload_total', 0) + 4096
+            sd['size_total'] = sd.get('size_total', 0) + 4096
+            sd['offset'] = offset + 4096
+        runtime.sync()
+
+    def _offsets(self, runtime):
+        # BeakerWriter.set_offset
+        for i in xrange(self.COUNT):
+            runtime.type_set('offsets/task1', 'debug/task_output_stdout', i*4096)
+        runtime.sync()
+
+    def _id_list(self, runtime):
+        # PersistentBeakerContainer.id_list
+        id_list = runtimes.TypeList(runtime, 'task1/children/BeakerWriter')
+        for i in xrange(self.COUNT):
+            id_list.append('debug/file_%d' % i)
+        runtime.sync()
+        self.failUnlessEqual(len(runtimes.TypeList(runtime,
+            'task1/children/BeakerWriter')), self.COUNT)
+
+    def testBenchmark(self):
+        for runtime_type, fname, cache_size in self.RUNTIMES:
+            label = runtime_type
+            if cache_size:
+                label += '+cache'
+            for name in ('_stored_data', '_offsets', '_id_list'):
+                runtime = self._runtime(runtime_type, fname, cache_size)
+                benchmark('%s %s' % (label, name[1:]), self.COUNT,
+                        getattr(self, name), runtime)
+                if cache_size:
+                    print "cache: %r" % (runtime.cache_stats(),)
+                runtime.close()
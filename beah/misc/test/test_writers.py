@@ -1,8 +1,12 @@
 # -*- test-case-name: beah.misc.test.test_writers -*-
 
+import random
+from StringIO import StringIO
+
 from twisted.trial import unittest
 
 from beah.misc import writers
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
 
 
 class TestWriter(unittest.TestCase):
@@ -63,6 +67,76 @@ class TestCachingWriter(unittest.TestCase):
         wr.close()
         self.failUnlessEqual(l, ['012345678', '0123', '012'])
 
+    def testBuffer(self):
+        """Compare chunked buffer with a plain string."""
+        rnd = random.Random(1)
+        wr = writers.CachingWriter(4)
+        model = ""
+        for i in range(2000):
+            op = rnd.randint(0, 2)
+            if op == 0:
+                data = 'abcdefghij'[:rnd.randint(0, 10)]
+                wr.cache_append(data)
+                model += data
+            elif op == 1:
+                length = rnd.randint(0, 30)
+                self.failUnlessEqual(wr.cache_get(length), model[:length])
+                self.failUnlessEqual(wr.cache_get(), model)
+            else:
+                length = rnd.randint(0, 15)
+                wr.cache_pop(length)
+                model = model[length:]
+            self.failUnlessEqual(wr.cache_len(), len(model))
+
+    def testBenchmark(self):
+        """
+        Many small writes followed by a flush.
+
+        Use BEAH_BENCHMARK_SCALE=100 for 2M writes.
+        """
+        count = 20000 * BENCHMARK_SCALE
+        sent = []
+        wr = writers.CachingWriter(1024*1024, True)
+        wr.send = lambda data: sent.append(len(data))
+        def write():
+            line = 'output line\n'
+            for i in xrange(count):
+                wr.write(line)
+            wr.flush()
+        benchmark('caching writer small writes', count, write)
+        self.failUnlessEqual(sum(sent), count * 12)
+    testBenchmark.skip = BENCHMARK_SKIP
+
+
+class TestAdaptiveCachingWriter(unittest.TestCase):
+
+    def testGrow(self):
+        l = []
+        flushes = []
+        wr = writers.CachingWriter(4, True, max_capacity=10)
+        wr.send = l.append
+        wr.is_ready = False
+        wr.ready = lambda: wr.is_ready
+        wr.schedule_flush = lambda: flushes.append(wr.cache_len())
+        wr.write('0123')
+        self.failUnlessEqual(l, [])
+        self.failUnlessEqual(flushes, [4])
+        wr.write('4567')
+        self.failUnlessEqual(l, [])
+        # at max_capacity data are sent anyway:
+        wr.write('89abcd')
+        self.failUnlessEqual(l, ['0123456789'])
+        wr.is_ready = True
+        wr.write('ef')
+        self.failUnlessEqual(l, ['0123456789', 'abcdef'])
+        wr.write('0123456789abcdefghijklmn')
+        self.failUnlessEqual(l, ['0123456789', 'abcdef', '0123456789',
+            'abcdefghij', 'klmn'])
+        wr.is_ready = False
+        wr.write('0123456789abcdefghijklmn')
+        wr.flush()
+        self.failUnlessEqual(l[-3:], ['0123456789', 'abcdefghij', 'klmn'])
+
 
 class FakeWriter(writers.JournallingWriter):
     def __init__(self, ss, l, offs=-1, wroff=lambda x: None):
@@ -138,3 +212,25 @@ class TestJournallingWriter(unittest.TestCase):
         self.l_expected.append('45')
         self._test()
 
+    def testReplay(self):
+        """Unflushed journal is replayed in pieces."""
+        l = []
+        data = ''.join(['%05d\n' % i for i in range(10000)])
+        class SmallBlockWriter(FakeWriter):
+            REPLAY_BLOCK = 1000
+        wr = SmallBlockWriter(StringIO(data), l, 6)
+        self.failUnless(len(l) > 1000)
+        wr.flush()
+        self.failUnlessEqual(''.join(l), data[6:])
+
+    def testBenchmarkReplay(self):
+        """Replay of a large unflushed journal."""
+        count = 20000 * BENCHMARK_SCALE
+        data = 'output line\n' * count
+        def replay():
+            l = []
+            FakeWriter(StringIO(data), l, 0)
+            return l
+        benchmark('journalling writer replay', count, replay)
+    testBenchmarkReplay.skip = BENCHMARK_SKIP
+
@@ -1,5 +1,7 @@
 # -*- test-case-name: beah.misc.test.test_writers -*-
 
+from collections import deque
+
 class Writer(object):
 
     # PUBLIC INTERFACE:
@@ -37,47 +39,108 @@ class CachingWriter(Writer):
     It buffers data up to capacity length.
     If no_split is set, data submitted in one write won't be broken into more
     chunks.
+
+    With max_capacity set, data are sent in chunks of at most max_capacity
+    and buffered up to max_capacity while ready returns False, which allows
+    sending larger chunks when receiver is busy. schedule_flush is called
+    when data are left in the buffer.
+
+    Buffer is a list of chunks, so appending and removing data does not copy
+    the whole buffer.
     """
 
-    def __init__(self, capacity=4096, no_split=False):
+    def __init__(self, capacity=4096, no_split=False, max_capacity=None):
         self.capacity = capacity
+        self.max_capacity = max_capacity
         if no_split:
-            self.quant = None
+            self.quant = max_capacity
         else:
             self.quant = self.capacity
-        self.buffer = ""
+        # chunks of buffered data. First head bytes of the first chunk were
+        # already removed.
+        self.chunks = deque()
+        self.head = 0
+        self.length = 0
 
     def cache_append(self, data):
-        self.buffer += data
+        if data:
+            self.chunks.append(data)
+            self.length += len(data)
 
     def cache_len(self):
-        return len(self.buffer)
+        return self.length
 
     def cache_get(self, length=None):
-        if length is None or length >= len(self.buffer):
-            return self.buffer
-        else:
-            return self.buffer[:length]
+        if length is None or length > self.length:
+            length = self.length
+        chunks = self.chunks
+        if not chunks:
+            return ""
+        head = self.head
+        first = chunks[0]
+        if head + length <= len(first):
+            if head == 0 and length == len(first):
+                return first
+            return first[head:head+length]
+        answ = [first[head:]]
+        left = length - len(answ[0])
+        chunks = iter(chunks)
+        chunks.next()
+        for chunk in chunks:
+            if left < len(chunk):
+                answ.append(chunk[:left])
+                break
+            answ.append(chunk)
+            left -= len(chunk)
+            if not left:
+                break
+        return "".join(answ)
 
     def cache_pop(self, length):
-        if length >= len(self.buffer):
-            self.buffer = ""
-        else:
-            self.buffer = self.buffer[length:]
+        if length >= self.length:
+            self.chunks.clear()
+            self.head = 0
+            self.length = 0
+            return
+        self.length -= length
+        chunks = self.chunks
+        length += self.head
+        while length >= len(chunks[0]):
+            length -= len(chunks.popleft())
+        self.head = length
+
+    def ready(self):
+        """
+        Return False when receiver is busy and larger chunk should be sent
+        later.
+        """
+        return True
+
+    def schedule_flush(self):
+        """
+        Called when data are left in the buffer.
+        """
+        pass
 
     def write_(self):
         while self.cache_len() >= self.capacity:
+            if self.max_capacity is not None \
+                    and self.cache_len() < self.max_capacity \
+                    and not self.ready():
+                break
             data = self.cache_get(self.quant)
             self.send(data)
             self.cache_pop(len(data))
+        if self.cache_len() > 0:
+            self.schedule_flush()
 
     def write(self, obj):
         self.cache_append(self.repr(obj))
         self.write_()
 
     def flush(self):
-        if self.cache_len() > 0:
-            data = self.cache_get()
+        while self.cache_len() > 0:
+            data = self.cache_get(self.max_capacity)
             self.send(data)
             self.cache_pop(len(data))
 
@@ -89,24 +152,31 @@ class JournallingWriter(CachingWriter):
     Subclass should override set_offset to write to persistent location.
     """
 
-    def __init__(self, journal, offset=-1, capacity=4096, no_split=False):
+    REPLAY_BLOCK = 64*1024
+
+    def __init__(self, journal, offset=-1, capacity=4096, no_split=False,
+            max_capacity=None):
         """
         journal: file-like object.
         offset: position of data which were not sent. -1 - EOF.
         """
         self.journal = journal
+        CachingWriter.__init__(self, capacity=capacity, no_split=no_split,
+                max_capacity=max_capacity)
         if offset < 0:
             self.journal.seek(0, 2)
             self.set_offset(self.journal.tell())
-            unflushed_cache = ""
         else:
             self.set_offset(offset)
             self.journal.seek(offset)
-            unflushed_cache = self.journal.read()
-        CachingWriter.__init__(self, capacity=capacity, no_split=no_split)
-        if unflushed_cache:
-            CachingWriter.cache_append(self, unflushed_cache)
-            self.write_()
+            # replay unflushed data in pieces:
+            block = max(capacity, self.REPLAY_BLOCK)
+            while True:
+                data = self.journal.read(block)
+                if not data:
+                    break
+                CachingWriter.cache_append(self, data)
+                self.write_()
 
     def cache_append(self, data):
         self.journal.write(data)
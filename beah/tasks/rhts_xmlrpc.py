@@ -22,7 +22,7 @@ from twisted.protocols import basic
 from twisted.internet.defer import Deferred
 from twisted.internet.error import CannotListenError
 from twisted.python.failure import Failure
-from beah.misc.jsonenv import json
+from beah.misc import jsonenv
 import sys
 import os
 import os.path
@@ -532,7 +532,7 @@ class RHTSMain(object):
 
     def send_evt(self, evt):
         log.debug("sending evt: %r", evt)
-        self.__controller_output(json.dumps(evt))
+        self.__controller_output(jsonenv.dumps(evt))
 
     TEST_RUNNER = '/usr/bin/beah-rhts-runner.sh'
     SHELL = '/bin/bash'
@@ -1,3 +1,6 @@
+import os
+import time
+
 from twisted.internet.base import DelayedCall
 
 
@@ -18,3 +21,26 @@ class twisted_debug(object):
         finally:
             self.restore()
 
+
+# Benchmarks are skipped unless BEAH_BENCHMARK_SCALE is set. Their sizes are
+# multiplied by it: use 1 for a quick run and 100 or so to get meaningful
+# numbers. Mark benchmarks with skip = BENCHMARK_SKIP.
+BENCHMARK_SCALE = int(os.getenv('BEAH_BENCHMARK_SCALE', '0') or '0')
+if BENCHMARK_SCALE > 0:
+    BENCHMARK_SKIP = None
+else:
+    BENCHMARK_SKIP = "Benchmark. Set BEAH_BENCHMARK_SCALE to run it."
+
+
+def benchmark(label, count, call, *args, **kwargs):
+    """
+    Run call(*args, **kwargs) performing count operations.
+
+    Print and return number of operations per second.
+    """
+    start = time.time()
+    call(*args, **kwargs)
+    elapsed = max(time.time() - start, 1e-6)
+    rate = count / elapsed
+    print "%s: %d ops in %.3fs (%.0f ops/s)" % (label, count, elapsed, rate)
+    return rate
@@ -39,6 +39,7 @@ import beah.config
 from beah.wires.internals.twmisc import serveAnyChild, serveAnyRequest, twisted_logging
 from beah import misc
 from beah.misc import log_this, runtimes
+from beah.core import event
 import beah.tools
 
 LOG_PATH = 'var/log'
@@ -677,9 +678,13 @@ class LCHandler(xmlrpc.XMLRPC):
             'xmlrpc_task_result', 'xmlrpc_task_upload_file', 'catch_xmlrpc',
             'xmlrpc_result_upload_file', 'xmlrpc_extend_watchdog',
             'xmlrpc_recipeset_stop', 'xmlrpc_recipe_stop', 'xmlrpc_job_stop',
-            'xmlrpc_task_info',
+            'xmlrpc_task_info', 'xmlrpc_upload_codecs',
+            'xmlrpc_task_upload_file_encoded',
+            'xmlrpc_result_upload_file_encoded',
             )
 
+    UPLOAD_CODECS = ['gz', 'bz2']
+
     def __init__(self, *args, **kwargs):
         xmlrpc.XMLRPC.__init__(self, *args, **kwargs)
         recipes = LCRecipes()
@@ -761,6 +766,24 @@ class LCHandler(xmlrpc.XMLRPC):
         return self.Return(do_result_upload_file("result_upload_file", result_id, path, name,
                 size, digest, offset, data))
 
+    def xmlrpc_upload_codecs(self):
+        return self.UPLOAD_CODECS
+
+    def decode_upload(self, codec, data):
+        if codec not in self.UPLOAD_CODECS:
+            raise exceptions.NotImplementedError("unknown codec %r" % codec)
+        return base64.encodestring(event.decode(codec + '|base64', data))
+
+    def xmlrpc_task_upload_file_encoded(self, task_id, path, name, size,
+            digest, offset, codec, data):
+        return self.xmlrpc_task_upload_file(task_id, path, name, size, digest,
+                offset, self.decode_upload(codec, data))
+
+    def xmlrpc_result_upload_file_encoded(self, result_id, path, name, size,
+            digest, offset, codec, data):
+        return self.xmlrpc_result_upload_file(result_id, path, name, size,
+                digest, offset, self.decode_upload(codec, data))
+
     def catch_xmlrpc(self, method, *args):
         """Handler for unhandled requests."""
         log.error("Missing method: %r", [method] + list(args))
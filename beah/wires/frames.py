@@ -0,0 +1,250 @@
+# Beah - Test harness. Part of Beaker project.
+#
+# Copyright (C) 2009 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Framing of messages passed between controller, tasks and backends.
+
+Messages are new-line delimited JSON objects by default. A peer announcing it
+can receive binary frames by sending HELLO frame may be sent binary frames:
+
+    '\\0' + struct.pack('!II', header_len, payload_len) + header + payload
+
+where header is a JSON object. Data of file_write events with explicit codec
+are sent as raw binary payload outside the header. Base64 encoding is removed
+from the codec and the data are passed with the remaining codec. A frame with
+empty header and payload is the HELLO frame.
+
+Several objects may be sent as a batch: a JSON array of objects sent in one
+line or frame. Objects are lists themselves, so a batch is a list of lists.
+
+Serialized forms of an Event are cached on the event, so an event sent to
+several backends is serialized only once. The cache is dropped when the event,
+its origin or args were changed since. Only top-level items of origin and args
+are compared: a value changed in place (e.g. a nested dict) is not noticed and
+has to be replaced instead.
+
+This module does not depend on twisted, to be usable from tasks.
+"""
+
+import struct
+import base64
+from beah.core.event import Event
+from beah.misc import jsonenv
+
+BINARY_FRAME = '\0'
+FRAME_HEADER = '!II'
+FRAME_HEADER_LEN = struct.calcsize(FRAME_HEADER)
+FRAME_PREFIX_LEN = len(BINARY_FRAME) + FRAME_HEADER_LEN
+HELLO = BINARY_FRAME + struct.pack(FRAME_HEADER, 0, 0)
+MAX_FRAME_LENGTH = 0x4000000 # 64 MiB
+MAX_LINE_LENGTH = 0x100000 # 1 MiB
+
+_BASE64 = 'base64'
+
+
+def _file_write_args(obj):
+    """Return args of file_write event with explicit codec or None."""
+    if not isinstance(obj, list) or len(obj) < 6 or obj[1] != 'file_write':
+        return None
+    args = obj[5]
+    if not isinstance(args, dict) or args.get('codec', None) is None \
+            or not isinstance(args.get('data', None), basestring):
+        return None
+    return args
+
+
+def has_payload(obj):
+    """Check whether obj carries data sent as payload of a binary frame."""
+    return _file_write_args(obj) is not None
+
+
+def _bytes(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return data
+
+
+def split_payload(obj):
+    """
+    Return (header, payload) pair with data of file_write moved to payload.
+
+    Payload is None if obj does not carry any data. Data in header are
+    replaced by an empty string. obj is not modified.
+    """
+    args = _file_write_args(obj)
+    if args is None:
+        return (obj, None)
+    codec = args['codec']
+    data = _bytes(args['data'])
+    if codec == _BASE64 or codec.endswith('|' + _BASE64):
+        data = base64.decodestring(data)
+        codec = codec[:-len(_BASE64)-1]
+    header = list(obj)
+    header[5] = dict(args, data='', codec=codec)
+    return (header, data)
+
+
+def join_payload(obj, payload):
+    """Put payload received in a binary frame back to obj."""
+    if payload is not None:
+        obj[5]['data'] = payload
+    return obj
+
+
+def json_safe(obj):
+    """
+    Return obj which can be serialized to JSON.
+
+    Raw data received in a binary frame are base64 encoded again.
+    """
+    args = _file_write_args(obj)
+    if args is None:
+        return obj
+    codec = args['codec']
+    if codec == _BASE64 or codec.endswith('|' + _BASE64):
+        return obj
+    if codec:
+        codec = codec + '|' + _BASE64
+    else:
+        codec = _BASE64
+    obj = list(obj)
+    obj[5] = dict(args, data=base64.encodestring(_bytes(args['data'])), codec=codec)
+    return obj
+
+
+def _cached(obj, key, make):
+    """Return make(obj), cached on obj if it is an Event."""
+    if not isinstance(obj, Event):
+        return make(obj)
+    try:
+        snapshot, cache = obj.serialized
+    except AttributeError:
+        snapshot = None
+    if snapshot != obj:
+        snapshot = list(obj)
+        snapshot[Event.ORIGIN] = dict(snapshot[Event.ORIGIN])
+        snapshot[Event.ARGS] = dict(snapshot[Event.ARGS])
+        cache = {}
+        obj.serialized = (snapshot, cache)
+    else:
+        msg = cache.get(key, None)
+        if msg is not None:
+            return msg
+    msg = cache[key] = make(obj)
+    return msg
+
+
+def _dumps_safe(obj):
+    return jsonenv.dumps(json_safe(obj))
+
+
+def dumps(obj):
+    """Serialize obj to JSON. Data of file_write are base64 encoded."""
+    return _cached(obj, 'json', _dumps_safe)
+
+
+def _make_line(obj):
+    return dumps(obj) + "\n"
+
+
+def _make_frame(obj):
+    if not has_payload(obj):
+        return format_json(dumps(obj), True)
+    header, payload = split_payload(obj)
+    header = jsonenv.dumps(header)
+    if payload is None:
+        payload = ''
+    return ''.join([BINARY_FRAME,
+        struct.pack(FRAME_HEADER, len(header), len(payload)), header, payload])
+
+
+def is_batch(obj):
+    """Check whether obj is a batch of objects."""
+    return isinstance(obj, list) and len(obj) > 0 and isinstance(obj[0], list)
+
+
+def format_batch(objs, binary=False):
+    """
+    Create message(s) sending objs as batches.
+
+    In binary mode objects with payload are sent in frames of their own.
+    A batch of a single object is sent as the object.
+    """
+    if not binary:
+        if len(objs) == 1:
+            return format_line(objs[0])
+        return '[' + ', '.join([dumps(obj) for obj in objs]) + ']\n'
+    messages = []
+    batch = []
+    for obj in list(objs) + [None]:
+        if obj is not None and not has_payload(obj):
+            batch.append(obj)
+            continue
+        if len(batch) == 1:
+            messages.append(format_frame(batch[0]))
+        elif batch:
+            messages.append(format_json(
+                '[' + ', '.join([dumps(obj) for obj in batch]) + ']', True))
+        batch = []
+        if obj is not None:
+            messages.append(format_frame(obj))
+    return ''.join(messages)
+
+
+def format_json(header, binary=False):
+    """Create a message from an object already serialized to JSON."""
+    if not binary:
+        return header + "\n"
+    return ''.join([BINARY_FRAME, struct.pack(FRAME_HEADER, len(header), 0),
+        header])
+
+
+def format_line(obj):
+    """Create a JSON line message from an object."""
+    return _cached(obj, 'line', _make_line)
+
+
+def format_frame(obj):
+    """Create a binary frame from an object."""
+    return _cached(obj, 'frame', _make_frame)
+
+
+def frame_length(data, pos=0):
+    """
+    Return length of binary frame starting at pos or None if incomplete.
+    """
+    if len(data) < pos + FRAME_PREFIX_LEN:
+        return None
+    header_len, payload_len = struct.unpack(FRAME_HEADER,
+            data[pos+1:pos+FRAME_PREFIX_LEN])
+    return FRAME_PREFIX_LEN + header_len + payload_len
+
+
+def parse_frame(frame):
+    """
+    Return object sent in a complete binary frame or None for HELLO.
+    """
+    header_len, payload_len = struct.unpack(FRAME_HEADER,
+            frame[1:FRAME_PREFIX_LEN])
+    if not header_len:
+        return None
+    obj = jsonenv.loads(frame[FRAME_PREFIX_LEN:FRAME_PREFIX_LEN+header_len])
+    if payload_len or has_payload(obj):
+        # empty payload is data of the file_write too:
+        obj = join_payload(obj, frame[FRAME_PREFIX_LEN+header_len:])
+    return obj
@@ -172,6 +172,11 @@ class repeatWithHandle(object):
         #return self.__call__(fail)
 
 
+# Stream of calls waiting for all previously submitted calls and blocking all
+# later calls:
+BARRIER = ('<barrier>',)
+
+
 def repeatAlways(fail):
     """
     Convenience repeat function to repeat call forever.
@@ -197,7 +202,14 @@ class RepeatingProxy(object):
     already submitted calls.
 
     In serializing mode, submitted calls are cached, and are processed in
-    order, later call waiting for previous to finish.
+    order, later call waiting for previous to finish. Calls are ordered per
+    stream (see streamRemote): calls in different streams are processed in
+    parallel, up to max_parallel calls at once. Calls submitted without
+    stream share the default stream. Calls in BARRIER stream wait for all
+    earlier calls to finish and all later calls wait for them.
+
+    call_mark and is_done allow to check whether all calls submitted up to
+    some point were finished.
 
     This implementation will retry forever on ConnectError.
 
@@ -205,6 +217,10 @@ class RepeatingProxy(object):
     * by overriding on_idle
     * by calling when_idle which returns deferred (which is default on_idle's
       behavior.)
+
+    on_ready is called when a call finished, there are no calls waiting and
+    more calls could be processed (see is_ready), while other calls are still
+    pending.
     """
 
     def __init__(self, proxy):
@@ -224,8 +240,16 @@ class RepeatingProxy(object):
         self.delay = AdaptiveTimeout(60, max=600)
         # max_retries: maximal number of retrials. Unbound if none.
         self.max_retries = None
-        # serializing: allow only one pending remote call when True
+        # serializing: keep order of remote calls in each stream when True
         self.serializing = False
+        # max_parallel: maximal number of pending calls in serializing mode
+        self.max_parallel = 1
+        # __busy: streams with a pending call
+        self.__busy = {}
+        # __seq: sequence number of the next call
+        self.__seq = 0
+        # __unfinished: sequence numbers of calls which did not finish yet
+        self.__unfinished = {}
         self.proxy = proxy
         # use factory with timeout...
         self.queryFactory = QueryFactoryWithTimeout
@@ -239,6 +263,9 @@ class RepeatingProxy(object):
             self.__on_idle = None
             d.callback(True)
 
+    def on_ready(self): # pylint: disable=E0202
+        pass
+
     def when_idle(self):
         if self.__on_idle is None:
             self.__on_idle = Deferred()
@@ -247,7 +274,7 @@ class RepeatingProxy(object):
     def dump(self):
         return "%r %r" % (self,
                 dict(cache=self.__cache, sleep=self.__sleep,
-                    pending=self.__pending))
+                    pending=self.__pending, busy=self.__busy.keys()))
 
     def is_auto_retry_condition(self, fail):
         """
@@ -269,15 +296,27 @@ class RepeatingProxy(object):
         """
         return True
 
-    def on_ok(self, result, d):
+    def on_ok(self, result, d, m=None):
         """
         Handler for successfull remote call.
         """
         self.__pending -= 1
-        self.__sleep = False
+        if m is not None:
+            self._finished(m)
+        if not self.serializing:
+            self.__sleep = False
         d.callback(result)
         self.delay.decr()
         self.send_next()
+        self._check_ready()
+
+    def _finished(self, m):
+        self.__busy.pop(m[6], None)
+        self.__unfinished.pop(m[7], None)
+
+    def _check_ready(self):
+        if self.is_ready() and not self.is_idle():
+            self.on_ready()
 
     def on_error(self, fail, m):
         """
@@ -286,6 +325,7 @@ class RepeatingProxy(object):
         if fail.check(AlreadyCalledError):
             return -2
         self.__pending -= 1
+        self.__busy.pop(m[6], None)
         repeat = self.is_auto_retry_condition(fail)
         if m[5] is not None and m[5](fail):
             repeat = True
@@ -296,10 +336,13 @@ class RepeatingProxy(object):
                 m[1] -= 1
                 count = m[1]
             if count <= 0 or self.is_accepted_failure(fail):
-                self.__sleep = False
+                self.__unfinished.pop(m[7], None)
+                if not self.serializing:
+                    self.__sleep = False
                 m[0].errback(fail)
                 self.delay.decr()
                 self.send_next()
+                self._check_ready()
                 return -1
         if self.serializing:
             self.insert(m)
@@ -326,16 +369,70 @@ class RepeatingProxy(object):
             return False
         if self.is_empty() or self.__sleep:
             return False
-        if self.serializing and self.__pending > 0:
-            self.__sleep = True
-            return False
-        [d, count, method, args, kwargs, ffilter] = m = self.pop()
-        if self.serializing:
-            self.__sleep = True
+        if not self.serializing:
+            self.send(self.pop())
+            return True
+        sent = False
+        while self.__pending < self.max_parallel:
+            m = self.pop_next()
+            if m is None:
+                break
+            self.__busy[m[6]] = True
+            self.send(m)
+            sent = True
+        return sent
+
+    def send(self, m):
+        [d, count, method, args, kwargs, ffilter, stream, seq] = m
+        if isinstance(args, Deferred):
+            self.__pending += 1
+            args.addCallbacks(self.on_args, self.on_arg_error,
+                    callbackArgs=[m], errbackArgs=[m])
+            return
+        for ix in range(len(args)):
+            if isinstance(args[ix], Deferred):
+                # wait for the argument and count the call as pending:
+                self.__pending += 1
+                args[ix].addCallbacks(self.on_arg, self.on_arg_error,
+                        callbackArgs=[m, ix], errbackArgs=[m])
+                return
         self.callRemote_(method, *args, **kwargs) \
-                .addCallbacks(self.on_ok, self.on_error, callbackArgs=[d],
+                .addCallbacks(self.on_ok, self.on_error, callbackArgs=[d, m],
                         errbackArgs=[m])
-        return True
+
+    def on_arg(self, value, m, ix):
+        """
+        Handler for argument passed as Deferred.
+        """
+        args = list(m[3])
+        args[ix] = value
+        m[3] = tuple(args)
+        self.__pending -= 1
+        self.send(m)
+
+    def on_args(self, value, m):
+        """
+        Handler for arguments of preparedRemote. None cancels the call.
+        """
+        self.__pending -= 1
+        if value is None:
+            self._finished(m)
+            m[0].callback(None)
+            self.send_next()
+            self._check_ready()
+            return
+        m[3] = tuple(value)
+        self.send(m)
+
+    def on_arg_error(self, fail, m):
+        """
+        Handler for failed Deferred argument. The call fails.
+        """
+        self.__pending -= 1
+        self._finished(m)
+        m[0].errback(fail)
+        self.send_next()
+        self._check_ready()
 
     def callRemote_(self, method, *args, **kwargs):
         """
@@ -345,7 +442,7 @@ class RepeatingProxy(object):
         self.__pending += 1
         return answ
 
-    def _makeCall(self, method, args, kwargs, repeat):
+    def _makeCall(self, method, args, kwargs, repeat, stream=None):
         """
         Queue remote call.
 
@@ -353,11 +450,17 @@ class RepeatingProxy(object):
 
         repeat: a callable allowing per-call failure handling.
         On failure, if this function returns True, call will be repeated.
+
+        stream: calls in the same stream are processed in order.
         """
         # Method has to return new deferred, as the original one will be
         # consumed internally.
         d = Deferred()
-        self.push([d, self.max_retries, method, args, kwargs, repeat])
+        seq = self.__seq
+        self.__seq += 1
+        self.__unfinished[seq] = True
+        self.push([d, self.max_retries, method, args, kwargs, repeat, stream,
+            seq])
         self.send_next()
         return d
 
@@ -372,9 +475,36 @@ class RepeatingProxy(object):
     def callRemote(self, method, *args, **kwargs):
         """
         Overridden base class method, to handle retrying.
+
+        Arguments may be Deferreds: the call is sent when they fire.
         """
         return self._makeCall(method, args, kwargs, None)
 
+    def streamRemote(self, stream, method, *args, **kwargs):
+        """
+        Remote call ordered with other calls in the same stream only.
+
+        stream is any hashable object, e.g. (method, id, filename) for
+        uploads of a file.
+        """
+        return self._makeCall(method, args, kwargs, None, stream)
+
+    def preparedRemote(self, stream, method, args):
+        """
+        Remote call with arguments which are not known yet.
+
+        args is a Deferred called with sequence of arguments. The call keeps
+        its place in stream and is sent when arguments are ready. The call is
+        not sent and its result is None when args is called with None.
+        """
+        return self._makeCall(method, args, {}, None, stream)
+
+    def barrierRemote(self, method, *args, **kwargs):
+        """
+        Remote call waiting for all previously submitted calls to finish.
+        """
+        return self._makeCall(method, args, kwargs, None, BARRIER)
+
     def mustPassRemote(self, method, *args, **kwargs):
         """
         Remote call which accepts no failure.
@@ -386,12 +516,55 @@ class RepeatingProxy(object):
     def is_idle(self):
         return self.__pending == 0 and self.is_empty()
 
+    def is_ready(self):
+        """
+        Return True when a new call would be processed immediately.
+        """
+        if not self.serializing:
+            return self.is_empty()
+        return self.is_empty() and self.__pending < self.max_parallel \
+                and not self.__busy.has_key(BARRIER)
+
+    def call_mark(self):
+        """
+        Return mark for is_done identifying calls submitted so far.
+        """
+        return self.__seq
+
+    def is_done(self, mark):
+        """
+        Return True when all calls submitted before call_mark returned mark
+        were finished.
+        """
+        for seq in self.__unfinished.keys():
+            if seq < mark:
+                return False
+        return True
+
     def is_empty(self):
         return not self.__cache
 
     def pop(self):
         return self.__cache.pop(0)
 
+    def pop_next(self):
+        """
+        Remove and return the first call which may be processed in
+        serializing mode or None if there is no such call.
+        """
+        if self.__busy.has_key(BARRIER):
+            return None
+        busy = self.__busy
+        for ix, m in enumerate(self.__cache):
+            stream = m[6]
+            if stream is BARRIER:
+                if ix == 0 and self.__pending == 0:
+                    return self.__cache.pop(0)
+                return None
+            if not busy.has_key(stream):
+                return self.__cache.pop(ix)
+        return None
+
     def insert(self, m):
         self.__cache.insert(0, m)
 
@@ -400,7 +573,8 @@ class RepeatingProxy(object):
 
     _VERBOSE = ('callRemote', 'callRemote_', 'is_accepted_failure', 'is_auto_retry_condition')
     _MORE_VERBOSE = ('is_accepted_failure', 'on_ok', 'on_error',
-                'resend', 'send_next', 'when_idle', 'is_empty', 'is_idle',
-                'pop', 'insert', 'push')
+                'resend', 'send_next', 'send', 'on_args', 'on_arg',
+                'on_arg_error', 'when_idle', 'is_empty', 'is_idle', 'is_ready',
+                'pop', 'pop_next', 'insert', 'push')
     _VERBOSE_CLASSES = (QueryWithTimeoutProtocol, QueryFactoryWithTimeout, )
 
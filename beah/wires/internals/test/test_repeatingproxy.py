@@ -10,6 +10,7 @@ from twisted.internet import reactor, defer
 from twisted.trial import unittest
 from twisted.python import failure
 from twisted.internet.base import DelayedCall
+from twisted.internet.error import ConnectionLost
 
 from beah.wires.internals import repeatingproxy
 from beah.misc.log_this import log_this
@@ -273,6 +274,160 @@ class TestRepeatingProxy(unittest.TestCase):
         return p.when_idle()
 
 
+class FakeProxy(object):
+
+    """Proxy recording calls, which are finished by calling finish."""
+
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        d = defer.Deferred()
+        self.calls.append((method, d))
+        return d
+
+    def pending(self):
+        return [method for method, d in self.calls if not d.called]
+
+    def finish(self, method, fail=None):
+        for m, d in self.calls:
+            if m == method and not d.called:
+                if fail is None:
+                    d.callback(method)
+                else:
+                    d.errback(fail)
+                return
+        raise KeyError(method)
+
+
+class TestStreams(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeProxy()
+        p = self.proxy = repeatingproxy.RepeatingProxy(self.fake)
+        p.serializing = True
+        p.max_parallel = 3
+        self.ready = 0
+        p.on_ready = self.on_ready
+
+    def on_ready(self):
+        self.ready += 1
+
+    def testParallel(self):
+        p = self.proxy
+        results = []
+        for call in ['a1', 'a2', 'b1', 'c1', 'd1']:
+            p.streamRemote(call[0], call).addCallback(results.append)
+        # one call per stream, up to max_parallel:
+        self.failUnlessEqual(self.fake.pending(), ['a1', 'b1', 'c1'])
+        self.failIf(p.is_ready())
+        self.fake.finish('b1')
+        self.failUnlessEqual(self.fake.pending(), ['a1', 'c1', 'd1'])
+        self.fake.finish('a1')
+        self.failUnlessEqual(self.fake.pending(), ['c1', 'd1', 'a2'])
+        self.failUnlessEqual(self.ready, 0)
+        self.fake.finish('d1')
+        self.failUnless(p.is_ready())
+        self.failUnlessEqual(self.ready, 1)
+        self.fake.finish('c1')
+        self.fake.finish('a2')
+        self.failUnless(p.is_idle())
+        self.failUnlessEqual(results, ['b1', 'a1', 'd1', 'c1', 'a2'])
+
+    def testBarrier(self):
+        p = self.proxy
+        p.streamRemote('a', 'a1')
+        p.streamRemote('b', 'b1')
+        p.barrierRemote('stop')
+        p.streamRemote('c', 'c1')
+        self.failUnlessEqual(self.fake.pending(), ['a1', 'b1'])
+        self.fake.finish('a1')
+        self.failUnlessEqual(self.fake.pending(), ['b1'])
+        self.fake.finish('b1')
+        self.failUnlessEqual(self.fake.pending(), ['stop'])
+        self.failIf(p.is_ready())
+        self.fake.finish('stop')
+        self.failUnlessEqual(self.fake.pending(), ['c1'])
+
+    def testDeferredArgument(self):
+        p = self.proxy
+        arg = defer.Deferred()
+        results = []
+        p.streamRemote('a', 'a1', arg).addCallback(results.append)
+        p.streamRemote('a', 'a2').addCallback(results.append)
+        p.streamRemote('b', 'b1').addCallback(results.append)
+        self.failUnlessEqual(self.fake.pending(), ['b1'])
+        self.failIf(p.is_idle())
+        arg.callback('data')
+        self.failUnlessEqual(self.fake.pending(), ['b1', 'a1'])
+        self.fake.finish('a1')
+        self.fake.finish('a2')
+        self.fake.finish('b1')
+        self.failUnlessEqual(results, ['a1', 'a2', 'b1'])
+        self.failUnless(p.is_idle())
+
+    def testDeferredArgumentFailure(self):
+        p = self.proxy
+        arg = defer.Deferred()
+        failures = []
+        p.streamRemote('a', 'a1', arg).addErrback(failures.append)
+        p.streamRemote('a', 'a2')
+        arg.errback(failure.Failure(RuntimeError()))
+        self.failUnlessEqual(len(failures), 1)
+        self.failUnlessEqual(self.fake.pending(), ['a2'])
+
+    def testPreparedArguments(self):
+        p = self.proxy
+        args1, args2 = defer.Deferred(), defer.Deferred()
+        results = []
+        p.preparedRemote('a', 'a1', args1).addCallback(results.append)
+        p.preparedRemote('a', 'a2', args2).addCallback(results.append)
+        p.streamRemote('a', 'a3').addCallback(results.append)
+        mark = p.call_mark()
+        self.failUnlessEqual(self.fake.pending(), [])
+        # a1 is cancelled:
+        args1.callback(None)
+        self.failUnlessEqual(self.fake.pending(), [])
+        args2.callback(['data'])
+        self.failUnlessEqual(self.fake.pending(), ['a2'])
+        self.fake.finish('a2')
+        self.failIf(p.is_done(mark))
+        self.fake.finish('a3')
+        self.failUnless(p.is_done(mark))
+        self.failUnlessEqual(results, [None, 'a2', 'a3'])
+        self.failUnless(p.is_idle())
+
+    def testCallMark(self):
+        p = self.proxy
+        p.streamRemote('a', 'a1')
+        mark1 = p.call_mark()
+        p.streamRemote('b', 'b1')
+        mark2 = p.call_mark()
+        self.fake.finish('b1')
+        self.failIf(p.is_done(mark1))
+        self.failIf(p.is_done(mark2))
+        self.fake.finish('a1')
+        self.failUnless(p.is_done(mark1))
+        self.failUnless(p.is_done(mark2))
+
+    def testRetryKeepsOrder(self):
+        p = self.proxy
+        p.delay = repeatingproxy.ConstTimeout(0)
+        p.streamRemote('a', 'a1')
+        p.streamRemote('a', 'a2')
+        p.streamRemote('b', 'b1')
+        self.fake.finish('a1', failure.Failure(ConnectionLost()))
+        # waiting for retry:
+        self.failUnlessEqual(self.fake.pending(), ['b1'])
+        d = defer.Deferred()
+        def check():
+            self.failUnlessEqual(self.fake.pending(), ['b1', 'a1'])
+            self.fake.finish('a1')
+            self.failUnlessEqual(self.fake.pending(), ['b1', 'a2'])
+        reactor.callLater(0, d.callback, None)
+        return d.addCallback(lambda _: check())
+
+
 if VERBOSE:
     repeatingproxy.RepeatingProxy._VERBOSE = repeatingproxy.RepeatingProxy._VERBOSE + repeatingproxy.RepeatingProxy._MORE_VERBOSE
     make_class_verbose(repeatingproxy.RepeatingProxy, print_this)
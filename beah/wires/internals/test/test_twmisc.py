@@ -0,0 +1,485 @@
+# -*- test-case-name: beah.wires.internals.test.test_twmisc -*-
+
+import socket
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import abstract, reactor
+from twisted.protocols import basic
+
+import beahlib
+from beah.core import event, command
+from beah.misc import jsonenv
+from beah.test import benchmark, BENCHMARK_SCALE, BENCHMARK_SKIP
+from beah.wires import frames
+from beah.wires.internals import twmisc, twadaptors
+
+
+class Receiver(twmisc.JSONProtocol):
+
+    binary = True
+
+    def __init__(self):
+        self.received = []
+        self.exceeded = []
+
+    def proc_input(self, obj):
+        self.received.append(obj)
+
+    def lineLengthExceeded(self, line):
+        self.exceeded.append(len(line))
+
+
+def connected(protocol):
+    transport = proto_helpers.StringTransport()
+    protocol.makeConnection(transport)
+    return transport
+
+
+class TestFrames(unittest.TestCase):
+
+    def testSplitPayload(self):
+        evt = event.file_write('f1', event.encode('gz|base64', 'abc'),
+                codec='gz|base64')
+        header, payload = frames.split_payload(evt)
+        self.failUnlessEqual(header[5]['codec'], 'gz')
+        self.failUnlessEqual(header[5]['data'], '')
+        self.failUnlessEqual(event.decode('gz', payload), 'abc')
+        # original event is untouched:
+        self.failUnlessEqual(evt.arg('codec'), 'gz|base64')
+        obj = frames.join_payload(header, payload)
+        safe = frames.json_safe(obj)
+        self.failUnlessEqual(safe[5]['codec'], 'gz|base64')
+        self.failUnlessEqual(event.decode('gz|base64', safe[5]['data']), 'abc')
+
+    def testNoPayload(self):
+        evt = event.file_write('f1', 'abc')
+        self.failUnlessEqual(frames.split_payload(evt), (evt, None))
+        self.failUnless(frames.json_safe(evt) is evt)
+        evt = event.output('line')
+        self.failUnlessEqual(frames.split_payload(evt), (evt, None))
+
+    def testRoundTrip(self):
+        data = ''.join([chr(i % 256) for i in xrange(1000)])
+        evt = event.file_write('f1', event.encode('base64', data),
+                codec='base64')
+        frame = frames.format_frame(evt)
+        self.failUnless(len(frame) < len(frames.format_line(evt)))
+        self.failUnlessEqual(frames.frame_length(frame), len(frame))
+        self.failUnlessEqual(frames.frame_length(frame[:3]), None)
+        obj = frames.parse_frame(frame)
+        self.failUnlessEqual(obj[5]['codec'], '')
+        self.failUnlessEqual(obj[5]['data'], data)
+        self.failUnlessEqual(frames.parse_frame(frames.HELLO), None)
+
+    def testEmptyData(self):
+        for codec in ('base64', 'gz|base64'):
+            evt = event.file_write('f1', event.encode(codec, ''), codec=codec)
+            obj = frames.parse_frame(frames.format_frame(evt))
+            args = obj[5]
+            self.failUnless(isinstance(args['data'], str))
+            self.failUnlessEqual(event.decode(args['codec'], args['data']), '')
+            safe = frames.json_safe(obj)[5]
+            self.failUnlessEqual(event.decode(safe['codec'], safe['data']), '')
+
+
+class TestSerializedCache(unittest.TestCase):
+
+    def _count_dumps(self):
+        calls = []
+        dumps = jsonenv.dumps
+        def counting_dumps(obj):
+            calls.append(obj)
+            return dumps(obj)
+        self.patch(jsonenv, 'dumps', counting_dumps)
+        return calls
+
+    def testFanOut(self):
+        calls = self._count_dumps()
+        evt = event.linfo('message')
+        adaptors = []
+        for binary in (False, True, False, True):
+            adaptor = twadaptors.BackendAdaptor_JSON()
+            adaptor.binary = binary
+            adaptor.set_controller(None)
+            adaptors.append((adaptor, connected(adaptor)))
+            if binary:
+                adaptor.dataReceived(frames.HELLO)
+        for adaptor, transport in adaptors:
+            transport.clear()
+            adaptor.proc_evt(evt)
+        self.failUnlessEqual(len(calls), 1)
+        self.failUnlessEqual(adaptors[0][1].value(), frames.format_line(list(evt)))
+        self.failUnlessEqual(adaptors[1][1].value(), frames.format_frame(list(evt)))
+        # batches reuse serialized events, too:
+        adaptors[0][0].proc_evts([evt, evt])
+        self.failUnlessEqual(len(calls), 3)
+
+    def testInvalidate(self):
+        calls = self._count_dumps()
+        evt = event.file_write('f1', event.encode('base64', 'abc'),
+                codec='base64')
+        frames.format_line(evt)
+        self.failUnlessEqual(frames.format_frame(evt), frames.format_frame(evt))
+        self.failUnlessEqual(len(calls), 2)
+        evt.origin()['id'] = 'task1'
+        self.failUnlessEqual(frames.parse_frame(frames.format_frame(evt))[3],
+                {'id': 'task1'})
+        evt.args()['data'] = event.encode('base64', 'def')
+        line = frames.format_line(evt)
+        self.failUnlessEqual(event.decode('base64', jsonenv.loads(line)[5]['data']),
+                'def')
+        self.failUnlessEqual(len(calls), 4)
+
+    def testBenchmark(self):
+        count = 5000 * BENCHMARK_SCALE
+        backends = 5
+        evts = [event.linfo('line %d' % i, origin={'id': 'task1'})
+                for i in xrange(count)]
+        lists = [list(evt) for evt in evts]
+        def fan_out(objs):
+            for obj in objs:
+                for i in xrange(backends):
+                    frames.format_frame(obj)
+        benchmark('%d backends, serialized per backend' % backends, count,
+                fan_out, lists)
+        benchmark('%d backends, serialized once' % backends, count,
+                fan_out, evts)
+    testBenchmark.skip = BENCHMARK_SKIP
+
+
+class TestJSONProtocol(unittest.TestCase):
+
+    def testMixedFraming(self):
+        data = 'x' * (2 * Receiver.MAX_LENGTH)
+        evt = event.file_write('f1', event.encode('base64', data),
+                codec='base64')
+        stream = ''.join([frames.format_line(['a']), frames.HELLO,
+            frames.format_frame(evt), frames.format_line(['b'])])
+        p = Receiver()
+        connected(p)
+        # feed in pieces not aligned with frames:
+        for i in xrange(0, len(stream), 4093):
+            p.dataReceived(stream[i:i+4093])
+        self.failUnless(p.peer_binary)
+        self.failUnlessEqual(p.exceeded, [])
+        self.failUnlessEqual(len(p.received), 3)
+        self.failUnlessEqual(p.received[0], ['a'])
+        self.failUnlessEqual(p.received[1][5]['data'], data)
+        self.failUnlessEqual(p.received[2], ['b'])
+
+    def testNulWithoutFraming(self):
+        controller = FakeController()
+        task = twadaptors.TaskAdaptor_JSON()
+        task.set_controller(controller)
+        connected(task)
+        evt = event.linfo('line')
+        task.dataReceived('\0abc\n' + frames.format_line(evt))
+        self.failUnlessEqual([e.event() for e in controller.events],
+                ['lose_item', 'log'])
+        self.failUnlessEqual(controller.events[0].arg('data'), '\0abc')
+        self.failUnlessEqual(controller.events[1].arg('message'), 'line')
+
+    def testLineLength(self):
+        p = Receiver()
+        connected(p)
+        p.dataReceived('x' * (Receiver.MAX_LENGTH + 2))
+        self.failUnlessEqual(p.exceeded, [Receiver.MAX_LENGTH + 2])
+        self.failUnlessEqual(p.received, [])
+
+    def testSend(self):
+        p = Receiver()
+        transport = connected(p)
+        evt = event.file_write('f1', event.encode('base64', 'abc'),
+                codec='base64')
+        p.send_cmd(evt)
+        p.dataReceived(frames.HELLO)
+        p.send_cmd(evt)
+        sent = transport.value()
+        line = frames.format_line(evt)
+        # the announcement is answered before the frame is sent:
+        self.failUnless(sent.startswith(line + frames.HELLO))
+        sent = sent[len(line + frames.HELLO):]
+        self.failUnlessEqual(frames.parse_frame(sent)[5]['data'], 'abc')
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.events = []
+
+    def set_controller(self, controller=None):
+        pass
+
+    def proc_evt(self, evt):
+        self.events.append(evt)
+
+    def proc_evts(self, evts):
+        self.events.append(evts)
+
+
+class FakeController(object):
+
+    def __init__(self):
+        self.batches = []
+        self.events = []
+        self.flow = []
+
+    def add_task(self, task):
+        pass
+
+    def add_backend(self, backend):
+        pass
+
+    def remove_backend(self, backend):
+        pass
+
+    def proc_evt(self, task, evt):
+        self.events.append(evt)
+
+    def proc_evts(self, task, evts):
+        self.batches.append(evts)
+
+    def backend_paused(self, backend):
+        self.flow.append('paused')
+
+    def backend_resumed(self, backend):
+        self.flow.append('resumed')
+
+
+class StalledTransport(abstract.FileDescriptor):
+
+    """Transport buffering data until the peer reads them."""
+
+    def __init__(self):
+        abstract.FileDescriptor.__init__(self, reactor)
+        self.connected = 1
+        self.stalled = True
+        self.sent = []
+
+    def writeSomeData(self, data):
+        if self.stalled:
+            return 0
+        self.sent.append(str(data))
+        return len(data)
+
+    def startWriting(self):
+        pass
+
+    def stopWriting(self):
+        pass
+
+
+class TestAdaptors(unittest.TestCase):
+
+    def testBackendReceivesJSONSafeEvents(self):
+        backend = FakeBackend()
+        p = twadaptors.ControllerAdaptor_Backend_JSON()
+        p.add_backend(backend)
+        transport = connected(p)
+        # backend replies to controller's announcement only:
+        self.failUnlessEqual(transport.value(), '')
+        p.dataReceived(frames.HELLO)
+        self.failUnlessEqual(transport.value(), frames.HELLO)
+        evt = event.file_write('f1', event.encode('base64', '\0\1\2'),
+                codec='base64')
+        p.dataReceived(frames.format_frame(evt))
+        self.failUnlessEqual(backend.events[0].arg('codec'), 'base64')
+        self.failUnlessEqual(event.decode('base64',
+            backend.events[0].arg('data')), '\0\1\2')
+
+    def testBatch(self):
+        controller = FakeController()
+        task = twadaptors.TaskAdaptor_JSON()
+        task.set_controller(controller)
+        task.origin = {'id': 'task1'}
+        connected(task)
+        evts = [event.linfo('1'), event.file_write('f1',
+            event.encode('base64', 'abc'), codec='base64'), event.linfo('2')]
+        task.dataReceived(frames.format_batch(evts))
+        received = controller.batches[0]
+        self.failUnlessEqual([evt.event() for evt in received],
+                ['log', 'file_write', 'log'])
+        self.failUnlessEqual(received[0].origin()['id'], 'task1')
+        # forward to backend in binary mode:
+        be_adaptor = twadaptors.BackendAdaptor_JSON()
+        be_adaptor.binary = True
+        be_adaptor.set_controller(None)
+        transport = connected(be_adaptor)
+        be_adaptor.dataReceived(frames.HELLO)
+        transport.clear()
+        be_adaptor.proc_evts(received)
+        backend = FakeBackend()
+        p = twadaptors.ControllerAdaptor_Backend_JSON()
+        p.add_backend(backend)
+        connected(p)
+        p.dataReceived(transport.value())
+        self.failUnlessEqual([evt.event() for evt in backend.events],
+                ['log', 'file_write', 'log'])
+        self.failUnlessEqual(event.decode('base64',
+            backend.events[1].arg('data')), 'abc')
+
+    def testBackpressure(self):
+        controller = FakeController()
+        backend = twadaptors.BackendAdaptor_JSON()
+        backend.high_water_mark = 1000
+        backend.set_controller(controller)
+        transport = StalledTransport()
+        backend.makeConnection(transport)
+        self.failUnlessEqual(transport.bufferSize, 1000)
+        evt = event.linfo('x' * 100)
+        while not controller.flow:
+            backend.proc_evt(evt)
+        self.failUnlessEqual(controller.flow, ['paused'])
+        transport.stalled = False
+        transport.doWrite()
+        self.failUnlessEqual(controller.flow, ['paused', 'resumed'])
+        self.failUnless(''.join(transport.sent).endswith(frames.format_line(evt)))
+
+    def testPauseTask(self):
+        task = twadaptors.TaskAdaptor_JSON()
+        task.set_controller(FakeController())
+        transport = connected(task)
+        task.pauseProducing()
+        self.failUnlessEqual(transport.producerState, 'paused')
+        task.resumeProducing()
+        self.failUnlessEqual(transport.producerState, 'producing')
+
+
+class BaselineReceiver(basic.LineReceiver):
+
+    """JSON line protocol of beah versions without binary framing."""
+
+    delimiter = "\n"
+    MAX_LENGTH = 0x100000
+
+    def __init__(self):
+        self.received = []
+
+    def lineReceived(self, data):
+        # unparsable data are fatal, as lose_item raises:
+        self.received.append(jsonenv.loads(data))
+
+
+class TestCompatibility(unittest.TestCase):
+
+    """Peers without binary framing understand the default configuration."""
+
+    def _check(self, adaptor, send):
+        transport = connected(adaptor)
+        send(adaptor)
+        peer = BaselineReceiver()
+        peer.dataReceived(transport.value())
+        self.failUnlessEqual(len(peer.received), 1)
+        return peer.received[0]
+
+    def testTaskAdaptor(self):
+        task = twadaptors.TaskAdaptor_JSON()
+        task.set_controller(None)
+        obj = self._check(task, lambda p: p.proc_cmd(command.ping()))
+        self.failUnlessEqual(obj[1], 'ping')
+
+    def testBackendAdaptor(self):
+        backend = twadaptors.BackendAdaptor_JSON()
+        backend.set_controller(None)
+        evt = event.file_write('f1', event.encode('base64', 'abc'),
+                codec='base64')
+        obj = self._check(backend, lambda p: p.proc_evt(evt))
+        self.failUnlessEqual(obj, list(evt))
+
+    def testControllerAdaptors(self):
+        p = twadaptors.ControllerAdaptor_Backend_JSON()
+        p.add_backend(FakeBackend())
+        obj = self._check(p, lambda p: p.proc_cmd(None, command.ping()))
+        self.failUnlessEqual(obj[1], 'ping')
+        p = twadaptors.ControllerAdaptor_Task_JSON()
+        p.add_task(FakeBackend())
+        obj = self._check(p, lambda p: p.proc_evt(None, event.linfo('x')))
+        self.failUnlessEqual(obj[1], 'log')
+
+    def testEnabled(self):
+        backend = twadaptors.BackendAdaptor_JSON()
+        backend.binary = True
+        backend.set_controller(None)
+        self.failUnlessEqual(connected(backend).value(), frames.HELLO)
+
+
+class TestSocketSender(unittest.TestCase):
+
+    def _sender(self, greeting, batches=True):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        theirs.sendall(greeting)
+        self.patch(beahlib.SocketSender, 'HELLO_TIMEOUT', 0.1)
+        return (beahlib.SocketSender(sock=ours, hello=True, batches=batches),
+                theirs)
+
+    def _received(self, peer, lines=1):
+        peer.settimeout(5)
+        data = ''
+        while data.count('\n') < lines:
+            data += peer.recv(65536)
+        received = Receiver()
+        received.dataReceived(data)
+        return received.received
+
+    def testBinary(self):
+        sender, peer = self._sender(frames.HELLO, batches=False)
+        self.failUnless(sender.binary)
+        self.failUnless(sender.batches)
+        evt = event.file_write('f1', event.encode('base64', 'abc'),
+                codec='base64')
+        sender(evt)
+        frame = frames.format_frame(evt)
+        self.failUnlessEqual(peer.recv(len(frame)), frame)
+        sender.close()
+
+    def testBatch(self):
+        sender, peer = self._sender('')
+        evts = [event.linfo('message %d' % i) for i in range(3)]
+        for evt in evts:
+            sender(evt)
+        sender.flush()
+        self.failUnlessEqual(self._received(peer), [evts])
+        sender.close()
+
+    def testBatchSize(self):
+        sender, peer = self._sender('')
+        small = [event.linfo('x' * 50) for i in range(3)]
+        size = len(jsonenv.dumps(small[0]))
+        # room for two small events only:
+        sender.BATCH_SIZE = 2 * size + 2
+        large = event.linfo('y' * sender.BATCH_SIZE)
+        for evt in small + [large]:
+            sender(evt)
+        # the batch is closed before it grows over BATCH_SIZE and the large
+        # event is sent alone:
+        self.failUnlessEqual(self._received(peer, 3),
+                [small[:2], small[2], large])
+        sender.close()
+
+    def testUrgent(self):
+        sender, peer = self._sender('')
+        evts = [event.linfo('message'), event.passed('done')]
+        for evt in evts:
+            sender(evt)
+        self.failUnlessEqual(self._received(peer), [evts])
+        sender.close()
+
+    def testBatchDelay(self):
+        sender, peer = self._sender('')
+        sender.BATCH_DELAY = 0.01
+        sender(event.linfo('message'))
+        peer.settimeout(5)
+        self.failUnless(peer.recv(4096).endswith('\n'))
+        sender.close()
+
+    def testOldController(self):
+        sender, peer = self._sender('', batches=False)
+        self.failIf(sender.binary)
+        self.failIf(sender.batches)
+        evts = [event.linfo('message %d' % i) for i in range(2)]
+        for evt in evts:
+            sender(evt)
+        self.failUnlessEqual(self._received(peer, 2), evts)
+        sender.close()
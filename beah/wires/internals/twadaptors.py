@@ -18,12 +18,21 @@
 
 from beah.core import event, command
 from beah.core.errors import KilledException
+from beah.wires import frames
 from beah.wires.internals.twmisc import JSONProtocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import classImplements
 
 class ControllerAdaptor_Backend_JSON(JSONProtocol):
     """
     Class implementing ControllerInterface used by Twisted backends.
+
+    Events received in binary frames are passed to backend JSON serializable.
+
+    Backend not keeping pace with events pauses the adaptor: the transport
+    stops reading, so the controller holds events back and pauses tasks.
     """
+    binary = True
     def add_backend(self, backend):
         self.backend = backend
         self.backend.set_controller(None) # Wait for connectionMade
@@ -34,7 +43,11 @@ class ControllerAdaptor_Backend_JSON(JSONProtocol):
         """Process data(Event) received from Controller - forward to Backend"""
         if self.backend:
             try:
-                self.backend.proc_evt(event.Event(cmd))
+                if frames.is_batch(cmd):
+                    self.backend.proc_evts([event.adopt(frames.json_safe(evt))
+                        for evt in cmd])
+                else:
+                    self.backend.proc_evt(event.adopt(frames.json_safe(cmd)))
             except KilledException:
                 # FIXME: kill?
                 print "Server was killed, should also die..."
@@ -43,6 +56,10 @@ class ControllerAdaptor_Backend_JSON(JSONProtocol):
     def proc_cmd(self, backend, cmd):
         """Process Command received from backend - forward to Controller"""
         self.send_cmd(cmd)
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+    def resumeProducing(self):
+        self.transport.resumeProducing()
     def connectionMade(self):
         if self.backend:
             self.backend.set_controller(self)
@@ -53,7 +70,13 @@ class ControllerAdaptor_Backend_JSON(JSONProtocol):
 class BackendAdaptor_JSON(JSONProtocol):
     """
     Class implementing BackendInterface used by Twisted Controller.
+
+    The adaptor is registered as a producer with its transport: when more than
+    high_water_mark bytes are waiting to be sent to the backend, controller is
+    told to pause tasks until the data are sent.
     """
+    binary = False # frames are announced only if enabled
+    high_water_mark = None
     def set_controller(self, controller=None):
         self.controller = controller
     def proc_input(self, cmd):
@@ -63,17 +86,39 @@ class BackendAdaptor_JSON(JSONProtocol):
     def proc_evt(self, evt, **flags):
         """Process Event received from Controller - forward to Backed"""
         self.send_cmd(evt)
+    def proc_evts(self, evts, **flags):
+        """Process a batch of Events received from Controller - forward to
+        Backend as a batch"""
+        self.send_batch(evts)
+    def pauseProducing(self):
+        if self.controller:
+            self.controller.backend_paused(self)
+    def resumeProducing(self):
+        if self.controller:
+            self.controller.backend_resumed(self)
+    def stopProducing(self):
+        self.resumeProducing()
     def connectionMade(self):
+        self.announce_binary()
+        if self.high_water_mark:
+            self.transport.bufferSize = self.high_water_mark
+        self.transport.registerProducer(self, True)
         if self.controller:
             self.controller.add_backend(self)
     def connectionLost(self, reason):
         if self.controller:
             self.controller.remove_backend(self)
+classImplements(BackendAdaptor_JSON, IPushProducer)
 
 class TaskAdaptor_JSON(JSONProtocol):
     """
     Class implementing TaskInterface used by Twisted Controller.
+
+    Controller pauses the task when backends are not keeping pace: the
+    producer, the transport events are read from, stops reading.
     """
+    binary = False # frames are announced only if enabled
+    producer = None
     def __init__(self):
         self.origin = {}
     def set_controller(self, controller=None):
@@ -83,12 +128,18 @@ class TaskAdaptor_JSON(JSONProtocol):
         if not cmd:
             return
         if self.controller:
-            try:
-                evt = event.Event(cmd)
-                evt.origin().update(self.origin)
-            except:
-                evt = event.lose_item(data=cmd, origin=dict(self.origin))
-            self.controller.proc_evt(self, evt)
+            if frames.is_batch(cmd):
+                self.controller.proc_evts(self, [self.make_evt(obj)
+                    for obj in cmd])
+            else:
+                self.controller.proc_evt(self, self.make_evt(cmd))
+    def make_evt(self, obj):
+        try:
+            evt = event.adopt(obj)
+            evt.origin().update(self.origin)
+        except:
+            evt = event.lose_item(data=obj, origin=dict(self.origin))
+        return evt
     def lose_item(self, data):
         if self.controller:
             self.controller.proc_evt(self, event.lose_item(data=data,
@@ -96,7 +147,15 @@ class TaskAdaptor_JSON(JSONProtocol):
     def proc_cmd(self, cmd):
         """Process Command received from Controller - forward to Task"""
         self.send_cmd(cmd)
+    def pauseProducing(self):
+        if self.producer is not None:
+            self.producer.pauseProducing()
+    def resumeProducing(self):
+        if self.producer is not None:
+            self.producer.resumeProducing()
     def connectionMade(self):
+        self.announce_binary()
+        self.producer = self.transport
         if self.controller:
             self.controller.add_task(self)
     def connectionLost(self, reason):
@@ -107,6 +166,7 @@ class ControllerAdaptor_Task_JSON(JSONProtocol):
     """
     Class implementing ControllerInterface used by Twisted tasks.
     """
+    binary = True
     def add_task(self, task):
         self.task = task
         self.task.set_controller(None) # wait for connectionMade
@@ -21,7 +21,8 @@ from twisted.internet import reactor
 from beah.wires.internals.twadaptors import ControllerAdaptor_Backend_JSON
 from beah.wires.internals.twmisc import twisted_logging, connect_loopback
 from beah import config
-from beah.misc import make_log_handler, str2log_level, localhost_, parse_bool
+from beah.misc import make_log_handler, str2log_level, localhost_, parse_bool, \
+        set_handler
 
 import os
 import logging
@@ -39,7 +40,7 @@ class BackendFactory(ReconnectingClientFactory):
             if backend.controller:
                 backend.controller.transport.loseConnection()
             byef_(evt)
-        backend.proc_evt_bye = proc_evt_bye
+        set_handler(backend, 'proc_evt_bye', proc_evt_bye)
         self.controller_protocol = controller_protocol
         # set up ReconnectingClientFactory:
         # we do not want test killed by watchdog. repeat at least every 120s.
@@ -16,7 +16,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from beah.misc.jsonenv import json
+from beah.misc import jsonenv
+from beah.wires import frames
 from twisted.protocols import basic
 from twisted.internet import reactor
 from twisted.internet.error import DNSLookupError, NoRouteError, CannotListenError
@@ -27,10 +28,25 @@ USE_DEFAULT = object()
 
 class JSONProtocol(basic.LineReceiver):
 
-    """Protocol to send and receive new-line delimited JSON objects"""
+    """
+    Protocol to send and receive new-line delimited JSON objects
+
+    Binary frames (see beah.wires.frames) are accepted too. Objects are sent
+    in binary frames once the peer has announced it accepts them.
+
+    Subclasses with binary set accept frames. The accepting side of a
+    connection announces it by calling announce_binary when connected, the
+    connecting side replies to peer's announcement only: a peer not
+    supporting frames would not understand the HELLO frame.
+    """
 
     delimiter = "\n"
-    MAX_LENGTH = 0x100000 # 1 MiB
+    MAX_LENGTH = frames.MAX_LINE_LENGTH
+    MAX_FRAME_LENGTH = frames.MAX_FRAME_LENGTH
+
+    binary = False
+    announced = False
+    peer_binary = False
 
     ########################################
     # METHODS TO REIMPLEMENT:
@@ -47,20 +63,99 @@ class JSONProtocol(basic.LineReceiver):
     ########################################
     def send_cmd(self, obj):
         """Send an object as a message"""
-        self.transport.write(self.format(obj))
+        if self.peer_binary:
+            self.transport.write(frames.format_frame(obj))
+        else:
+            self.transport.write(self.format(obj))
+
+    def send_batch(self, objs):
+        """Send a list of objects as a batch"""
+        if objs:
+            self.transport.write(frames.format_batch(objs, self.peer_binary))
 
     def format(obj):
         """Create a message from an object"""
-        return json.dumps(obj) + "\n"
+        return frames.format_line(obj)
     # AVOID DECORATORS - KEEP PYTHON 2.2 COMPATIBILITY
     format = staticmethod(format)
 
+    def announce_binary(self):
+        """Tell the peer binary frames are accepted."""
+        if self.binary and not self.announced:
+            self.announced = True
+            self.transport.write(frames.HELLO)
+
+    def frameReceived(self, frame):
+        try:
+            obj = frames.parse_frame(frame)
+        except:
+            obj = self.lose_item(frame)
+        else:
+            if obj is None:
+                self.peer_binary = True
+                self.announce_binary()
+                return
+        self.proc_input(obj)
+
     ########################################
     # INHERITED METHODS:
     ########################################
+    _rx_chunks = ()
+    _rx_len = 0
+    _rx_needed = 0
+
+    def dataReceived(self, data):
+        """
+        Split received data into lines and binary frames.
+
+        Chunks of an incomplete frame are joined only when the frame is
+        complete. Frames are recognized only by protocols accepting them or
+        talking to a peer which announced them, otherwise data starting with
+        NUL are a line as any other.
+        """
+        if not self._rx_chunks:
+            self._rx_chunks = []
+        self._rx_chunks.append(data)
+        self._rx_len += len(data)
+        if self._rx_len < self._rx_needed:
+            return
+        buf = ''.join(self._rx_chunks)
+        self._rx_chunks = []
+        self._rx_len = 0
+        self._rx_needed = 0
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            if self.transport and self.transport.disconnecting:
+                return
+            if buf[pos] == frames.BINARY_FRAME \
+                    and (self.binary or self.peer_binary):
+                length = frames.frame_length(buf, pos)
+                if length is not None and length > self.MAX_FRAME_LENGTH:
+                    return self.lineLengthExceeded(buf[pos:])
+                if length is None or pos + length > size:
+                    self._rx_needed = length or frames.FRAME_PREFIX_LEN
+                    break
+                self.frameReceived(buf[pos:pos+length])
+                pos += length
+            else:
+                end = buf.find(self.delimiter, pos)
+                if end < 0:
+                    if size - pos >= self.MAX_LENGTH + len(self.delimiter):
+                        return self.lineLengthExceeded(buf[pos:])
+                    break
+                if end - pos > self.MAX_LENGTH:
+                    return self.lineLengthExceeded(buf[pos:])
+                self.lineReceived(buf[pos:end])
+                pos = end + len(self.delimiter)
+        if pos < size:
+            rest = buf[pos:]
+            self._rx_chunks.append(rest)
+            self._rx_len = len(rest)
+
     def lineReceived(self, data):
         try:
-            obj = json.loads(data)
+            obj = jsonenv.loads(data)
         except:
             obj = self.lose_item(data)
         self.proc_input(obj)
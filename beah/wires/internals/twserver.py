@@ -33,14 +33,21 @@ import os
 log = logging.getLogger('beah')
 
 class BackendListener(protocol.ServerFactory):
-    def __init__(self, controller, backend_protocol=BackendAdaptor_JSON):
+    def __init__(self, controller, backend_protocol=BackendAdaptor_JSON,
+            high_water_mark=None, binary=False):
         self.protocol = backend_protocol or BackendAdaptor_JSON
         self.controller = controller
+        self.high_water_mark = high_water_mark
+        self.binary = binary
 
     def buildProtocol(self, addr):
         log.info('%s: New client connected from remote address %s', self.__class__.__name__, addr)
         backend = self.protocol()
         backend.client_addr = addr
+        if self.high_water_mark:
+            backend.high_water_mark = self.high_water_mark
+        if self.binary:
+            backend.binary = True
         # FIXME: filterring requests for remote backends
         # - configuration, filterring,...
         #backend.set_cmd_filter()
@@ -51,13 +58,17 @@ class BackendListener(protocol.ServerFactory):
         return backend
 
 class TaskListener(protocol.ServerFactory):
-    def __init__(self, controller, task_protocol=TaskAdaptor_JSON):
+    def __init__(self, controller, task_protocol=TaskAdaptor_JSON,
+            binary=False):
         self.protocol = task_protocol or TaskAdaptor_JSON
         self.controller = controller
+        self.binary = binary
 
     def buildProtocol(self, addr):
         log.info('%s: New client connected from remote address %s', self.__class__.__name__, addr)
         task = self.protocol()
+        if self.binary:
+            task.binary = True
         task.set_controller(self.controller)
         log.debug('%s: Connected [Done]', self.__class__.__name__)
         return task
@@ -106,7 +117,12 @@ def start_server(conf=None, backend_host=None, backend_port=None,
         backend_socket = ''
         task_port = int(task_port)
         task_socket = ''
-    runtime = runtimes.ShelveRuntime(conf.get('CONTROLLER', 'RUNTIME_FILE_NAME'))
+    runtime = runtimes.open_runtime(conf.get('CONTROLLER', 'RUNTIME_FILE_NAME'),
+            conf.get('CONTROLLER', 'RUNTIME_TYPE'))
+    runtime.set_sync_policy(conf.get('CONTROLLER', 'RUNTIME_SYNC'),
+            writes=conf.get('CONTROLLER', 'RUNTIME_SYNC_WRITES'),
+            interval=conf.get('CONTROLLER', 'RUNTIME_SYNC_INTERVAL'),
+            call_later=reactor.callLater)
     runtime.vars = runtimes.TypeDict(runtime, 'vars')
     runtime.tasks = runtimes.TypeDict(runtime, 'tasks')
     controller = Controller(spawn or Spawn(task_host, task_port, socket=task_socket),  runtime=runtime)
@@ -119,7 +135,10 @@ def start_server(conf=None, backend_host=None, backend_port=None,
     log.info("################################")
     log.info("#   Starting a Controller...   #")
     log.info("################################")
-    backend_listener = BackendListener(controller, backend_adaptor)
+    binary = parse_bool(conf.get('CONTROLLER', 'BINARY_FRAMES'))
+    backend_listener = BackendListener(controller, backend_adaptor,
+            high_water_mark=int(conf.get('BACKEND', 'HIGH_WATER_MARK')),
+            binary=binary)
     if backend_port != '':
         if backend_host == 'localhost':
             listening = listen_loopback_tcp(backend_port, backend_listener)
@@ -138,7 +157,7 @@ def start_server(conf=None, backend_host=None, backend_port=None,
             os.remove(backend_socket)
         log.info("Controller: BackendListener listening on %s", backend_socket)
         reactor.listenUNIX(backend_socket, backend_listener)
-    task_listener = TaskListener(controller, task_adaptor)
+    task_listener = TaskListener(controller, task_adaptor, binary=binary)
     if task_port != '':
         if task_host == 'localhost':
             listening = listen_loopback_tcp(task_port, task_listener)
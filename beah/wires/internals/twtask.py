@@ -49,9 +49,13 @@ class TaskStdoutProtocol(ProcessProtocol):
         log.debug("%s:connectionMade", self.__class__.__name__)
         self.pid = self.transport.pid
         self.task = self.task_protocol()
+        # stdout is task's output, never binary frames:
+        self.task.binary = False
         # FIXME: this is not very nice...
         self.task.send_cmd = lambda obj: self.transport.write(self.task.format(obj))
         self.task.task_id = self.task_id
+        # stdout and stderr are not read while the task is paused:
+        self.task.producer = self.transport
         self.task.set_controller(self.controller)
         self.set_master()
         self.controller.task_started(self.task)
@@ -105,6 +109,8 @@ def Spawn(host, port, proto=None, socket=''):
         # BEAH_TPORT - port
         # BEAH_TSOCKET - socket
         # BEAH_TID - id of task - used to introduce itself when opening socket
+        # BEAH_TBINARY - controller announces binary frames
+        # BEAH_TBATCH - controller accepts batches of events
         task_id = task_info['id']
         conf = config.get_conf('beah')
         env_file = os.path.join(conf.get('TASK', 'VAR_ROOT'),
@@ -122,6 +128,9 @@ def Spawn(host, port, proto=None, socket=''):
         task_env.setdefault('BEAH_TASK_LOG', ll)
         task_env.setdefault('BEAH_TASK_CONSOLE', conf.get('TASK', 'CONSOLE_LOG', 'False'))
         task_env.setdefault('TERM', 'dumb')
+        task_env['BEAH_TBATCH'] = '1'
+        if parse_bool(conf.get('CONTROLLER', 'BINARY_FRAMES')):
+            task_env['BEAH_TBINARY'] = '1'
         val = os.getenv('PYTHONPATH')
         if val:
             task_env['PYTHONPATH'] = val
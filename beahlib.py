@@ -11,9 +11,12 @@ Usage:
 import sys
 import os
 import socket
+import threading
+import atexit
 from beah.core import event, new_id, command
 from beah.core.constants import RC, LOG_LEVEL
-from beah.misc.jsonenv import json
+from beah.misc import jsonenv
+from beah.wires import frames
 
 
 """
@@ -32,7 +35,7 @@ think about this:
 
 
 def a_command(str):
-    return command.command(json.loads(str))
+    return command.command(jsonenv.loads(str))
 
 
 class BeahError(Exception):
@@ -57,13 +60,13 @@ def an_answer(evt, str):
 
 
 def stdout_send(evt):
-    print json.dumps(evt)
+    print jsonenv.dumps(evt)
     answ = sys.stdin.readline()
     return an_answer(evt, answ)
 
 
 def stdout_send_noanswer(evt):
-    print json.dumps(evt)
+    print jsonenv.dumps(evt)
     return 0
 
 
@@ -76,14 +79,55 @@ def StdoutSender(nowait=True):
 
 class SocketSender(object):
 
-    def __init__(self, nowait=True):
+    """
+    Send events to the controller over a socket.
+
+    Events are sent in binary frames when controller announces it accepts
+    them right after the connection is made. The announcement is waited for
+    only if hello is True, by default when BEAH_TBINARY is set by controller.
+
+    When not waiting for answers and the controller accepts batches
+    (BEAH_TBATCH is set by controller or it announced binary frames), events
+    are buffered and sent in batches. A batch is sent before it would grow
+    over BATCH_SIZE bytes, BATCH_DELAY seconds after the first event was
+    buffered, with any of URGENT_EVENTS, on flush and at exit. Events larger
+    than BATCH_SIZE are sent on their own.
+    """
+
+    HELLO_TIMEOUT = 5
+    # well below the controller's frames.MAX_LINE_LENGTH:
+    BATCH_SIZE = 64*1024
+    BATCH_DELAY = 0.5
+    # events which are not to be held back, e.g. if the task is killed:
+    URGENT_EVENTS = ('end', 'result', 'abort', 'rebooting', 'kill',
+            'set_timeout', 'extend_watchdog')
+
+    def __init__(self, nowait=True, sock=None, hello=None, batches=None):
         self.buffer = ""
         self.nowait = nowait
+        if hello is None:
+            hello = bool(os.getenv('BEAH_TBINARY'))
+        self.hello = hello
+        if batches is None:
+            batches = bool(os.getenv('BEAH_TBATCH'))
+        self.batches = batches
+        self.binary = False
+        self.batch = []
+        self.batch_size = 0
+        self.timer = None
+        self.lock = threading.RLock()
+        atexit.register(self.flush)
+        # use already connected socket:
+        if sock is not None:
+            self.s = sock
+            self.wait_hello()
+            return
         # if available: use Unix socket:
         tsocket = os.getenv('BEAH_TSOCKET')
         if tsocket:
             self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             self.s.connect(tsocket)
+            self.wait_hello()
             return
         # otherwise: TCP/IP socket:
         thost = os.getenv('BEAH_THOST')
@@ -91,21 +135,94 @@ class SocketSender(object):
         if thost and tport:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.s.connect((thost, tport))
+            self.wait_hello()
             return
         # unavailable:
         self.s = None
         raise Exception('None of BEAH_TSOCKET or (BEAH_THOST, BEAH_TPORT) are defined!')
 
+    def wait_hello(self):
+        """Check whether controller accepts binary frames."""
+        if not self.hello:
+            return
+        self.s.settimeout(self.HELLO_TIMEOUT)
+        try:
+            try:
+                while len(self.buffer) < len(frames.HELLO):
+                    answ = self.s.recv(len(frames.HELLO) - len(self.buffer))
+                    if not answ:
+                        break
+                    self.buffer += answ
+                    if not frames.HELLO.startswith(self.buffer):
+                        break
+            except socket.timeout:
+                pass
+        finally:
+            self.s.settimeout(None)
+        if self.buffer == frames.HELLO:
+            self.buffer = ""
+            self.binary = True
+            self.batches = True
+
     def __del__(self):
         self.close()
 
     def close(self):
         if self.s is not None:
+            self.flush()
             self.s.close()
             self.s = None
 
+    def flush(self):
+        """Send buffered events."""
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch = self.batch
+            if not batch or self.s is None:
+                return
+            self.batch = []
+            self.batch_size = 0
+            if len(batch) == 1:
+                header = batch[0]
+            else:
+                header = '[' + ','.join(batch) + ']'
+            self.s.sendall(frames.format_json(header, self.binary))
+        finally:
+            self.lock.release()
+
+    def send(self, evt):
+        if self.binary:
+            self.s.sendall(frames.format_frame(evt))
+        else:
+            self.s.sendall(frames.format_line(evt))
+
     def __call__(self, evt):
-        self.s.send(json.dumps(evt)+"\n")
+        self.lock.acquire()
+        try:
+            if self.nowait and self.batches \
+                    and not (self.binary and frames.has_payload(evt)):
+                item = jsonenv.dumps(frames.json_safe(evt))
+                if self.batch_size + len(item) + len(self.batch) > self.BATCH_SIZE:
+                    self.flush()
+                if len(item) < self.BATCH_SIZE:
+                    self.batch.append(item)
+                    self.batch_size += len(item)
+                    if evt[event.Event.EVENT] in self.URGENT_EVENTS:
+                        self.flush()
+                    elif self.timer is None:
+                        self.timer = threading.Timer(self.BATCH_DELAY, self.flush)
+                        self.timer.setDaemon(True)
+                        self.timer.start()
+                    return
+            # large events, events with binary payload and events waiting for
+            # an answer are sent on their own:
+            self.flush()
+            self.send(evt)
+        finally:
+            self.lock.release()
         if self.nowait:
             return
         while True:
@@ -325,7 +442,11 @@ class BeahTask(IBeahSection):
         return self.send(event.lose_item(o))
 
     def flush(self):
-        return self.send(event.flush())
+        answ = self.send(event.flush())
+        flush = getattr(self._sender, 'flush', None)
+        if flush is not None:
+            flush()
+        return answ
 
     def set_timeout(self, timeout):
         return self.send(event.set_timeout(timeout))
@@ -366,6 +487,8 @@ class BeahResult(BeahEventObject, IBeahUpload):
 class BeahFile(BeahEventObject):
 
     MAX_CHUNK_SIZE = 128*1024
+    # binary frames are not limited by maximal line length:
+    BINARY_CHUNK_SIZE = 1024*1024
     CODEC = 'base64'
 
     def __init__(self, parent, handle):
@@ -379,10 +502,14 @@ class BeahFile(BeahEventObject):
         # and sending whole file. Just copy it to known location. Event that
         # could be avoided
         f = open(filename, 'r')
+        if getattr(self.task()._sender, 'binary', False):
+            chunk_size = self.BINARY_CHUNK_SIZE
+        else:
+            chunk_size = self.MAX_CHUNK_SIZE
         try:
             offset = 0
             while True:
-                data = f.read(self.MAX_CHUNK_SIZE)
+                data = f.read(chunk_size)
                 if not data:
                     break
                 self.upload_chunk(offset, data)